@@ -58,6 +58,7 @@ com_q = Queue.Queue(maxsize=200000)
 # Initialize Data Writer, hand log to labview VIs
 card_q = card_in.get_queues()
 data_out = data_writer(card_q[0],[temp_control.get_queue()],sys_time)
+data_out.set_card_info(card_in.get_channel_names(), card_in.sample_freq)
 data_out.start()
 temp_control.set_log(data_out)
 
@@ -0,0 +1,159 @@
+#
+# benchmark.py
+#
+# general use benchmarking script for the acquisition and data writing path
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import os
+import sys
+import time
+import numpy as np
+
+# Run against the simulated driver in daqmx_sim.py with --sim, must be set before nidaq is imported
+import parameters
+if "--sim" in sys.argv:
+	parameters.DAQ_backend = "simulated"
+from nidaq import *
+
+# The original per-sample timestamping loop, kept for comparison with nidaq.timestamp_block
+def timestamp_loop(data, pts, count, freq):
+	d = np.zeros((pts,data.shape[1]+1),dtype=np.float64)
+	for j in range(0,pts):
+		count += 1
+		d[j][0] = count/freq
+		d[j][1:] = data[j][:]
+	return d
+# end timestamp_loop
+
+# Times the block timestamping step alone, no hardware required
+# Prints the number of samples per channel per second that a single core can timestamp
+def bench_timestamping(channels=10, freq=100000.0, poll_delay=0.05, seconds=2.0):
+	pts = int(freq*poll_delay)
+	data = np.random.uniform(-5.0, 5.0, (pts, channels))
+	offsets = np.arange(1, pts+1, dtype=np.float64)
+	for name, step in (("vectorized", lambda c: timestamp_block(data, pts, c, freq, offsets)),
+					   ("per-sample loop", lambda c: timestamp_loop(data, pts, c, freq))):
+		count = 0
+		t0 = time.time()
+		while time.time() - t0 < seconds:
+			step(count)
+			count += pts
+		rate = count/(time.time() - t0)
+		print "%s timestamping: %.0f S/s per channel at %d channels (%.1fx real time at %.0f S/s)"%(name, rate, channels, rate/freq, freq)
+# end bench_timestamping
+
+# Runs the card at %freq samples per second per channel for %seconds and counts the samples that
+# arrive on the data queue, the acquisition keeps up if the received rate matches the requested rate.
+# Also prints the latency from the last sample of each block being clocked to the block arriving
+def bench_acquisition(channels=10, physical_chan="Dev1/ai0:7, Dev1/ai16:17", freq=100000.0, seconds=10.0):
+	card = analog_voltage_time_input(channels, physical_chan, 1, sample_freq=freq)
+	q = card.get_queues()[0]
+	t0 = time.time()
+	card.start()
+	got = 0
+	latency = []
+	while time.time() - t0 < seconds:
+		try:
+			d = q.get(timeout=1.0)
+		except Queue.Empty:
+			continue
+		if d.shape[0] > 0:
+			latency.append(time.time() - t0 - d[-1,0])
+		got += d.shape[0]
+	elapsed = time.time() - t0
+	card.stop()
+	print "acquisition: received %.0f S/s per channel of %.0f S/s requested (%.1f%%)"%(got/elapsed, freq, 100.0*got/(elapsed*freq))
+	if len(latency) > 0:
+		print "acquisition: block latency mean %.1f ms, max %.1f ms"%(1e3*np.mean(latency), 1e3*np.max(latency))
+# end bench_acquisition
+
+# Compares polling on the scheduler with fixed block reads, printing the block interval jitter and the
+# CPU time used by the process in each mode while the card runs at %freq for %seconds
+def bench_poll_modes(channels=10, physical_chan="Dev1/ai0:7, Dev1/ai16:17", freq=100000.0, seconds=10.0):
+	for name, block_size in (("scheduled poll", 0), ("block read", int(freq*0.05))):
+		card = analog_voltage_time_input(channels, physical_chan, 1, sample_freq=freq, block_size=block_size)
+		q = card.get_queues()[0]
+		cpu0 = sum(os.times()[:2])
+		t0 = time.time()
+		card.start()
+		while time.time() - t0 < seconds:
+			try:
+				q.get(timeout=1.0)
+			except Queue.Empty:
+				pass
+		card.stop()
+		cpu = sum(os.times()[:2]) - cpu0
+		print "%s: %s, CPU %.1f%%"%(name, card.block_timing.summary(), 100.0*cpu/(time.time() - t0))
+# end bench_poll_modes
+
+# Times writing a block of card data as text with one str() per value against datafiles.format_text_block,
+# the best of %repeat runs of each, and checks that the text parses back to the same values
+# The bulk formatter was meant to be 10 times faster, it is 8 to 11 times depending on the machine, see the
+# comment on text data files in datafiles.py for why
+def bench_text_format(channels=10, rows=100000, repeat=3):
+	block = np.column_stack((np.arange(1, rows+1)/100000.0, np.random.uniform(-5.0, 5.0, (rows, channels))))
+	out = open(os.devnull, 'w')
+	t_str = t_bulk = float('inf')
+	for i in range(repeat):
+		t0 = time.time()
+		for a in block:
+			out.write("\t".join(str(x) for x in a) + "\n")
+		t_str = min(t_str, time.time() - t0)
+		t0 = time.time()
+		text = format_text_block(block)
+		out.write(text)
+		t_bulk = min(t_bulk, time.time() - t0)
+	out.close()
+	back = np.loadtxt(text.splitlines())
+	print "text formatting: str() %.0f rows/s, bulk %.0f rows/s (%.1fx, %s the 10x target), max parse back error %.2e"%(rows/t_str,
+		rows/t_bulk, t_str/t_bulk, "meets" if t_str >= 10*t_bulk else "SHORT of", np.abs(back - block).max())
+# end bench_text_format
+
+# Runs %jobs jobs on the scheduler, each taking %work seconds every %interval seconds, for %seconds
+# and prints the timing of each, the lateness, jitter and overruns
+def bench_scheduler(jobs=8, interval=0.05, work=0.005, seconds=5.0):
+	s = scheduler()
+	for i in range(jobs):
+		s.add(lambda: time.sleep(work), interval, "job " + str(i))
+	time.sleep(seconds)
+	for line in s.stats():
+		print "scheduler " + line
+	s.stop()
+# end bench_scheduler
+
+# Reads %n LakeShore 625 magnets on loopback ports (see serialloop.loopback_lakeshore_625) through the
+# serial loop for each n in %instruments, each polled every %interval seconds for %seconds, and prints
+# the readings per second and the CPU time used, the link at %baudrate limits each magnet
+def bench_serial_loop(instruments=(1, 4, 16, 64), baudrate=9600, interval=0.01, seconds=5.0):
+	from serialcom import lakeshore_625
+	from serialloop import loopback_lakeshore_625
+	for n in instruments:
+		magnets = [lakeshore_625("loopback", Stopwatch(), port=loopback_lakeshore_625(baudrate)) for i in range(n)]
+		jobs = [get_scheduler().add(m.read_data, interval, "magnet " + str(i)) for i, m in enumerate(magnets)]
+		cpu0 = sum(os.times()[:2])
+		t0 = time.time()
+		time.sleep(seconds)
+		for job in jobs:
+			job.cancel()
+		elapsed = time.time() - t0
+		cpu = sum(os.times()[:2]) - cpu0
+		got = sum([m.get_data_queue().qsize() for m in magnets])
+		timeouts = sum([m.loop_port.timeouts for m in magnets])
+		for m in magnets:
+			m.stop()
+		print "serial loop: %d magnets at %d baud, %.0f readings/s (%.1f each), %d timeouts, CPU %.1f%%"%(n, baudrate, got/elapsed, got/elapsed/n, timeouts, 100.0*cpu/elapsed)
+# end bench_serial_loop
+
+if __name__ == "__main__":
+	bench_timestamping()
+	bench_scheduler()
+	if "--serial" in sys.argv:
+		bench_serial_loop()
+		bench_serial_loop(baudrate=115200)
+	bench_text_format()
+	if "--card" in sys.argv or "--sim" in sys.argv:
+		bench_acquisition()
+		bench_poll_modes()
@@ -0,0 +1,251 @@
+#
+# catalog.py
+#
+# GaborDAQ run catalog, an SQLite database of the recorded runs in the data directory
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+
+from parameters import *
+from runloader import run_files
+
+# The catalog records every run with its files, start and stop times, sample frequency and channels,
+# the parameter changes from its log, and the minimum, maximum and mean of each column of its tmp and mag
+# data, so that runs can be found without reading the data files, for example all runs with a field
+# above 1 T at 4 K:
+#
+#	cat = run_catalog()
+#	cat.find_runs([('mag.field', 'max', '>', 1.0), ('tmp.A', 'mean', '<', 4.5)])
+#
+# It also holds the next run number of each day, so the data writer gets a new run number without
+# searching the data directory
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, date TEXT, run INTEGER,
+	started REAL, stopped REAL, sample_freq REAL, channels TEXT);
+CREATE TABLE IF NOT EXISTS files (run_id INTEGER, type TEXT, path TEXT);
+CREATE TABLE IF NOT EXISTS params (run_id INTEGER, time REAL, name TEXT, value TEXT, number REAL);
+CREATE TABLE IF NOT EXISTS stats (run_id INTEGER, stream TEXT, col TEXT, min REAL, max REAL, mean REAL);
+CREATE TABLE IF NOT EXISTS next_run (date TEXT PRIMARY KEY, run INTEGER);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (date, run);
+CREATE INDEX IF NOT EXISTS files_run ON files (run_id);
+CREATE INDEX IF NOT EXISTS params_name ON params (name, number);
+CREATE INDEX IF NOT EXISTS params_run ON params (run_id);
+CREATE INDEX IF NOT EXISTS stats_col ON stats (stream, col);
+CREATE INDEX IF NOT EXISTS stats_run ON stats (run_id);
+"""
+catalog_ops = ('<', '<=', '>', '>=', '=', '!=')
+run_file_pattern = re.compile(r'^(\d{4}_\d{2}_\d{2})_(\d+)_(\w+)\.(\w+)$')
+
+# Returns %value as a number, or None if it is not one
+def as_number(value):
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return None
+# end as_number
+
+# The run catalog, may be used from any thread
+# %filename is the SQLite database, created if it doesn't exist
+# %data_dir is the directory holding the data files
+class run_catalog():
+	def __init__(self, filename=None, data_dir=data_dir_path):
+		if filename == None:
+			filename = os.path.join(data_dir, catalog_file)
+		self.filename = filename
+		self.data_dir = data_dir
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+		self.db.executescript(catalog_schema)
+	#
+
+	# Reserves and returns the next run number of %date, given as %year_%month_%day, today if None
+	# The first time a day is seen the data directory is searched for runs made without the catalog
+	def allocate_run(self, date=None):
+		if date == None:
+			date = time.strftime("%Y_%m_%d")
+		with self.lock:
+			self.db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self.db.execute("SELECT run FROM next_run WHERE date = ?", (date,)).fetchone()
+				if row == None:
+					run = self.first_free_run(date)
+					self.db.execute("INSERT INTO next_run (date, run) VALUES (?, ?)", (date, run + 1))
+				else:
+					run = row[0]
+					self.db.execute("UPDATE next_run SET run = ? WHERE date = ?", (run + 1, date))
+				self.db.execute("COMMIT")
+			except:
+				self.db.execute("ROLLBACK")
+				raise
+		return run
+	#
+
+	# Returns the first run number of %date after every run in the data directory
+	def first_free_run(self, date):
+		last = -1
+		if os.path.isdir(self.data_dir):
+			for name in os.listdir(self.data_dir):
+				m = run_file_pattern.match(name)
+				if m and m.group(1) == date:
+					last = max(last, int(m.group(2)))
+		return last + 1
+	#
+
+	# Records the start of run number %run of %date, %files is a dictionary of the data file of each type
+	# A run already in the catalog keeps its id and its old files, parameters and statistics are removed
+	# Returns the id of the run in the catalog
+	def start_run(self, date, run, files, sample_freq=None, channels=None, started=None):
+		if started == None:
+			started = time.time()
+		name = str(date) + '_' + str(run)
+		with self.lock:
+			self.db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self.db.execute("SELECT id FROM runs WHERE name = ?", (name,)).fetchone()
+				if row == None:
+					run_id = self.db.execute("INSERT INTO runs (name, date, run, started, sample_freq, channels) VALUES (?, ?, ?, ?, ?, ?)",
+						(name, date, run, started, sample_freq, json.dumps(channels))).lastrowid
+				else:
+					run_id = row[0]
+					self.db.execute("UPDATE runs SET date = ?, run = ?, started = ?, stopped = NULL, sample_freq = ?, channels = ? WHERE id = ?",
+						(date, run, started, sample_freq, json.dumps(channels), run_id))
+					for table in ('files', 'params', 'stats'):
+						self.db.execute("DELETE FROM " + table + " WHERE run_id = ?", (run_id,))
+				self.db.executemany("INSERT INTO files (run_id, type, path) VALUES (?, ?, ?)",
+					[(run_id, str(t), str(p)) for t, p in files.items()])
+				self.db.execute("COMMIT")
+			except:
+				self.db.execute("ROLLBACK")
+				raise
+		return run_id
+	#
+
+	# Records the end of run %run_id, with its parameter changes and the statistics of its tmp and mag data
+	def finish_run(self, run_id, stopped=None):
+		if stopped == None:
+			stopped = time.time()
+		with self.lock:
+			name = self.db.execute("SELECT name FROM runs WHERE id = ?", (run_id,)).fetchone()[0]
+		params, stats = self.read_run(os.path.join(self.data_dir, name))
+		with self.lock:
+			self.db.execute("BEGIN IMMEDIATE")
+			try:
+				self.db.execute("UPDATE runs SET stopped = ? WHERE id = ?", (stopped, run_id))
+				self.db.execute("DELETE FROM params WHERE run_id = ?", (run_id,))
+				self.db.execute("DELETE FROM stats WHERE run_id = ?", (run_id,))
+				self.db.executemany("INSERT INTO params (run_id, time, name, value, number) VALUES (?, ?, ?, ?, ?)",
+					[(run_id,) + p for p in params])
+				self.db.executemany("INSERT INTO stats (run_id, stream, col, min, max, mean) VALUES (?, ?, ?, ?, ?, ?)",
+					[(run_id,) + s for s in stats])
+				self.db.execute("COMMIT")
+			except:
+				self.db.execute("ROLLBACK")
+				raise
+	#
+
+	# Reads the parameter changes and the statistics of the slow streams of the run %prefix
+	# Returns (params, stats), lists of (time, name, value, number) and (stream, column, min, max, mean)
+	def read_run(self, prefix):
+		params = []
+		stats = []
+		try:
+			run = run_files(prefix)
+		except IOError:
+			return params, stats
+		for t in run.types():
+			if t == 'log':
+				for p in run.log:
+					if p['name'] != '':
+						params.append((float(p['time']), p['name'], p['value'], as_number(p['value'])))
+			elif t != 'bnc':
+				s = run[t]
+				for c in s.columns()[1:]:
+					v = np.asarray(s[c], dtype=np.float64)
+					v = v[np.isfinite(v)]
+					if v.shape[0] > 0:
+						stats.append((t, c, float(v.min()), float(v.max()), float(v.mean())))
+				s.forget()
+		return params, stats
+	#
+
+	# Adds the runs in the data directory that are not in the catalog, for runs recorded before it existed
+	# Returns the number of runs added
+	def scan(self):
+		runs = {}
+		for name in os.listdir(self.data_dir):
+			m = run_file_pattern.match(name)
+			if m and m.group(4) != index_file_ext:
+				runs.setdefault((m.group(1), int(m.group(2))), {})[m.group(3)] = os.path.join(self.data_dir, name)
+		added = 0
+		for (date, run), files in sorted(runs.items()):
+			with self.lock:
+				known = self.db.execute("SELECT id FROM runs WHERE name = ?", (date + '_' + str(run),)).fetchone() != None
+			if known:
+				continue
+			started = min(os.path.getmtime(p) for p in files.values())
+			run_id = self.start_run(date, run, files, started=started)
+			self.finish_run(run_id, max(os.path.getmtime(p) for p in files.values()))
+			with self.lock:
+				self.db.execute("UPDATE runs SET started = NULL WHERE id = ?", (run_id,)) # Not known
+			added += 1
+		return added
+	#
+
+	# Returns the names of the runs meeting every condition in %conditions, on %date if given
+	# Each condition is a tuple of
+	# (stream.column, statistic, op, value) - a statistic, 'min', 'max' or 'mean', of a column of the tmp or
+	#                                         mag data, for example ('mag.field', 'max', '>', 1.0)
+	# ('param.' + name, op, value)          - a parameter set during the run, for example ('param.Heater Setpoint', '>=', 4)
+	# op is one of <, <=, >, >=, = and !=
+	def find_runs(self, conditions=(), date=None):
+		sql = "SELECT name FROM runs WHERE 1"
+		args = []
+		if date != None:
+			sql += " AND date = ?"
+			args.append(date)
+		for cond in conditions:
+			op = cond[-2]
+			if op not in catalog_ops:
+				raise ValueError("catalog.find_runs : unknown op " + str(op))
+			if cond[0].startswith('param.'):
+				sql += " AND EXISTS (SELECT 1 FROM params p WHERE p.run_id = runs.id AND p.name = ? AND p.number " + op + " ?)"
+				args += [cond[0][len('param.'):], cond[2]]
+			else:
+				stream, col = cond[0].split('.', 1)
+				stat = cond[1]
+				if stat not in ('min', 'max', 'mean'):
+					raise ValueError("catalog.find_runs : unknown statistic " + str(stat))
+				sql += " AND EXISTS (SELECT 1 FROM stats s WHERE s.run_id = runs.id AND s.stream = ? AND s.col = ? AND s." + stat + " " + op + " ?)"
+				args += [stream, col, cond[3]]
+		sql += " ORDER BY date, run"
+		with self.lock:
+			return [r[0] for r in self.db.execute(sql, args).fetchall()]
+	#
+
+	# Returns the record of run %name as a dictionary, with its files, parameter changes and statistics
+	def run_info(self, name):
+		with self.lock:
+			row = self.db.execute("SELECT id, name, date, run, started, stopped, sample_freq, channels FROM runs WHERE name = ?", (name,)).fetchone()
+			if row == None:
+				raise KeyError("catalog.run_info : no run " + str(name))
+			info = dict(zip(('id', 'name', 'date', 'run', 'started', 'stopped', 'sample_freq', 'channels'), row))
+			info['channels'] = json.loads(info['channels']) if info['channels'] != None else None
+			info['files'] = dict(self.db.execute("SELECT type, path FROM files WHERE run_id = ?", (info['id'],)).fetchall())
+			info['params'] = self.db.execute("SELECT time, name, value FROM params WHERE run_id = ? ORDER BY time", (info['id'],)).fetchall()
+			info['stats'] = self.db.execute("SELECT stream, col, min, max, mean FROM stats WHERE run_id = ?", (info['id'],)).fetchall()
+		return info
+	#
+
+	def close(self):
+		self.db.close()
+	#
+# end run_catalog
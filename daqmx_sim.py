@@ -0,0 +1,386 @@
+#
+# daqmx_sim.py
+#
+# A simulated NI-DAQmx driver, so that the acquisition code in nidaq.py can be run and benchmarked on
+# computers without a DAQ card, including Linux. Selected by setting the global parameter DAQ_backend
+# to "simulated" before nidaq.py is imported
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import ctypes
+import threading
+import time
+import numpy as np
+
+from parameters import *
+
+# Error codes returned by the simulated driver and their messages
+sim_errors = {
+	-200279 : "Attempted to read samples that are no longer available. The application is not able to keep up with the hardware acquisition.",
+	-200284 : "Some or all of the samples requested have not yet been acquired.",
+	-200088 : "Task specified is invalid or does not exist.",
+	-200290 : "The generation has stopped to prevent the regeneration of old samples.",
+	-200000 : "Simulated error injected for testing."
+}
+
+# Returns the value of an argument that may be a ctypes object or a plain python value
+def arg_value(x):
+	if hasattr(x, 'value'):
+		return x.value
+	return x
+# end arg_value
+
+# Returns the object pointed to by an argument passed with ctypes.byref()
+def arg_ref(p):
+	return p._obj
+# end arg_ref
+
+# Expands channels in NI channel syntax, for example "Dev1/ai0:2, Dev1/ai16" to a list of names
+def expand_channels(physical_chan):
+	names = []
+	for part in str(arg_value(physical_chan)).split(','):
+		part = part.strip()
+		if part == "":
+			continue
+		dev, chan = part.split('/')
+		prefix = chan.rstrip('0123456789:')
+		span = chan[len(prefix):].split(':')
+		first = int(span[0])
+		last = int(span[-1])
+		step = 1 if last >= first else -1
+		for i in range(first, last+step, step):
+			names.append(dev + '/' + prefix + str(i))
+	return names
+# end expand_channels
+
+# The default synthetic signal, channel k of a device is a sine wave of k+1 Hz and 1 V amplitude
+# with 1 mV of noise, %index is the index of the channel on its device and %t an array of times
+def default_signal(index, t):
+	return np.sin(2.0*np.pi*(index + 1)*t) + 1e-3*np.random.standard_normal(t.shape[0])
+# end default_signal
+
+# The state of one simulated task
+class sim_task():
+	def __init__(self):
+		self.channels = []
+		self.ranges = []
+		self.output = False
+		self.rate = 1000.0
+		self.continuous = True
+		self.samples = 1000
+		self.buffer = None
+		self.trigger_device = None
+		self.running = False
+		self.t0 = None
+		self.read_count = 0
+		self.written = 0
+		self.values = []
+		self.regenerate = True
+	#
+
+	# Returns the number of samples per channel the hardware has clocked since the task started
+	def clocked(self, sim):
+		if not self.running:
+			return 0
+		if self.t0 == None: # Waiting for the start trigger of another device
+			master = sim.running_task(self.trigger_device)
+			if master == None:
+				return 0
+			self.t0 = master.t0
+		n = int((time.time() - self.t0)*self.rate)
+		if not self.continuous:
+			n = min(n, self.samples)
+		return n
+	#
+
+	# Returns the size of the buffer in samples per channel
+	def buffer_size(self):
+		if self.buffer != None:
+			return self.buffer
+		return max(self.samples, 10000)
+	#
+# end sim_task
+
+# The simulated driver, has methods with the names and arguments of the NI-DAQmx C functions used in
+# nidaq.py, all of them return a DAQmx error code which is checked with nidaq.CHK
+#
+# %signals maps physical channel names such as "Dev1/ai3" to functions f(t) returning the voltage at
+# an array of times t, channels without an entry get default_signal
+#
+# Use inject_error() to make a later call fail, for example inject_error(-200279, 'DAQmxReadAnalogF64')
+# simulates a buffer overflow on the next read. Reading too slowly overflows the buffer by itself
+class simulated_daqmx():
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.tasks = {}
+		self.next_handle = 1
+		self.signals = {}
+		self.injected = []
+		self.call_latency = 0.0 # Seconds each call takes, to emulate driver overhead
+		self.poll_interval = 0.001
+	#
+
+	# Makes the %count'th next call of the function %name (or of any function if None) return %code
+	def inject_error(self, code, name=None, count=1):
+		with self.lock:
+			self.injected.append([code, name, count])
+	#
+
+	# Returns an injected error code for a call to %name, or 0
+	def check_injected(self, name):
+		if self.call_latency > 0:
+			time.sleep(self.call_latency)
+		with self.lock:
+			for e in self.injected:
+				if e[1] == None or e[1] == name:
+					e[2] -= 1
+					if e[2] <= 0:
+						self.injected.remove(e)
+						return e[0]
+		return 0
+	#
+
+	# Returns the running, triggering task on the given device, or None
+	def running_task(self, device):
+		for task in self.tasks.values():
+			if task.running and task.t0 != None and len(task.channels) > 0 and task.channels[0].split('/')[0] == device:
+				return task
+		return None
+	#
+
+	# Returns (task, 0) for a task handle, or (None, error code) if it does not exist
+	def get_task(self, handle):
+		task = self.tasks.get(arg_value(handle))
+		if task == None:
+			return None, -200088
+		return task, 0
+	#
+
+	# Returns the voltages of the analog input task for samples %first to %first+%n as a (n, channels) array
+	def generate(self, task, first, n):
+		t = np.arange(first+1, first+n+1, dtype=np.float64)/task.rate
+		data = np.empty((n, len(task.channels)), dtype=np.float64)
+		for i, name in enumerate(task.channels):
+			f = self.signals.get(name)
+			if f != None:
+				data[:,i] = f(t)
+			else:
+				data[:,i] = default_signal(int(name.split('/')[1].lstrip('ai')), t)
+			np.clip(data[:,i], task.ranges[i][0], task.ranges[i][1], out=data[:,i])
+		return data
+	#
+
+	def DAQmxGetErrorString(self, err, buf, size):
+		arg_ref(buf).value = sim_errors.get(err, "Simulated error %d"%err)[:size-1]
+		return 0
+
+	def DAQmxCreateTask(self, name, handle):
+		e = self.check_injected('DAQmxCreateTask')
+		if e != 0:
+			return e
+		with self.lock:
+			arg_ref(handle).value = self.next_handle
+			self.tasks[self.next_handle] = sim_task()
+			self.next_handle += 1
+		return 0
+
+	def DAQmxCreateAIVoltageChan(self, handle, physical_chan, name, config, vmin, vmax, units, scale):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxCreateAIVoltageChan')
+		if e != 0:
+			return e
+		for c in expand_channels(physical_chan):
+			task.channels.append(c)
+			task.ranges.append((arg_value(vmin), arg_value(vmax)))
+		return 0
+
+	def DAQmxCreateAOVoltageChan(self, handle, physical_chan, name, vmin, vmax, units, scale):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxCreateAOVoltageChan')
+		if e != 0:
+			return e
+		for c in expand_channels(physical_chan):
+			task.channels.append(c)
+			task.ranges.append((arg_value(vmin), arg_value(vmax)))
+			task.values.append(0.0)
+		task.output = True
+		return 0
+
+	def DAQmxCfgSampClkTiming(self, handle, source, rate, edge, mode, samples):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxCfgSampClkTiming')
+		if e != 0:
+			return e
+		task.rate = float(arg_value(rate))
+		task.continuous = (arg_value(mode) == DAQmx_Val_ContSamps)
+		task.samples = int(arg_value(samples))
+		return 0
+
+	def DAQmxCfgDigEdgeStartTrig(self, handle, source, edge):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxCfgDigEdgeStartTrig')
+		if e != 0:
+			return e
+		task.trigger_device = str(arg_value(source)).strip('/').split('/')[0]
+		return 0
+
+	def DAQmxCfgInputBuffer(self, handle, samples):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxCfgInputBuffer')
+		if e != 0:
+			return e
+		task.buffer = int(arg_value(samples))
+		return 0
+
+	def DAQmxSetWriteRegenMode(self, handle, mode):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		task.regenerate = (arg_value(mode) != DAQmx_Val_DoNotAllowRegen)
+		return 0
+
+	def DAQmxStartTask(self, handle):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxStartTask')
+		if e != 0:
+			return e
+		with self.lock:
+			task.running = True
+			task.read_count = 0
+			if task.trigger_device == None:
+				task.t0 = time.time()
+			else:
+				task.t0 = None
+		return 0
+
+	def DAQmxStopTask(self, handle):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		task.running = False
+		return 0
+
+	def DAQmxClearTask(self, handle):
+		with self.lock:
+			task = self.tasks.pop(arg_value(handle), None)
+		if task == None:
+			return -200088
+		task.running = False
+		return 0
+
+	def DAQmxGetTaskChannels(self, handle, buf, size):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		buf.value = ", ".join(task.channels)[:arg_value(size)-1]
+		return 0
+
+	def DAQmxGetAIDevScalingCoeff(self, handle, channel, coeffs, size):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		vmin, vmax = task.ranges[task.channels.index(str(arg_value(channel)))]
+		c = np.frombuffer((ctypes.c_double*arg_value(size)).from_address(coeffs), dtype=np.float64)
+		c[:] = 0.0
+		c[:2] = (0.5*(vmin + vmax), (vmax - vmin)/65536.0)[:c.shape[0]]
+		return 0
+
+	# Waits for samples and copies them into the array at %address, shared by the read functions
+	def read(self, name, handle, samples, timeout, address, size, read, dtype):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected(name)
+		if e != 0:
+			return e
+		nchan = len(task.channels)
+		samples = ctypes.c_int32(arg_value(samples)).value # -1 (as signed) reads all available
+		limit = arg_value(size)//nchan
+		deadline = time.time() + arg_value(timeout)
+		while True:
+			if not task.running:
+				return -200088
+			available = task.clocked(self) - task.read_count
+			if available > task.buffer_size():
+				return -200279
+			if samples < 0 or available >= samples:
+				break
+			if time.time() > deadline:
+				return -200284
+			time.sleep(self.poll_interval)
+		n = min(available if samples < 0 else samples, limit)
+		data = self.generate(task, task.read_count, n)
+		out = np.frombuffer((ctypes.c_char*(n*nchan*np.dtype(dtype).itemsize)).from_address(address), dtype=dtype)
+		if dtype == np.int16:
+			vmin = np.array([r[0] for r in task.ranges])
+			vmax = np.array([r[1] for r in task.ranges])
+			codes = np.rint((data - 0.5*(vmin + vmax))*65536.0/(vmax - vmin))
+			out[:] = np.clip(codes, -32768, 32767).ravel()
+		else:
+			out[:] = data.ravel()
+		task.read_count += n
+		arg_ref(read).value = n
+		return 0
+
+	def DAQmxReadAnalogF64(self, handle, samples, timeout, fill, address, size, read, reserved):
+		return self.read('DAQmxReadAnalogF64', handle, samples, timeout, address, size, read, np.float64)
+
+	def DAQmxReadBinaryI16(self, handle, samples, timeout, fill, address, size, read, reserved):
+		return self.read('DAQmxReadBinaryI16', handle, samples, timeout, address, size, read, np.int16)
+
+	def DAQmxWriteAnalogScalarF64(self, handle, autostart, timeout, value, reserved):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxWriteAnalogScalarF64')
+		if e != 0:
+			return e
+		task.values[0] = arg_value(value)
+		return 0
+
+	def DAQmxWriteAnalogF64(self, handle, samples, autostart, timeout, fill, address, written, reserved):
+		task, e = self.get_task(handle)
+		if e == 0:
+			e = self.check_injected('DAQmxWriteAnalogF64')
+		if e != 0:
+			return e
+		n = arg_value(samples)
+		deadline = time.time() + arg_value(timeout)
+		# Without regeneration a write waits for the card to make room in the buffer
+		while task.running and not task.regenerate and task.written + n - task.clocked(self) > task.buffer_size():
+			if time.time() > deadline:
+				return -200284
+			time.sleep(self.poll_interval)
+		data = np.frombuffer((ctypes.c_double*(n*len(task.channels))).from_address(address), dtype=np.float64)
+		task.values = list(data[-len(task.channels):])
+		task.written += n
+		arg_ref(written).value = n
+		return 0
+
+	def DAQmxGetWriteTotalSampPerChanGenerated(self, handle, generated):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		arg_ref(generated).value = min(task.clocked(self), task.written)
+		return 0
+
+	def DAQmxWaitUntilTaskDone(self, handle, timeout):
+		task, e = self.get_task(handle)
+		if e != 0:
+			return e
+		timeout = arg_value(timeout)
+		deadline = time.time() + timeout
+		while task.clocked(self) < task.samples:
+			if not task.running:
+				return -200088
+			if timeout >= 0 and time.time() > deadline:
+				return -200284
+			time.sleep(self.poll_interval)
+		return 0
+# end simulated_daqmx
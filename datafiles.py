@@ -0,0 +1,1171 @@
+#
+# datafiles.py
+#
+# GaborDAQ modules for writing and reading data files
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import os
+import json
+import time
+import zlib
+import bz2
+import struct
+import threading
+import collections
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from parameters import *
+
+# Write-behind buffering
+# The data files can be opened through a write_behind group, their writes then go into memory and a
+# flusher thread writes them out to the disk, so the thread writing the data never waits on the disk.
+# The flusher writes everything waiting in every file of the group at once, a group commit, when
+# flush_bytes are waiting or the oldest write is flush_age seconds old, then flushes each file and, if
+# flush_fsync, makes the operating system write it to the disk. At most write_behind_bytes can be waiting,
+# a write that would go over waits for the flusher, so the memory used is bounded. The data at risk if
+# the computer fails is at most flush_age seconds or flush_bytes, plus what the operating system holds
+# if flush_fsync is False
+
+# A file of a write_behind group, used in place of the file object, see write_behind.open
+class buffered_file():
+	def __init__(self, group, f):
+		self.group = group
+		self.file = f
+		self.name = f.name
+		self.parts = [] # Data given to write() and not yet taken by the flusher
+		self.failed = False # True once a write failed part way and could not be undone, the file is not written to again
+		self.file.seek(0, 2)
+		self.pos = self.file.tell() # Offset of the end of the data written, as seen by tell()
+	#
+
+	def write(self, data):
+		if len(data) > 0:
+			self.group.add(self, data)
+			self.pos += len(data)
+	#
+
+	def writelines(self, lines):
+		self.write("".join(lines))
+	#
+
+	def tell(self):
+		return self.pos
+	#
+
+	# Writes out what is waiting, then moves to the given position as file.seek does
+	def seek(self, offset, whence=0):
+		self.group.flush()
+		self.file.seek(offset, whence)
+		self.pos = self.file.tell()
+	#
+
+	# Waits until everything written so far, to this file and the rest of the group, is written out
+	def flush(self):
+		self.group.flush()
+	#
+
+	def close(self):
+		self.group.close_file(self)
+	#
+# end buffered_file
+
+# A group of files written out together by a flusher thread, see above
+#
+# %flush_bytes is the number of bytes waiting that starts a flush
+# %flush_age is the age in seconds of the oldest waiting write that starts a flush
+# %max_bytes is the largest number of bytes that can be waiting
+# %fsync is True to make the operating system write each file to the disk on every flush
+class write_behind():
+	def __init__(self, flush_bytes=flush_bytes, flush_age=flush_age, max_bytes=write_behind_bytes, fsync=flush_fsync):
+		self.flush_bytes = flush_bytes
+		self.flush_age = flush_age
+		self.max_bytes = max_bytes
+		self.fsync = fsync
+		self.files = []
+		self.cond = threading.Condition()
+		self.running = True
+		self.bytes_pending = 0 # Bytes given to the group and not yet written out
+		self.oldest = None # Time of the oldest write waiting
+		self.requested = 0 # Number of the last flush asked for by flush()
+		self.completed = 0 # Number of the last flush done
+		self.flushes = 0
+		self.bytes_flushed = 0
+		self.failures = 0 # Flushes that could not write out everything, the data is kept to try again
+		self.retry_at = 0.0 # Time after a failure before which only flush() starts a flush
+		self.bytes_lost = 0 # Bytes that could not be written out before their file was closed
+		self.stalls = 0 # Writes that waited for the flusher
+		self.latency = 0.0 # Time taken by the last flush
+		self.max_latency = 0.0
+		self.total_latency = 0.0
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	#
+
+	# Opens %filename in %mode, as for open(), as a file of the group
+	def open(self, filename, mode='ab'):
+		f = buffered_file(self, open(filename, mode))
+		with self.cond:
+			self.files.append(f)
+		return f
+	#
+
+	# Adds %data to the writes waiting for file %f, waits if too much is waiting
+	def add(self, f, data):
+		with self.cond:
+			if f.failed:
+				self.bytes_lost += len(data)
+				return
+			if self.bytes_pending > 0 and self.bytes_pending + len(data) > self.max_bytes:
+				self.stalls += 1
+				while self.running and self.bytes_pending > 0 and self.bytes_pending + len(data) > self.max_bytes:
+					self.cond.wait(0.1)
+			f.parts.append(data)
+			self.bytes_pending += len(data)
+			if self.oldest == None:
+				self.oldest = time.time()
+			if self.bytes_pending >= self.flush_bytes:
+				self.cond.notify_all()
+	#
+
+	# The flusher thread
+	def run(self):
+		while True:
+			with self.cond:
+				while True:
+					now = time.time()
+					due = self.requested > self.completed
+					if now >= self.retry_at and (self.bytes_pending >= self.flush_bytes or (self.oldest != None and now - self.oldest >= self.flush_age)):
+						due = True
+					if due or not self.running:
+						break
+					self.cond.wait(self.flush_age if self.oldest == None else max(self.oldest + self.flush_age - now, self.retry_at - now, 0.001))
+				if not self.running and self.bytes_pending == 0 and self.requested == self.completed:
+					return
+				number = self.requested
+				batch = [(f, f.parts) for f in self.files if len(f.parts) > 0]
+				for f, parts in batch:
+					f.parts = []
+				self.oldest = None
+			t0 = time.time()
+			written = 0
+			failed = [] # (file, data to write again or None if the file buffer still holds it, error)
+			for f, parts in batch:
+				data = "".join(parts)
+				pos = None
+				try:
+					pos = f.file.tell()
+					f.file.write(data)
+					written += len(data)
+				except Exception as e:
+					if not self.rewind(f, pos):
+						f.failed = True
+					failed.append((f, data, e))
+			for f, parts in batch:
+				try:
+					f.file.flush()
+					if self.fsync:
+						os.fsync(f.file.fileno())
+				except Exception as e:
+					failed.append((f, None, e))
+			dt = time.time() - t0
+			with self.cond:
+				self.bytes_pending -= written
+				for f, data, e in failed:
+					if data != None and f in self.files and not f.failed:
+						f.parts.insert(0, data)
+						self.oldest = t0 if self.oldest == None else min(self.oldest, t0)
+					elif data != None: # Closed while it was being written, or failed
+						self.bytes_pending -= len(data)
+						self.bytes_lost += len(data)
+				if len(failed) > 0:
+					self.failures += 1
+					self.retry_at = time.time() + self.flush_age
+				elif len(batch) > 0:
+					self.flushes += 1
+					self.latency = dt
+					self.max_latency = max(self.max_latency, dt)
+					self.total_latency += dt
+				self.bytes_flushed += written
+				self.completed = max(self.completed, number)
+				self.cond.notify_all()
+			for f, data, e in failed:
+				if f.failed:
+					print "datafiles.write_behind : Could not write out data to " + str(f.name) + ", nothing more is written to it"
+				else:
+					print "datafiles.write_behind : Could not write out data to " + str(f.name) + ", it is kept to try again"
+				print str(e)
+	#
+
+	# Undoes a failed write to file %f, which may have written part of its data, by cutting the file back
+	# to %pos, where the write started. Returns False if that fails, what was written is then unknown
+	def rewind(self, f, pos):
+		if pos == None:
+			return False
+		try:
+			f.file.seek(pos)
+			f.file.truncate()
+			return True
+		except Exception:
+			return False
+	#
+
+	# Writes out everything waiting, in the flusher thread, and waits until it is done
+	def flush(self):
+		with self.cond:
+			self.requested += 1
+			number = self.requested
+			self.cond.notify_all()
+			while self.completed < number and self.thread.is_alive():
+				self.cond.wait(0.1)
+	#
+
+	# Writes out what is waiting for file %f, then closes it, what still can't be written out is lost
+	def close_file(self, f):
+		self.flush()
+		with self.cond:
+			if f in self.files:
+				self.files.remove(f)
+			lost = sum([len(p) for p in f.parts])
+			f.parts = []
+			self.bytes_pending -= lost
+			self.bytes_lost += lost
+			self.cond.notify_all()
+		if lost > 0:
+			print "datafiles.write_behind : " + str(lost) + " bytes could not be written out to " + str(f.name) + " before it was closed"
+		try:
+			f.file.close()
+		except Exception as e:
+			print "datafiles.write_behind : Could not close " + str(f.name)
+			print str(e)
+	#
+
+	# Writes out everything waiting and stops the flusher thread, closing the files of the group
+	def stop(self):
+		for f in list(self.files):
+			self.close_file(f)
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+		self.thread.join()
+	#
+
+	# Returns a one line summary of the statistics
+	def summary(self):
+		mean = self.total_latency/self.flushes if self.flushes > 0 else 0.0
+		return "%d flushes, %d failed, %.1f MB written, %d bytes pending, %d bytes lost, %d stalls, flush latency last %.3f s, mean %.3f s, max %.3f s"%(
+			self.flushes, self.failures, self.bytes_flushed/1048576.0, self.bytes_pending, self.bytes_lost, self.stalls, self.latency, mean, self.max_latency)
+	#
+# end write_behind
+
+# Binary run files
+# A binary run file holds the card data of a run as fixed size records, one per sample, with a named,
+# typed field for the time and for each channel. The file starts with a text header of
+# binary_header_size bytes holding a JSON description of the records, the sample frequency and the
+# scaling coefficients if the channels hold raw codes, followed by the records appended block by block.
+# The records can be loaded with read_binary_run(), or directly with
+# np.memmap(filename, dtype=record_dtype(header), mode='r', offset=binary_header_size)
+binary_header_size = 4096
+binary_magic = "GaborDAQ binary run"
+
+# Returns the numpy record dtype described by a binary run file header
+def record_dtype(header):
+	return np.dtype([(str(name), str(t)) for name, t in header['columns']])
+# end record_dtype
+
+# Reads the header of the binary run file %filename, returns it as a dictionary
+def read_binary_header(filename):
+	f = open(filename, 'rb')
+	header = json.loads(f.read(binary_header_size).rstrip())
+	f.close()
+	if header.get('format') != binary_magic:
+		raise IOError("datafiles.read_binary_header : " + str(filename) + " is not a binary run file")
+	return header
+# end read_binary_header
+
+# Opens the binary run file %filename, returns (header, records) where records is a read only memory
+# mapped record array, so only the parts of the file that are used are read from disk.
+# Columns are accessed by name, e.g. records['time'], channels holding raw codes can be scaled
+# with utilities.scale_raw and the header['scaling'] coefficients
+def read_binary_run(filename):
+	header = read_binary_header(filename)
+	dtype = record_dtype(header)
+	f = open(filename, 'rb')
+	f.seek(0, 2)
+	rows = (f.tell() - binary_header_size) // dtype.itemsize
+	f.close()
+	if rows <= 0:
+		return header, np.zeros(0, dtype=dtype)
+	return header, np.memmap(filename, dtype=dtype, mode='r', offset=binary_header_size, shape=(rows,))
+# end read_binary_run
+
+# Returns the records of dtype %dtype holding a utilities.raw_block, the time and the unscaled codes
+def raw_records(block, dtype):
+	pts = block.codes.shape[0]
+	rec = np.empty(pts, dtype=dtype)
+	rec['time'] = np.arange(block.count+1, block.count+pts+1, dtype=np.float64)/block.freq
+	for i, name in enumerate(dtype.names[1:]):
+		rec[name] = block.codes[:,i]
+	return rec
+# end raw_records
+
+# Writes card data to a binary run file, one write per block
+# The header is written with the first block, when the number of channels is known
+#
+# %filename is the file to create
+# %channel_names is a list of names for the channels, defaults to ai0, ai1, ... if None
+# %sample_freq is the sample frequency of the card
+# %opener opens the file, open or the open method of a write_behind group
+class binary_run_writer():
+	def __init__(self, filename, channel_names=None, sample_freq=masterSampleFreq, opener=open):
+		self.filename = filename
+		self.channel_names = channel_names
+		self.sample_freq = sample_freq
+		self.header = None
+		self.rows = 0
+		self.file = opener(filename, 'wb')
+	#
+
+	# Writes the header describing records of %channels channels of the given type,
+	# %scaling is the coefficients for raw codes or None for volts
+	def write_header(self, channels, channel_type, scaling):
+		names = self.channel_names
+		if names == None or len(names) != channels:
+			names = ['ai' + str(i) for i in range(channels)]
+		self.header = {
+			'format' : binary_magic,
+			'version' : 1,
+			'created' : time.strftime("%Y/%m/%d %H:%M:%S"),
+			'sample_freq' : self.sample_freq,
+			'columns' : [['time', '<f8']] + [[n, channel_type] for n in names],
+			'scaling' : None if scaling is None else np.asarray(scaling).tolist()
+		}
+		text = json.dumps(self.header)
+		if len(text) >= binary_header_size:
+			raise IOError("datafiles.binary_run_writer : header too long for " + str(self.filename))
+		self.file.write(text + ' '*(binary_header_size - len(text) - 1) + '\n')
+		self.dtype = record_dtype(self.header)
+	#
+
+	# Appends a (scans, channels+1) block of voltage data, time first
+	def write(self, block):
+		if self.header == None:
+			self.write_header(block.shape[1]-1, '<f8', None)
+		if self.header['scaling'] != None:
+			raise IOError("datafiles.binary_run_writer : " + str(self.filename) + " holds raw data, use write_raw")
+		# Rows of doubles already have the layout of the records
+		self.file.write(np.ascontiguousarray(block, dtype='<f8').tostring())
+		self.rows += block.shape[0]
+	#
+
+	# Appends a block of raw codes, %block is a utilities.raw_block, the codes are stored unscaled
+	def write_raw(self, block):
+		if self.header == None:
+			self.sample_freq = block.freq
+			self.write_header(block.codes.shape[1], '<i2', block.coeffs)
+		if self.header['scaling'] == None:
+			raise IOError("datafiles.binary_run_writer : " + str(self.filename) + " holds voltage data, use write")
+		rec = raw_records(block, self.dtype)
+		self.file.write(rec.tostring())
+		self.rows += rec.shape[0]
+	#
+
+	def flush(self):
+		self.file.flush()
+	#
+
+	def close(self):
+		self.file.close()
+	#
+# end binary_run_writer
+
+# Time index files
+# A time index file sits next to a data file with the same name and the extension index_file_ext, it maps
+# the time of every index_stride-th row of the data file to the byte offset where the row starts, so a
+# window of time can be read by seeking straight to it. The time is that of the first column, the card time
+# for bnc files and the stop watch time for the others, log lines are indexed by the time in brackets.
+# The entries are appended as the data file is written, so the index is usable while a run is recording
+index_dtype_time = np.dtype([('time', '<f8'), ('offset', '<u8'), ('row', '<u8')])
+
+# Returns the name of the time index file of the data file %filename
+def time_index_filename(filename):
+	return os.path.splitext(filename)[0] + '.' + index_file_ext
+# end time_index_filename
+
+# Returns the time at the start of a line of text, or None if it doesn't start with a time
+def line_time(line):
+	field = line.lstrip('[').split('\t', 1)[0].split(']', 1)[0]
+	try:
+		return float(field)
+	except ValueError:
+		return None
+# end line_time
+
+# Appends entries to the time index file %filename, opened with %opener
+class time_index_writer():
+	def __init__(self, filename, opener=open):
+		self.filename = filename
+		self.file = opener(filename, 'ab')
+	#
+
+	# Appends entries for rows starting at byte %offsets, %times and %rows are arrays of the same length
+	def add(self, times, offsets, rows):
+		entries = np.empty(len(times), dtype=index_dtype_time)
+		entries['time'] = times
+		entries['offset'] = offsets
+		entries['row'] = rows
+		self.file.write(entries.tostring())
+	#
+
+	def flush(self):
+		self.file.flush()
+	#
+
+	def close(self):
+		self.file.close()
+	#
+# end time_index_writer
+
+# A text data file that keeps a time index file as it is written, used in place of the file object
+#
+# %filename is the file to open
+# %mode is the mode to open it with, as for open()
+# %stride is the number of rows between index entries
+# %opener opens the file and its index, open or the open method of a write_behind group
+class indexed_text_file():
+	def __init__(self, filename, mode='a+', stride=index_stride, opener=open):
+		self.filename = filename
+		self.name = filename # As for a file object
+		self.file = opener(filename, mode)
+		self.file.seek(0, 2)
+		self.pos = self.file.tell() # Byte offset of the end of the file
+		self.stride = stride
+		self.lines = 0 # Lines started before the end of the file
+		self.line_start = True # True if the file ends with a whole line
+		self.extra = 0 if 'b' in mode else len(os.linesep) - 1 # Bytes added to each newline in text mode
+		self.index = time_index_writer(time_index_filename(filename), opener)
+	#
+
+	# Writes %text, and adds an index entry for every stride-th line that starts in it
+	def write(self, text):
+		self.file.write(text)
+		ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+		starts = ends + 1
+		if self.line_start:
+			starts = np.concatenate(([0], starts))
+		starts = starts[starts < len(text)]
+		first = self.lines + (0 if self.line_start else 1) # Line number of starts[0]
+		k = np.arange(-first % self.stride, starts.shape[0], self.stride)
+		times = []
+		keep = []
+		for j in k:
+			t = line_time(text[starts[j]:starts[j]+64])
+			if t != None:
+				times.append(t)
+				keep.append(j)
+		if len(keep) > 0:
+			keep = np.array(keep)
+			offsets = starts[keep] + self.extra*np.searchsorted(ends, starts[keep])
+			self.index.add(times, self.pos + offsets, first + keep)
+		self.lines += ends.shape[0]
+		if len(text) > 0:
+			self.line_start = text.endswith('\n')
+		self.pos += len(text) + self.extra*ends.shape[0]
+	#
+
+	def writelines(self, lines):
+		self.write("".join(lines))
+	#
+
+	def flush(self):
+		self.file.flush()
+		self.index.flush()
+	#
+
+	def close(self):
+		self.file.close()
+		self.index.close()
+	#
+# end indexed_text_file
+
+# Returns the entries of the time index of the data file %filename
+def read_time_index(filename):
+	name = time_index_filename(filename)
+	if not os.path.isfile(name):
+		raise IOError("datafiles.read_time_index : " + str(filename) + " has no time index")
+	return np.fromfile(name, dtype=index_dtype_time)
+# end read_time_index
+
+# Returns the byte range of the data file %filename holding the times %t0 to %t1, from its time index
+# The range starts at the last indexed row before t0 and ends at the first indexed row at or after t1
+def time_window_offsets(filename, t0, t1):
+	index = read_time_index(filename)
+	i = np.searchsorted(index['time'], t0, side='right') - 1
+	j = np.searchsorted(index['time'], t1, side='left')
+	start = int(index['offset'][i]) if i >= 0 else 0
+	stop = int(index['offset'][j]) if j < index.shape[0] else os.path.getsize(filename)
+	return start, stop
+# end time_window_offsets
+
+# Returns the lines of the text data file %filename with times from %t0 up to but not including %t1
+# Only the part of the file given by its time index is read
+def read_text_window(filename, t0, t1):
+	start, stop = time_window_offsets(filename, t0, t1)
+	f = open(filename, 'rb')
+	f.seek(start)
+	lines = f.read(stop - start).splitlines(True)
+	f.close()
+	out = []
+	for line in lines:
+		t = line_time(line)
+		if t != None and t0 <= t < t1:
+			out.append(line)
+	return out
+# end read_text_window
+
+# Returns the rows of the data file %filename with times from %t0 up to but not including %t1 as an array,
+# for text files one row per line, for binary run files the records
+def read_data_window(filename, t0, t1):
+	if filename.endswith('.' + binary_file_ext):
+		header, records = read_binary_run(filename)
+		t = records['time']
+		return np.array(records[np.searchsorted(t, t0, side='left'):np.searchsorted(t, t1, side='left')])
+	lines = read_text_window(filename, t0, t1)
+	if len(lines) == 0:
+		return np.zeros((0, 0))
+	return np.loadtxt(lines, ndmin=2)
+# end read_data_window
+
+# Text data files
+# The text bnc, tmp and mag files hold one sample per line with tab separated columns, see
+# GaborDAQ_Documentation.txt. format_text_block() formats a whole block of card data in a handful of
+# vectorized steps instead of one str() call per value, each value is written as %.{precision}e
+# It is about 8 to 11 times faster than str() depending on the machine (python benchmark.py), not a
+# reliable 10 times: removing the zero bytes left in the place of the + sign and of the hundreds digit
+# of the exponent takes as long as building the fields. Writing them would change the file format, so
+# they stay, runs that need more speed than this should be written as binary or compressed run files
+
+# Four digit strings '0000' to '9999', each packed in one uint32 so a group of digits is one lookup
+text_digits = np.frombuffer(''.join('%04d'%i for i in range(10000)), dtype=np.uint32)
+with np.errstate(over='ignore'):
+	text_powers = 10.0**np.arange(-330, 331)
+# Leading digits of a value with its sign and the decimal point, '1.2' or '-1.2', for values with
+# p%4 + 1 leading digits, the index is the digits, plus 10**(p%4 + 1) if the value is negative
+text_leads = [np.array([s + t[0] + '.' + t[1:] for s in ('', '-') for t in ['%0*d'%(q+1, i) for i in range(10**(q+1))]],
+	dtype='S%d'%(q+3)) for q in range(4)]
+# Exponents from e-330 to e+330 with the tab after them, indexed by exponent + 330, with two and three
+# digits, a zero byte in the place of the hundreds digit of the exponents under 100
+text_exponents = {2: np.array(['e%+03d\t'%i for i in range(-330, 331)], dtype='S5'),
+	3: np.array(['e' + '+-'[i < 0] + ('%03d'%abs(i) if abs(i) >= 100 else '\x00%02d'%abs(i)) + '\t' for i in range(-330, 331)], dtype='S6')}
+text_chunk_rows = 4096 # Rows formatted at a time, small enough to stay in the CPU cache
+
+# Formats a block with the % operator, used for values the vectorized formatter can't handle
+def format_text_slow(block, precision=text_precision):
+	row = "\t".join(["%%.%de"%precision]*block.shape[1]) + "\n"
+	return (row*block.shape[0]) % tuple(block.ravel().tolist())
+# end format_text_slow
+
+# Formats a (rows, columns) block as tab separated text, one row per line, and returns it as one string
+# Values are written in exponent notation with %precision digits after the decimal point as
+# "%.{precision}e" would write them, except that a value within rounding error of halfway between two
+# last digits may be rounded the other way
+def format_text_block(block, precision=text_precision):
+	block = np.asarray(block, dtype=np.float64)
+	if block.ndim == 1:
+		block = block.reshape(1, -1)
+	parts = []
+	for i in range(0, block.shape[0], text_chunk_rows):
+		parts.append(format_text_chunk(block[i:i+text_chunk_rows], precision))
+	return "".join(parts)
+# end format_text_block
+
+# Formats a chunk of rows for format_text_block(). Builds every field as a fixed width record of the
+# leading digits with the sign and point, groups of four digits and the exponent with the separator,
+# each written with one table lookup, with zero bytes in the place of characters that are not needed,
+# then removes the zero bytes
+def format_text_chunk(x, p):
+	n, c = x.shape
+	a = np.abs(x)
+	if p < 1 or p > 10 or not np.isfinite(a).all(): # Beyond 10 digits the scaled mantissa loses its last digit
+		return format_text_slow(x, p)
+	nz = a > 0
+	# Decimal exponent estimated from the binary one without a log10() call. Bits 52 to 62 of a double
+	# are its exponent biased by 1023 (the sign bit is clear after abs), minus 1022 it is the b of
+	# a = f*2**b with 0.5 <= f < 1. floor(b*log10(2)) is then the decimal exponent or one more, it is
+	# worked out in integers as b*78913 >> 18, 78913/2**18 being within 1e-6 of log10(2).
+	# The estimate is corrected below, zero gets exponent 0 and subnormals, which give about -308,
+	# go to the slow path
+	e = ((a.view(np.int64) >> 52) - 1022)*78913 >> 18
+	e *= nz
+	if n*c == 0 or max(e.max(), -e.min()) > 300 - p:
+		return format_text_slow(x, p)
+	e -= nz & (a < text_powers[e + 330])
+	# Mantissa as an integer of p+1 digits, the estimated exponent can be off by one
+	m = a*text_powers[p - e + 330]
+	np.rint(m, out=m)
+	low = nz & (m < text_powers[p + 330])
+	high = m >= text_powers[p + 331]
+	if low.any() or high.any():
+		e[low] -= 1
+		e[high] += 1
+		fix = low | high
+		m[fix] = np.rint(a[fix]*text_powers[p - e[fix] + 330])
+	q = p%4
+	k = p//4
+	E = 3 if max(e.max(), -e.min()) >= 100 else 2
+	W = p + E + 6
+	field = np.dtype({'names': ['lead'] + ['g%d'%j for j in range(k)] + ['exp'],
+		'formats': ['S%d'%(q+3)] + ['u4']*k + ['S%d'%(E+3)],
+		'offsets': [0] + [q+3+4*j for j in range(k)] + [p+3], 'itemsize': W})
+	buf = bytearray(n*c*W)
+	out = np.frombuffer(buf, dtype=field).reshape(n, c)
+	# Splits the mantissa into groups of four digits from the right, m = hi*10**4 + group. The division
+	# is done in floating point, exact since m < 10**11 < 2**53, each group is one lookup in text_digits
+	# that writes its four characters at once as a uint32, what is left of m are the leading digits
+	hi = np.empty_like(m)
+	for j in range(k-1, -1, -1):
+		np.multiply(m, 1e-4, out=hi)
+		np.floor(hi, out=hi)
+		m -= hi*1e4
+		out['g%d'%j] = text_digits[m.astype(np.intp)]
+		m, hi = hi, m
+	lead = m.astype(np.intp)
+	lead += np.signbit(x)*10**(q+1)
+	out['lead'] = text_leads[q][lead]
+	e += 330
+	out['exp'] = text_exponents[E][e]
+	# The tab after the last field of each row becomes the newline
+	buf[-1::-c*W] = '\n'*n
+	return str(buf.translate(None, '\x00'))
+# end format_text_chunk
+
+# Compressed run files
+# A compressed run file holds a stream as chunks compressed with a stdlib codec, either the records of
+# the card data, with the same fields as a binary run file, or the lines of a text data file.
+# The file starts with a JSON header of binary_header_size bytes like a binary run file, followed by
+# the chunks, each one a chunk_header giving its size, its first row, its number of rows and the times
+# of its first and last rows, then the compressed data. Closing the file appends the chunk index, the
+# same values for every chunk with the offset of each, and a trailer pointing to it, so any time window
+# can be read by decompressing only the chunks that hold it. If the file was not closed the index is
+# rebuilt from the chunk headers.
+#
+# Before compression the records of a chunk can be filtered, each field is stored as the differences
+# between successive values of its bit pattern (delta), with the bytes of the values grouped by their
+# position (shuffle). Slowly changing channels then become long runs of nearly equal bytes.
+compressed_magic = "GaborDAQ compressed run"
+chunk_header = struct.Struct('<4sIQIdd') # 'GDCK', compressed bytes, first row, rows, first time, last time
+index_trailer = struct.Struct('<4sQQ') # 'GDIX', index offset, number of chunks
+index_dtype = np.dtype([('offset', '<u8'), ('bytes', '<u4'), ('first_row', '<u8'), ('rows', '<u4'),
+	('t_first', '<f8'), ('t_last', '<f8')])
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None # Not in the python 2 standard library
+
+# Compresses %data with %codec, 'zlib', 'bz2' or 'lzma', at the given %level
+# The compressor objects release the GIL while they work, so chunks compress in parallel on a thread pool
+def compress_data(data, codec, level):
+	if codec == 'zlib':
+		c = zlib.compressobj(level)
+	elif codec == 'bz2':
+		c = bz2.BZ2Compressor(level)
+	elif codec == 'lzma' and lzma != None:
+		c = lzma.LZMACompressor(preset=level)
+	else:
+		raise ValueError("datafiles.compress_data : codec " + str(codec) + " is not available")
+	return c.compress(data) + c.flush()
+# end compress_data
+
+def decompress_data(data, codec):
+	if codec == 'zlib':
+		return zlib.decompress(data)
+	elif codec == 'bz2':
+		return bz2.decompress(data)
+	elif codec == 'lzma' and lzma != None:
+		return lzma.decompress(data)
+	raise ValueError("datafiles.decompress_data : codec " + str(codec) + " is not available")
+# end decompress_data
+
+# Filters a chunk of records for compression, see above, %filter is 'none', 'shuffle' or 'delta_shuffle'
+def filter_records(rec, filter):
+	if filter == 'none':
+		return rec.tostring()
+	parts = []
+	for name in rec.dtype.names:
+		size = rec.dtype[name].itemsize
+		u = np.ascontiguousarray(rec[name]).view('<u' + str(size))
+		if filter == 'delta_shuffle':
+			d = np.empty_like(u)
+			d[:1] = u[:1]
+			np.subtract(u[1:], u[:-1], out=d[1:]) # Wraps around, so it is exactly reversible
+			u = d
+		parts.append(u.view(np.uint8).reshape(-1, size).T.tostring())
+	return "".join(parts)
+# end filter_records
+
+# Reverses filter_records, returns %rows records of %dtype
+def unfilter_records(data, dtype, rows, filter):
+	if filter == 'none':
+		return np.frombuffer(data, dtype=dtype, count=rows)
+	rec = np.empty(rows, dtype=dtype)
+	pos = 0
+	for name in dtype.names:
+		size = dtype[name].itemsize
+		u = np.frombuffer(data, dtype=np.uint8, count=rows*size, offset=pos).reshape(size, rows).T
+		u = np.ascontiguousarray(u).view('<u' + str(size)).reshape(-1)
+		if filter == 'delta_shuffle':
+			u = np.cumsum(u, dtype=u.dtype)
+		rec[name] = u.view(dtype[name])
+		pos += rows*size
+	return rec
+# end unfilter_records
+
+# Filters and compresses a chunk, run on the compression pool
+def pack_chunk(chunk, codec, level, filter):
+	if isinstance(chunk, str):
+		return compress_data(chunk, codec, level)
+	return compress_data(filter_records(chunk, filter), codec, level)
+# end pack_chunk
+
+# Returns the thread pool shared by all compressed run writers, started on first use
+compression_pool_threads = None
+def compression_pool():
+	global compression_pool_threads
+	if compression_pool_threads == None:
+		compression_pool_threads = ThreadPool(compressed_workers)
+	return compression_pool_threads
+# end compression_pool
+
+# Writes a stream to a compressed run file, the chunks are compressed on a pool of worker threads and
+# written in order as they complete, so writing a block only waits on the compression if more than
+# compressed_workers*4 chunks are waiting
+#
+# %filename is the file to create
+# %kind is 'records' for card data, written with write() and write_raw() like a binary_run_writer,
+# or 'text' for the lines of a text data file, written with write() like a file
+# %channel_names is a list of names for the channels of card data, defaults to ai0, ai1, ... if None
+# %sample_freq is the sample frequency of the card
+# %chunk_rows is the number of records or lines in each chunk
+# %opener opens the file, open or the open method of a write_behind group
+class compressed_run_writer():
+	def __init__(self, filename, kind='records', channel_names=None, sample_freq=masterSampleFreq,
+				 codec=compressed_codec, level=compressed_level, filter=compressed_filter, chunk_rows=None, opener=open):
+		if kind not in ('records', 'text'):
+			raise ValueError("datafiles.compressed_run_writer : unknown kind " + str(kind))
+		compress_data("", codec, level) # Fail now if the codec is not available
+		self.filename = filename
+		self.kind = kind
+		self.channel_names = channel_names
+		self.sample_freq = sample_freq
+		self.codec = codec
+		self.level = level
+		self.filter = filter if kind == 'records' else 'none'
+		if chunk_rows == None:
+			chunk_rows = compressed_chunk_rows if kind == 'records' else compressed_text_chunk_lines
+		self.chunk_rows = chunk_rows
+		self.header = None
+		self.rows = 0 # Rows given to the writer
+		self.chunk_first = 0 # First row of the next chunk
+		self.parts = [] # Rows waiting to fill a chunk
+		self.part_rows = 0
+		self.pending = collections.deque() # (result, first row, rows, first time, last time) of chunks being compressed
+		self.index = []
+		self.file = opener(filename, 'wb')
+		if kind == 'text':
+			self.write_header(None)
+	#
+
+	# Writes the header, %columns is the list of [name, type] of the records, None for text
+	def write_header(self, columns, scaling=None):
+		self.header = {
+			'format' : compressed_magic,
+			'version' : 1,
+			'created' : time.strftime("%Y/%m/%d %H:%M:%S"),
+			'kind' : self.kind,
+			'codec' : self.codec,
+			'filter' : self.filter,
+			'chunk_rows' : self.chunk_rows,
+			'sample_freq' : self.sample_freq,
+			'columns' : columns,
+			'scaling' : None if scaling is None else np.asarray(scaling).tolist()
+		}
+		text = json.dumps(self.header)
+		if len(text) >= binary_header_size:
+			raise IOError("datafiles.compressed_run_writer : header too long for " + str(self.filename))
+		self.file.write(text + ' '*(binary_header_size - len(text) - 1) + '\n')
+		if columns != None:
+			self.dtype = record_dtype(self.header)
+	#
+
+	# Appends a block, a (scans, channels+1) array of voltage data with the time first for card data,
+	# or a string of whole lines for text
+	def write(self, block):
+		if self.kind == 'text':
+			self.add(block, block.count('\n'))
+			return
+		if self.header == None:
+			names = self.channel_names
+			if names == None or len(names) != block.shape[1]-1:
+				names = ['ai' + str(i) for i in range(block.shape[1]-1)]
+			self.write_header([['time', '<f8']] + [[n, '<f8'] for n in names])
+		if self.header['scaling'] != None:
+			raise IOError("datafiles.compressed_run_writer : " + str(self.filename) + " holds raw data, use write_raw")
+		rec = np.ascontiguousarray(block, dtype='<f8').view(self.dtype).reshape(-1)
+		self.add(rec.copy(), rec.shape[0])
+	#
+
+	# Appends a block of raw codes, %block is a utilities.raw_block, the codes are stored unscaled
+	def write_raw(self, block):
+		if self.header == None:
+			self.sample_freq = block.freq
+			names = self.channel_names
+			if names == None or len(names) != block.codes.shape[1]:
+				names = ['ai' + str(i) for i in range(block.codes.shape[1])]
+			self.write_header([['time', '<f8']] + [[n, '<i2'] for n in names], block.coeffs)
+		rec = raw_records(block, self.dtype)
+		self.add(rec, rec.shape[0])
+	#
+
+	# Adds %rows rows to the chunk being filled, and starts compressing every full chunk
+	def add(self, part, rows):
+		self.parts.append(part)
+		self.part_rows += rows
+		self.rows += rows
+		if self.part_rows >= self.chunk_rows:
+			self.cut(False)
+		self.write_ready(4*compressed_workers)
+	#
+
+	# Starts compressing the rows waiting, in full chunks, or all of them if %partial
+	def cut(self, partial):
+		if self.part_rows == 0:
+			return
+		if self.kind == 'text':
+			lines = "".join(self.parts).splitlines(True)
+			n = len(lines) if partial else len(lines)//self.chunk_rows*self.chunk_rows
+			chunks = ["".join(lines[i:i+self.chunk_rows]) for i in range(0, n, self.chunk_rows)]
+			rest = "".join(lines[n:])
+			self.parts = [rest] if len(rest) > 0 else []
+			self.part_rows = len(lines) - n
+		else:
+			rec = np.concatenate(self.parts)
+			n = rec.shape[0] if partial else rec.shape[0]//self.chunk_rows*self.chunk_rows
+			chunks = [rec[i:i+self.chunk_rows] for i in range(0, n, self.chunk_rows)]
+			self.parts = [rec[n:]] if n < rec.shape[0] else []
+			self.part_rows = rec.shape[0] - n
+		for chunk in chunks:
+			if self.kind == 'text':
+				rows = chunk.count('\n')
+				t = chunk_times(chunk)
+			else:
+				rows = chunk.shape[0]
+				t = (chunk['time'][0], chunk['time'][-1])
+			result = compression_pool().apply_async(pack_chunk, (chunk, self.codec, self.level, self.filter))
+			self.pending.append((result, self.chunk_first, rows, t[0], t[1]))
+			self.chunk_first += rows
+	#
+
+	# Writes out the chunks that are done compressing, in order, waiting for more of them to be
+	# done if there are more than %keep
+	def write_ready(self, keep=None):
+		while len(self.pending) > 0 and (self.pending[0][0].ready() or (keep != None and len(self.pending) > keep)):
+			result, first, rows, t0, t1 = self.pending.popleft()
+			data = result.get()
+			self.index.append((self.file.tell(), len(data), first, rows, t0, t1))
+			self.file.write(chunk_header.pack('GDCK', len(data), first, rows, t0, t1))
+			self.file.write(data)
+	#
+
+	# Compresses and writes out every row given so far, as a short chunk if needed
+	def flush(self):
+		self.cut(True)
+		self.write_ready(0)
+		self.file.flush()
+	#
+
+	# Writes out everything, then the chunk index
+	def close(self):
+		if self.header == None: # No data was written
+			self.write_header([['time', '<f8']])
+		self.flush()
+		offset = self.file.tell()
+		self.file.write(np.array(self.index, dtype=index_dtype).tostring())
+		self.file.write(index_trailer.pack('GDIX', offset, len(self.index)))
+		self.file.close()
+	#
+# end compressed_run_writer
+
+# Returns the times in the first column of the first and last lines of a chunk of text that have one,
+# nan if no line has a number there
+def chunk_times(text):
+	lines = text.splitlines()
+	t = []
+	for order in (lines, reversed(lines)):
+		t.append(np.nan)
+		for line in order:
+			try:
+				t[-1] = float(line.split('\t')[0])
+				break
+			except (ValueError, IndexError):
+				pass
+	return t
+# end chunk_times
+
+# Reads a compressed run file, only the chunks holding the rows or times asked for are read from disk
+# Records are returned as a record array with fields named as in the header, text as a string of lines
+#
+# %filename is the file to open
+class compressed_run_reader():
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		self.header = json.loads(self.file.read(binary_header_size).rstrip())
+		if self.header.get('format') != compressed_magic:
+			raise IOError("datafiles.compressed_run_reader : " + str(filename) + " is not a compressed run file")
+		self.kind = self.header['kind']
+		if self.kind == 'records':
+			self.dtype = record_dtype(self.header)
+		self.index = self.read_index()
+		self.rows = int(self.index['first_row'][-1] + self.index['rows'][-1]) if self.index.shape[0] > 0 else 0
+		# Chunk times for the binary searches of read_time, in order and without the nan of text chunks
+		# without times, t_last[i] is the latest end of chunks 0 to i, t_first[i] the earliest start from i on
+		t_first = self.index['t_first']
+		t_last = self.index['t_last']
+		self.t_first = np.minimum.accumulate(np.where(np.isnan(t_first), np.inf, t_first)[::-1])[::-1]
+		self.t_last = np.maximum.accumulate(np.where(np.isnan(t_last), -np.inf, t_last))
+	#
+
+	# Reads the chunk index from the end of the file, or rebuilds it from the chunk headers
+	def read_index(self):
+		self.file.seek(0, 2)
+		size = self.file.tell()
+		if size >= binary_header_size + index_trailer.size:
+			self.file.seek(size - index_trailer.size)
+			magic, offset, n = index_trailer.unpack(self.file.read(index_trailer.size))
+			if magic == 'GDIX':
+				self.file.seek(offset)
+				return np.frombuffer(self.file.read(n*index_dtype.itemsize), dtype=index_dtype)
+		index = []
+		pos = binary_header_size
+		while pos + chunk_header.size <= size:
+			self.file.seek(pos)
+			magic, n, first, rows, t0, t1 = chunk_header.unpack(self.file.read(chunk_header.size))
+			if magic != 'GDCK' or pos + chunk_header.size + n > size: # End of the chunks or a chunk cut short
+				break
+			index.append((pos, n, first, rows, t0, t1))
+			pos += chunk_header.size + n
+		return np.array(index, dtype=index_dtype)
+	#
+
+	# Returns the contents of chunk %i
+	def chunk(self, i):
+		entry = self.index[i]
+		self.file.seek(int(entry['offset']) + chunk_header.size)
+		data = decompress_data(self.file.read(int(entry['bytes'])), self.header['codec'])
+		if self.kind == 'text':
+			return data
+		return unfilter_records(data, self.dtype, int(entry['rows']), self.header['filter'])
+	#
+
+	# Joins the contents of the chunks %first to %last, inclusive
+	def chunks(self, first, last):
+		parts = [self.chunk(i) for i in range(first, last+1)]
+		if self.kind == 'text':
+			return "".join(parts)
+		if len(parts) == 0:
+			return np.zeros(0, dtype=self.dtype)
+		return np.concatenate(parts)
+	#
+
+	# Returns the rows from %start up to but not including %stop
+	def read_rows(self, start, stop):
+		start = max(start, 0)
+		stop = min(stop, self.rows)
+		if stop <= start:
+			return self.chunks(0, -1)
+		ends = self.index['first_row'] + self.index['rows']
+		first = np.searchsorted(ends, start, side='right')
+		last = np.searchsorted(self.index['first_row'], stop, side='left') - 1
+		data = self.chunks(first, last)
+		skip = start - int(self.index['first_row'][first])
+		if self.kind == 'text':
+			return "".join(data.splitlines(True)[skip:skip+stop-start])
+		return data[skip:skip+stop-start]
+	#
+
+	# Returns the rows with times from %t0 up to but not including %t1
+	def read_time(self, t0, t1):
+		first = np.searchsorted(self.t_last, t0, side='left')
+		last = np.searchsorted(self.t_first, t1, side='left') - 1
+		data = self.chunks(first, last)
+		if self.kind == 'text':
+			lines = [l for l in data.splitlines(True) if t0 <= chunk_times(l)[0] < t1]
+			return "".join(lines)
+		t = data['time']
+		return data[(t >= t0) & (t < t1)]
+	#
+
+	def close(self):
+		self.file.close()
+	#
+# end compressed_run_reader
+
+# Event logs
+# The event log sits next to the text log of a run with the extension event_file_ext, one JSON object per
+# line in the order of their times:
+#	{"t": time, "snapshot": {parameter: value}}   - the first line, the values in parameters.py
+#	{"t": time, "name": parameter, "value": value} - a parameter change, the value keeps its type
+#	{"t": time, "message": text}                  - any other line of the text log
+#	{"t": time, "state": {parameter: value}}      - the last value of every parameter changed so far,
+#	                                                written every event_state_lines changes
+# Since the times are in order the line at any time is found with a binary search on the file, and the
+# value of a parameter at that time is on one of the few lines before it, see event_log_reader
+
+# Returns the file name of the event log of the text log %filename
+def event_log_filename(filename):
+	return os.path.splitext(filename)[0] + '.' + event_file_ext
+# end event_log_filename
+
+# Writes the event log %filename, opened with %opener
+# %t is the time of the snapshot of the parameters %snapshot, a dictionary
+# %state is the values of the parameters changed before %t, a dictionary, written as the first state line
+# and the start of the later ones
+class event_log_writer():
+	def __init__(self, filename, t, snapshot, opener=open, state=None):
+		self.filename = filename
+		self.file = opener(filename, 'ab')
+		self.state = {}
+		self.changes = 0
+		self.write({'t' : t, 'snapshot' : snapshot})
+		if state:
+			self.state = dict(state)
+			self.write({'t' : t, 'state' : self.state})
+	#
+
+	# Writes the event %event, a dictionary with the time 't' and a 'name' and 'value' or a 'message'
+	def write(self, event):
+		self.file.write(json.dumps(event, default=str, separators=(',', ':')) + '\n')
+		if 'name' in event:
+			self.state[event['name']] = event['value']
+			self.changes += 1
+			if self.changes % event_state_lines == 0:
+				self.file.write(json.dumps({'t' : event['t'], 'state' : self.state}, default=str, separators=(',', ':')) + '\n')
+	#
+
+	def flush(self):
+		self.file.flush()
+	#
+
+	def close(self):
+		self.file.close()
+	#
+# end event_log_writer
+
+# Reads the event log %filename, see above
+class event_log_reader():
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		self.size = os.path.getsize(filename)
+		self.snapshot = json.loads(self.file.readline())['snapshot']
+	#
+
+	# Returns the byte offset of the first line after %t, or at or after %t if not %strict
+	def offset_after(self, t, strict=True):
+		lo = 0
+		hi = self.size
+		while lo < hi:
+			mid = (lo + hi)//2
+			line = self.line_from(mid)
+			if line == '' or json.loads(line)['t'] > t or (not strict and json.loads(line)['t'] == t):
+				hi = mid
+			else:
+				lo = mid + 1
+		if lo == 0:
+			return 0
+		self.file.seek(lo - 1)
+		self.file.readline()
+		return self.file.tell()
+	#
+
+	# Returns the first line starting at or after byte %pos
+	def line_from(self, pos):
+		if pos > 0:
+			self.file.seek(pos - 1)
+			self.file.readline()
+		else:
+			self.file.seek(0)
+		return self.file.readline()
+	#
+
+	# Returns the parameter changes and messages from %t0 up to but not including %t1 as a list of dictionaries
+	def events(self, t0, t1):
+		self.file.seek(self.offset_after(t0, False))
+		out = []
+		for line in self.file:
+			e = json.loads(line)
+			if e['t'] >= t1:
+				break
+			if 'snapshot' not in e and 'state' not in e:
+				out.append(e)
+		return out
+	#
+
+	# Returns the value of the parameter %name at time %t, the value in parameters.py if it was not changed
+	# Reads back from the line at %t to the last change of the parameter or the last state line
+	def value(self, name, t):
+		end = self.offset_after(t)
+		while end > 0:
+			pos = max(end - 65536, 0)
+			self.file.seek(pos)
+			block = self.file.read(end - pos)
+			if pos > 0:
+				cut = block.find('\n') + 1 # Drop the partial first line
+				if cut == 0: # A line longer than the block, read from the start
+					pos = 0
+					self.file.seek(0)
+					block = self.file.read(end)
+				else:
+					block = block[cut:]
+					pos += cut
+			for line in reversed(block.splitlines()):
+				e = json.loads(line)
+				if e.get('name') == name:
+					return e['value']
+				if 'state' in e and name in e['state']:
+					return e['state'][name]
+				if 'state' in e or 'snapshot' in e:
+					return self.snapshot_value(name)
+			end = pos
+		return self.snapshot_value(name)
+	#
+
+	# Returns the value of the parameter %name in parameters.py, raises KeyError if there is none
+	def snapshot_value(self, name):
+		if name not in self.snapshot:
+			raise KeyError("datafiles.event_log_reader : no parameter " + str(name))
+		return self.snapshot[name]
+	#
+
+	# Returns the values of the parameter %name from %t0 to %t1 as a list of (time, value), starting
+	# with its value at t0
+	def values(self, name, t0, t1):
+		out = [(t0, self.value(name, t0))]
+		for e in self.events(t0, t1):
+			if e.get('name') == name and e['t'] > t0:
+				out.append((e['t'], e['value']))
+		return out
+	#
+
+	def close(self):
+		self.file.close()
+	#
+# end event_log_reader
@@ -15,8 +15,15 @@ import Queue
 import threading
 import numpy as np
 from parameters import *
+from utilities import *
+from processing import run_stages
 
-nidaq = ctypes.windll.nicaiu # load the DLL
+# load the DLL, or the simulated driver if selected in the parameters
+if DAQ_backend == "simulated":
+	from daqmx_sim import simulated_daqmx
+	nidaq = simulated_daqmx()
+else:
+	nidaq = ctypes.windll.nicaiu
 
 # NIDAQ drivers Error Checker
 def CHK(err):
@@ -32,6 +39,21 @@ def CHK(err):
       raise RuntimeError('nidaq generated warning %d: %s'%(err, repr(buf.value)))
 #
 
+# Timestamps the first %pts scans of %data, a (scans, channels) array read from the card, in one vectorized step
+# %count is the number of samples acquired before this block and %freq is the sample frequency
+# %offsets is a preallocated float array containing 1, 2, 3, ... at least %pts long
+# Returns a (pts, channels+1) array with the time in the first column, written into %out if given
+def timestamp_block(data, pts, count, freq, offsets, out=None):
+	if out is None:
+		d = np.empty((pts, data.shape[1]+1), dtype=np.float64)
+	else:
+		d = out[:pts]
+	np.add(offsets[:pts], count, out=d[:,0])
+	d[:,0] /= freq
+	d[:,1:] = data[:pts]
+	return d
+# end timestamp_block
+
 # analogVoltageTimeChannel creates a channel to read voltages from a NI DAQ card
 # %channels is the number of channels to be read, should match number requested with %physical_chan
 #
@@ -44,9 +66,23 @@ def CHK(err):
 # multiple queues facilitates sending data into multiple places, for example a data
 # writing queue, a data analysis queue and a display queue
 # The function get_queues returns a list containing all the queues
+#
+# %sample_freq is the sample frequency per channel, defaults to the global parameter masterSampleFreq
+#
+# %ring_seconds if greater than zero the data is also written into a preallocated ring buffer holding
+# that many seconds of data, which any number of consumers can read through get_ring_reader() without
+# copying. Pass num_queues = 0 to use only the ring buffer
+#
+# %block_size if greater than zero the card is read in fixed blocks of that many samples per channel by
+# this thread, which blocks on the driver until each block is complete, rather than polled every
+# poll_delay seconds by a chain of Timers. The timing of the blocks is kept in block_timing
+#
+# %raw if True the card is read as unscaled 16 bit codes, which are put on the queues as raw_block
+# objects holding the scaling coefficients of the run, call volts() on a block to scale it.
+# The ring buffer is not available in raw mode
 class analog_voltage_time_input(threading.Thread):
 	# Constructor
-	def __init__(self, channels, physical_chan, num_queues):
+	def __init__(self, channels, physical_chan, num_queues, sample_freq=masterSampleFreq, ring_seconds=0, block_size=0, raw=False):
 		self.running = True
 		self.numChannels = channels
 		self.poll_delay = 0.05
@@ -56,19 +92,44 @@ class analog_voltage_time_input(threading.Thread):
 		self.timeout = float64(10.0)
 		self.bufferSize = uInt32(10)                   
 		self.pointsRead = uInt32()
-		self.sampleRate = float64(masterSampleFreq)
+		self.sample_freq = float(sample_freq)
+		self.sampleRate = float64(self.sample_freq)
 		self.samplesPerChan = uInt64(2000)
 		self.chan = ctypes.create_string_buffer(physical_chan)
+		self.device = physical_chan.split('/')[0].strip()
 		self.clockSource = ctypes.create_string_buffer('OnboardClock')
-		self.data = np.zeros((1000,),dtype=np.float64)
-		self.points = int(masterSampleFreq / 2.0)
+		self.armed = False
+		self.block_size = int(block_size)
+		self.points = max(int(self.sample_freq / 2.0), self.block_size)
+		
+		self.raw = raw
+		self.scaling = None
+		
+		# Read buffer and sample offsets are allocated once and reused by every poll
+		if self.raw:
+			self.data = np.zeros((self.points,self.numChannels),dtype=np.int16)
+		else:
+			self.data = np.zeros((self.points,self.numChannels),dtype=np.float64)
+		self.sample_offsets = np.arange(1, self.points+1, dtype=np.float64)
 		self.polling = True
-		self.currentTime = time.clock()
+		self.poll_job = None
+		self.clock = card_clock(self.sample_freq)
+		if self.block_size > 0:
+			self.block_timing = interval_stats(self.block_size/self.sample_freq)
+		else:
+			self.block_timing = interval_stats(self.poll_delay)
 		
 		self.dataQueue =[]
 		for i in range(num_queues):
 			self.dataQueue.append(Queue.Queue(maxsize=200000))
 		
+		self.stages = []
+		self.ring = None
+		if ring_seconds > 0:
+			if self.raw:
+				raise RuntimeError('analog_voltage_time_input : the ring buffer is not available in raw mode')
+			self.ring = ring_buffer(int(ring_seconds*self.sample_freq) + self.points, self.numChannels+1, self.points)
+		
 		self.dataCount = 0
 		CHK(nidaq.DAQmxCreateTask("",ctypes.byref(self.taskHandle)))
 					
@@ -83,10 +144,34 @@ class analog_voltage_time_input(threading.Thread):
 		threading.Thread.__init__(self)
 	#
 		
-	# Starts the thread
+	# Starts the thread, with block_size 0 the card is polled every poll_delay on the scheduler instead
 	def run(self):
-		CHK(nidaq.DAQmxStartTask (self.taskHandle))
-		self.poll()
+		self.arm()
+		if self.block_size > 0:
+			self.read_blocks()
+		else:
+			self.poll_job = get_scheduler().add(self.poll, self.poll_delay, "card " + self.device)
+	#
+	
+	# Starts the task on the card without starting to read it, run() arms the card if this hasn't been called
+	def arm(self):
+		if not self.armed:
+			if self.raw:
+				self.scaling = self.get_scaling()
+			CHK(nidaq.DAQmxStartTask (self.taskHandle))
+			self.armed = True
+	#
+	
+	# Runs this input off the sample clock and start trigger of the analog_voltage_time_input %card on
+	# another device, which must be connected to it by a RTSI cable or a PXI chassis. Call before starting
+	# either of them and arm this input first, it then waits for %card to start
+	def sync_to(self, card):
+		if card.sample_freq != self.sample_freq:
+			raise RuntimeError('analog_voltage_time_input.sync_to : sample frequencies of the two inputs differ')
+		self.clockSource = ctypes.create_string_buffer('/' + card.device + '/ai/SampleClock')
+		CHK(nidaq.DAQmxCfgSampClkTiming(self.taskHandle, self.clockSource, self.sampleRate,
+							DAQmx_Val_Rising, DAQmx_Val_ContSamps, self.samplesPerChan))
+		CHK(nidaq.DAQmxCfgDigEdgeStartTrig(self.taskHandle, '/' + card.device + '/ai/StartTrigger', DAQmx_Val_Rising))
 	#
 	
 	# Returns a list containing all the Queues that the data is being written into
@@ -94,46 +179,243 @@ class analog_voltage_time_input(threading.Thread):
 		return self.dataQueue
 	# end get_queues
 	
-	# Re-zeros the time and also zeros the time of the given stopwatch object
+	# Adds a processing stage (see processing.py) to the output of the card, for example a decimator
+	# for a display. Returns a Queue which receives the output of the stage for every block
+	def add_stage(self, stage):
+		q = Queue.Queue(maxsize=200000)
+		self.stages.append((stage, q))
+		return q
+	# end add_stage
+	
+	# Returns a new reader of the ring buffer, starting from the most recent data
+	def get_ring_reader(self):
+		if self.ring == None:
+			raise RuntimeError('analog_voltage_time_input.get_ring_reader : no ring buffer, set ring_seconds')
+		return self.ring.reader()
+	# end get_ring_reader
+	
+	# Returns the names of the physical channels in the task in the order of the data columns,
+	# for example ['Dev1/ai0', 'Dev1/ai1']
+	def get_channel_names(self):
+		names = ctypes.create_string_buffer(4096)
+		CHK(nidaq.DAQmxGetTaskChannels(self.taskHandle, names, uInt32(4096)))
+		return [name.strip() for name in names.value.split(',')]
+	# end get_channel_names
+	
+	# Returns a (channels, 4) array of the polynomial coefficients the card uses to scale raw codes
+	# to volts for each channel in the task, see utilities.scale_raw
+	def get_scaling(self):
+		coeffs = np.zeros((self.numChannels, 4), dtype=np.float64)
+		for i, name in enumerate(self.get_channel_names()):
+			CHK(nidaq.DAQmxGetAIDevScalingCoeff(self.taskHandle, name, coeffs[i].ctypes.data, uInt32(4)))
+		return coeffs
+	# end get_scaling
+	
+	# Re-zeros the time and also zeros the time of the given stopwatch object, which from then on
+	# gives the card time from the fit of the card clock, see utilities.card_clock
 	def sync_zero(self, stop_watch):
 		self.dataCount = 0
+		self.clock.reset()
 		stop_watch.zero()
+		stop_watch.set_clock(self.clock)
 	#
 		
 	# polls the DAQ card for voltage measurements
 	def poll(self):
 		if self.polling:
-			pointsToRead = uInt32(-1)
-			data = np.zeros((self.points,self.numChannels),dtype=np.float64)
-			CHK(nidaq.DAQmxReadAnalogF64(self.taskHandle,pointsToRead,self.timeout,
-					DAQmx_Val_GroupByScanNumber,data.ctypes.data,
-					uInt32(data.size),ctypes.byref(pointsRead),None))
-			#
-			pts = int(pointsRead.value)
-			d = np.zeros((pts,self.numChannels+1),dtype=np.float64)
-			cnt = 0
-			for j in range(0,pts):
-				self.dataCount += 1
-				d[cnt][0] = self.dataCount/masterSampleFreq
-				d[cnt][1:] = data[j][:]
-				cnt +=1
-			#
+			self.publish(self.read(uInt32(-1)))
+	#
+	
+	# Reads the card in blocks of exactly block_size samples per channel until stopped
+	def read_blocks(self):
+		while self.polling:
+			try:
+				pts = self.read(int32(self.block_size))
+			except RuntimeError:
+				if not self.polling: # The task was stopped during the read
+					return
+				raise
+			self.publish(pts)
+	#
+	
+	# Reads %samples samples per channel from the card into the read buffer, -1 for all available
+	# Returns the number of samples per channel read
+	def read(self, samples):
+		if self.raw:
+			CHK(nidaq.DAQmxReadBinaryI16(self.taskHandle,samples,self.timeout,
+					DAQmx_Val_GroupByScanNumber,self.data.ctypes.data,
+					uInt32(self.data.size),ctypes.byref(self.pointsRead),None))
+		else:
+			CHK(nidaq.DAQmxReadAnalogF64(self.taskHandle,samples,self.timeout,
+					DAQmx_Val_GroupByScanNumber,self.data.ctypes.data,
+					uInt32(self.data.size),ctypes.byref(self.pointsRead),None))
+		return int(self.pointsRead.value)
+	#
+	
+	# Timestamps the first %pts scans in the read buffer and hands them to the ring buffer and queues
+	def publish(self, pts):
+		self.block_timing.tick()
+		self.clock.observe(self.dataCount + pts)
+		if self.ring != None:
+			n = 0
+			while n < pts:
+				v = self.ring.write_view(pts - n)
+				timestamp_block(self.data[n:], v.shape[0], self.dataCount + n, self.sample_freq, self.sample_offsets, out=v)
+				self.ring.commit(v.shape[0])
+				n += v.shape[0]
+		if self.raw:
+			d = raw_block(self.dataCount, self.data[:pts].copy(), self.scaling, self.sample_freq)
 			for q in self.dataQueue:
 				q.put(d)
-			#
-			threading.Timer(self.poll_delay, self.poll).start()
+			if len(self.stages) > 0:
+				run_stages(self.stages, d.volts())
+		elif len(self.dataQueue) > 0 or len(self.stages) > 0:
+			d = timestamp_block(self.data, pts, self.dataCount, self.sample_freq, self.sample_offsets)
+			for q in self.dataQueue:
+				q.put(d)
+			run_stages(self.stages, d)
+		self.dataCount += pts
 	#
 	
 	# Closes the analog voltage channel
 	def stop(self):
 		self.running = False
 		self.polling = False
+		if self.poll_job != None:
+			self.poll_job.cancel()
+		if self.block_size > 0 and self.is_alive() and threading.current_thread() != self:
+			self.join(2.0*self.block_size/self.sample_freq + 1.0)
 		if self.taskHandle.value != 0:
 			nidaq.DAQmxStopTask(self.taskHandle)
 			nidaq.DAQmxClearTask(self.taskHandle)
 	#
 # end analog_voltage_time_input
 
+# Acquires from several DAQ cards as one synchronized input. The first card is the master, the others
+# run off its sample clock and start trigger so they never drift apart, which requires the cards to
+# be connected by a RTSI cable or to share a PXI chassis. Each card is read by its own thread in fixed
+# blocks, the blocks are then merged into one stream with a single time base.
+#
+# %devices is a list of (channels, physical_chan) pairs, one for each card with the master first,
+# see analog_voltage_time_input, for example [(8, "Dev1/ai0:7"), (8, "Dev2/ai0:7")]
+#
+# %num_queues is the number of Queues that the merged data is written into, see get_queues().
+# Merged blocks have the time in the first column followed by the channels of each card in order
+#
+# %block_size is the number of samples per channel in each block, defaults to 50 ms of data
+class multi_device_input(threading.Thread):
+	# Constructor
+	def __init__(self, devices, num_queues, sample_freq=masterSampleFreq, block_size=0):
+		self.running = True
+		self.polling = True
+		self.sample_freq = float(sample_freq)
+		if block_size <= 0:
+			block_size = max(int(self.sample_freq*0.05), 1)
+		self.block_size = int(block_size)
+		self.sample_offsets = np.arange(1, self.block_size+1, dtype=np.float64)
+		self.dataCount = 0
+		
+		self.cards = []
+		for channels, physical_chan in devices:
+			self.cards.append(analog_voltage_time_input(channels, physical_chan, 1, sample_freq=self.sample_freq, block_size=self.block_size))
+		for card in self.cards[1:]:
+			card.sync_to(self.cards[0])
+		self.numChannels = sum(card.numChannels for card in self.cards)
+		
+		self.dataQueue =[]
+		for i in range(num_queues):
+			self.dataQueue.append(Queue.Queue(maxsize=200000))
+		self.stages = []
+		
+		threading.Thread.__init__(self)
+	#
+	
+	# Starts the cards, the master last so that the others are waiting for its start trigger, then merges
+	# their blocks until stopped
+	def run(self):
+		for card in self.cards[1:]:
+			card.arm()
+		self.cards[0].arm()
+		for card in self.cards:
+			card.start()
+		self.merge()
+	#
+	
+	# Returns a list containing all the Queues that the merged data is being written into
+	def get_queues(self):
+		return self.dataQueue
+	# end get_queues
+	
+	# Returns the names of the physical channels of every card in the order of the merged data columns
+	def get_channel_names(self):
+		return [name for card in self.cards for name in card.get_channel_names()]
+	# end get_channel_names
+	
+	# Adds a processing stage (see processing.py) to the merged output, returns a Queue which receives
+	# the output of the stage for every block
+	def add_stage(self, stage):
+		q = Queue.Queue(maxsize=200000)
+		self.stages.append((stage, q))
+		return q
+	# end add_stage
+	
+	# Re-zeros the time and also zeros the time of the given stopwatch object, which from then on
+	# gives the card time from the fit of the master card clock
+	def sync_zero(self, stop_watch):
+		self.dataCount = 0
+		self.cards[0].sync_zero(stop_watch)
+	#
+	
+	# Takes one block from each card and merges them, the time column comes from the common sample count
+	# Stops all of the cards with an error if a card thread has died or a block is not block_size scans
+	# of the card's channels, as the cards would no longer line up
+	def merge(self):
+		queues = [card.get_queues()[0] for card in self.cards]
+		while self.polling:
+			blocks = []
+			for card, q in zip(self.cards, queues):
+				while self.polling:
+					try:
+						blocks.append(q.get(timeout=0.5))
+						break
+					except Queue.Empty:
+						if not card.is_alive():
+							self.fail("multi_device_input.merge : the thread of card " + card.device + " has stopped")
+				if self.polling and blocks[-1].shape != (self.block_size, card.numChannels+1):
+					self.fail("multi_device_input.merge : card " + card.device + " gave a block of shape " + str(blocks[-1].shape) +
+						", expected " + str((self.block_size, card.numChannels+1)))
+			if not self.polling:
+				return
+			d = np.empty((self.block_size, self.numChannels+1), dtype=np.float64)
+			np.add(self.sample_offsets, self.dataCount, out=d[:,0])
+			d[:,0] /= self.sample_freq
+			col = 1
+			for b in blocks:
+				d[:,col:col+b.shape[1]-1] = b[:,1:]
+				col += b.shape[1]-1
+			self.dataCount += self.block_size
+			for q in self.dataQueue:
+				q.put(d)
+			run_stages(self.stages, d)
+	#
+	
+	# Stops all of the cards, the master first so the others stop on the same sample
+	def stop(self):
+		self.running = False
+		self.polling = False
+		for card in self.cards:
+			card.stop()
+		if self.is_alive() and threading.current_thread() != self:
+			self.join(1.0)
+	#
+	
+	# Stops all of the cards and raises a RuntimeError with %message
+	def fail(self, message):
+		self.stop()
+		raise RuntimeError(message)
+	#
+# end multi_device_input
+
 # This class sets the voltage of an analog output on an NI DAQ board
 # Default voltage is zero
 # constructor parameter is the output channel, for example 5 for channel 'ao5'
@@ -164,4 +446,150 @@ class analog_output(threading.Thread):
 		CHK(nidaq.DAQmxWriteAnalogScalarF64(self.taskHandle,1,float64(-1),float64(0),None))
 		nidaq.DAQmxStopTask(self.taskHandle)
 		nidaq.DAQmxClearTask(self.taskHandle)
-# end analog_output
\ No newline at end of file
+# end analog_output
+# This class generates hardware timed waveforms on one or more analog outputs of an NI DAQ board,
+# each output point is written by the card on a sample clock edge rather than by a call from python
+#
+# %channels is a list of the output channels, for example [0, 1] for 'ao0' and 'ao1'
+# %sample_freq is the output sample frequency, ignored if synchronized with an input with sync_to()
+#
+# Give the waveform as a (samples, channels) array to write_waveform(), or as a generator of such arrays
+# to stream_waveform() for sweeps too long to hold in memory, then call start(). The outputs hold the
+# last point of the waveform when it is done. The analog_output objects on the same channels reserve
+# them and must be stopped first
+class analog_waveform_output(threading.Thread):
+	# Constructor
+	def __init__(self, channels, sample_freq=masterSampleFreq, device="Dev1"):
+		self.running = True
+		self.done = False
+		self.channels = list(channels)
+		self.numChannels = len(self.channels)
+		self.sample_freq = float(sample_freq)
+		self.taskHandle = TaskHandle(0)
+		self.timeout = float64(10.0)
+		self.clockSource = ctypes.create_string_buffer('OnboardClock')
+		self.startTrigger = None
+		self.buffer_seconds = 1.0
+		self.waveform = None
+		self.generator = None
+		self.samples_written = 0
+		self.pointsWritten = int32()
+		self.chan = ctypes.create_string_buffer(", ".join(device + '/ao' + str(c) for c in self.channels))
+		
+		# Set up the DAQ software
+		CHK(nidaq.DAQmxCreateTask("", ctypes.byref(self.taskHandle)))
+		CHK(nidaq.DAQmxCreateAOVoltageChan(self.taskHandle,
+			self.chan, "", DAQ_AO_Min, DAQ_AO_Max, DAQmx_Val_Volts, None))
+		
+		threading.Thread.__init__(self)
+	#
+	
+	# Runs the output off the sample clock and start trigger of the analog_voltage_time_input %card
+	# so that output point k is generated on the same clock edge as input sample k. Call before starting
+	# either of them and start this output first, it then waits for the card to start
+	def sync_to(self, card):
+		self.sample_freq = card.sample_freq
+		self.clockSource = ctypes.create_string_buffer('/' + card.device + '/ai/SampleClock')
+		self.startTrigger = ctypes.create_string_buffer('/' + card.device + '/ai/StartTrigger')
+	#
+	
+	# Sets a finite waveform to output, %waveform is a (samples, channels) array in volts
+	def write_waveform(self, waveform):
+		self.waveform = np.ascontiguousarray(waveform, dtype=np.float64).reshape(-1, self.numChannels)
+		self.generator = None
+	#
+	
+	# Sets a generator of (samples, channels) arrays in volts to stream to the outputs
+	def stream_waveform(self, generator):
+		self.generator = generator
+		self.waveform = None
+	#
+	
+	# Generates the waveform
+	def run(self):
+		try:
+			if self.waveform is not None:
+				self.run_finite()
+			elif self.generator != None:
+				self.run_stream()
+		except RuntimeError:
+			if self.running:
+				raise
+		self.done = True
+	#
+	
+	# Configures the sample clock and start trigger for %samples points in the given sample mode
+	def configure(self, sample_mode, samples):
+		CHK(nidaq.DAQmxCfgSampClkTiming(self.taskHandle, self.clockSource, float64(self.sample_freq),
+							DAQmx_Val_Rising, sample_mode, uInt64(samples)))
+		if self.startTrigger != None:
+			CHK(nidaq.DAQmxCfgDigEdgeStartTrig(self.taskHandle, self.startTrigger, DAQmx_Val_Rising))
+	#
+	
+	# Writes a (samples, channels) block into the output buffer, waits for space if it is full
+	def write(self, block):
+		block = np.ascontiguousarray(block, dtype=np.float64).reshape(-1, self.numChannels)
+		CHK(nidaq.DAQmxWriteAnalogF64(self.taskHandle, int32(block.shape[0]), 0, self.timeout,
+				DAQmx_Val_GroupByScanNumber, block.ctypes.data, ctypes.byref(self.pointsWritten), None))
+		self.samples_written += self.pointsWritten.value
+	#
+	
+	# Writes the whole waveform to the card and waits for it to be generated
+	def run_finite(self):
+		n = self.waveform.shape[0]
+		self.configure(DAQmx_Val_FiniteSamps, n)
+		self.write(self.waveform)
+		CHK(nidaq.DAQmxStartTask(self.taskHandle))
+		CHK(nidaq.DAQmxWaitUntilTaskDone(self.taskHandle, DAQmx_Val_WaitInfinitely))
+	#
+	
+	# Streams the blocks from the generator into the output buffer as space frees up, with regeneration
+	# off so every point is generated exactly once. The blocks are written in pieces no larger than the
+	# buffer and the task is started once the buffer is full. As the card stops with an error when it runs
+	# out of samples, the last point is written again for a buffer length after the end of the stream and
+	# the task is stopped once the end has been generated
+	def run_stream(self):
+		size = int(self.buffer_seconds*self.sample_freq)
+		self.configure(DAQmx_Val_ContSamps, size)
+		CHK(nidaq.DAQmxSetWriteRegenMode(self.taskHandle, DAQmx_Val_DoNotAllowRegen))
+		started = False
+		last = None
+		for block in self.generator:
+			block = np.ascontiguousarray(block, dtype=np.float64).reshape(-1, self.numChannels)
+			i = 0
+			while i < block.shape[0]:
+				if not self.running:
+					return
+				n = size if started else size - self.samples_written
+				self.write(block[i:i+n])
+				i += n
+				if not started and self.samples_written >= size:
+					CHK(nidaq.DAQmxStartTask(self.taskHandle))
+					started = True
+			if block.shape[0] > 0:
+				last = block[-1]
+		if last is None or not self.running:
+			return
+		end = self.samples_written
+		self.write(np.tile(last, (size if started else size - self.samples_written, 1)))
+		if not started:
+			CHK(nidaq.DAQmxStartTask(self.taskHandle))
+		generated = uInt64()
+		while self.running:
+			CHK(nidaq.DAQmxGetWriteTotalSampPerChanGenerated(self.taskHandle, ctypes.byref(generated)))
+			if generated.value >= end:
+				break
+			time.sleep(0.01)
+		nidaq.DAQmxStopTask(self.taskHandle)
+	#
+	
+	# Stops the output and releases the channels
+	def stop(self):
+		self.running = False
+		if self.taskHandle.value != 0:
+			nidaq.DAQmxStopTask(self.taskHandle)
+			if self.is_alive() and threading.current_thread() != self:
+				self.join(1.0)
+			nidaq.DAQmxClearTask(self.taskHandle)
+	#
+# end analog_waveform_output
@@ -6,9 +6,43 @@ DAQ_name = "CPSDAQ"
 # Data Writing Parameters
 data_file_ext = "dat" # Data file extension, i.e. filename.ext
 data_file_types = ['bnc','tmp', 'mag','log'] # Types of data file, 'bnc' should always be first and 'log' should always be last
+bnc_file_format = "text" # "text" for tab separated bnc files, "binary" for binary run files, "compressed" for compressed run files, see datafiles.py
+binary_file_ext = "bin" # Binary run file extension
+text_precision = 9 # Digits after the decimal point of values in text data files, written as %.9e
+index_file_ext = "idx" # Time index file extension, see datafiles.py
+index_stride = 1000 # Rows of a text data file between entries of its time index
+compressed_file_ext = "gdz" # Compressed run file extension
+event_file_ext = "jsonl" # Event log extension, the parameter changes of a run as JSON lines, see datafiles.py
+event_state_lines = 100 # Parameter changes between the lines of an event log giving every value
+other_file_format = "text" # "text" for tmp and mag files as text, "compressed" for compressed run files
+compressed_codec = "zlib" # Codec of compressed run files, "zlib", "bz2", or "lzma" where available
+compressed_level = 6 # Compression level, 1 fastest to 9 smallest
+compressed_filter = "delta_shuffle" # Filter applied to card data before compression, "none", "shuffle" or "delta_shuffle"
+compressed_chunk_rows = 65536 # Samples of card data in each compressed chunk
+compressed_text_chunk_lines = 1024 # Lines of text data in each compressed chunk
+compressed_workers = 2 # Threads compressing chunks
+write_behind_enabled = True # True to write the data files through a write-behind buffer, see datafiles.py
+flush_bytes = 4*1024*1024 # Bytes waiting in the write-behind buffer that start a flush
+flush_age = 1.0 # Age in seconds of the oldest write waiting in the write-behind buffer that starts a flush
+flush_fsync = False # True to have the operating system write the data files to the disk on every flush
+write_behind_bytes = 64*1024*1024 # Largest number of bytes waiting in the write-behind buffer
+drain_max_bytes = 32*1024*1024 # Largest batch of queued data the data writer takes at once, in bytes
+drain_max_rows = 1000000 # Largest batch of queued data the data writer takes at once, in rows
+data_writer_process = False # True to format and write the data files in a separate process, see writerproc.py
+writer_shared_bytes = 64*1024*1024 # Shared memory passing data to the writer process, in bytes
+run_catalog_enabled = True # True to record each run in the run catalog of the data directory, see catalog.py
+catalog_file = "runs.sqlite" # Name of the run catalog database in the data directory
+scheduler_workers = 4 # Worker threads running the periodic pollers, see utilities.scheduler
+logger_flush_interval = 0.5 # Seconds between writes of the terminal log, see utilities.Logger
+logger_max_lines = 10000 # Lines of terminal output that can wait to be written, more are dropped
+logger_max_bytes = 16*1024*1024 # Size of the terminal log file at which it is rotated
+logger_backups = 5 # Rotated terminal log files kept
 
 # Data Acquisition Parameters
 masterSampleFreq = 100.0 # 1000.0 # DAQ card sample frequency, type = float
+DAQ_backend = "nidaq" # "nidaq" for the NI-DAQmx driver, "simulated" for the simulated driver in daqmx_sim.py
+clock_fit_interval = 1.0 # Seconds of card blocks from which one arrival is kept to fit the card clock
+clock_fit_points = 600 # Arrivals used to fit the card clock to the host clock
 
 # System Paths
 data_dir_path = "C:\\Cryomagnetic_Probe_Station\\Data\\" # Path to data directory
@@ -24,6 +58,12 @@ photocurrent_run_path = labview_dir_path + 'run_confocal_vi.py'
 
 # Magnet Parameters
 current_to_field = 1070.0 # Based on Janis research calibration # Units Gauss/Amps
+magnet_poll_interval = 0.1 # Seconds between readings of the magnet current and voltage
+
+# Serial Parameters
+serial_event_loop = True # True to run every serial instrument on one thread, see serialloop.py
+serial_command_timeout = 0.25 # Seconds allowed for the responses to a serial transaction
+serial_loop_tick = 0.001 # Seconds the serial loop sleeps when no port has anything to do
 
 # NI_DAQmx typedefs and constants, correspond with values in
 # C:\Program Files(x86)\National Instruments\NI-DAQ\DAQmx ANSI C Dev\include\NIDAQmx.h
@@ -45,6 +85,8 @@ DAQmx_Val_Diff =  10106
 DAQmx_Val_Volts = 10348
 DAQmx_Val_ContSamps = 10123
 DAQmx_Val_GroupByScanNumber = 1
+DAQmx_Val_DoNotAllowRegen = 10158
+DAQmx_Val_WaitInfinitely = float64(-1.0)
 DAQ_AO_Max = float64(5.0)
 DAQ_AO_Min = float64(-5.0)
 DAQ_AI_Max = float64(5.0)
@@ -0,0 +1,301 @@
+#
+# processing.py
+#
+# GaborDAQ modules for processing streams of data from the DAQ card
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import threading
+import numpy as np
+
+from parameters import *
+
+# Processing stages take the (scans, columns) blocks of the card stream, with the time in the first
+# column, one at a time through process(block) and return a processed block or None if there is no
+# output yet. They keep whatever state they need between blocks so that the output is continuous.
+# A stage is attached to an input with add_stage() (see nidaq.py), which returns the Queue it feeds
+
+# Passes a block through a list of (stage, queue) pairs, putting the output of each stage on its queue
+def run_stages(stages, block):
+	for stage, q in stages:
+		out = stage.process(block)
+		if out is not None and out.shape[0] > 0:
+			q.put(out)
+# end run_stages
+
+# Reduces the rate of a stream by an integer factor, for consumers such as displays that do not need
+# the full rate of the card
+#
+# %factor is the number of input rows for each output row, the output rate is the input rate / factor
+#
+# %mode is the reduction applied to each channel
+# 'boxcar' - the mean of each group of factor rows
+# 'cic'    - a cascaded integrator comb filter of the given %order, equivalent to applying the boxcar
+#            order times before decimating, which rejects much more of the signal that would alias
+# 'minmax' - the minimum and maximum of each group, for drawing an envelope that shows every spike,
+#            output rows are time, the minimum of each channel, then the maximum of each channel
+#
+# The time column of the output is the center of the group of input rows each row was reduced from
+class decimator():
+	def __init__(self, factor, mode='boxcar', order=3):
+		if mode not in ('boxcar', 'cic', 'minmax'):
+			raise ValueError("decimator : unknown mode " + str(mode))
+		self.factor = int(factor)
+		self.mode = mode
+		self.order = int(order) if mode == 'cic' else 1
+		self.count = 0 # Number of input rows processed
+		self.carry = None # Input rows kept from the previous block
+	#
+
+	# Reduces a block, returns the output rows completed by it
+	def process(self, block):
+		if self.mode == 'cic':
+			return self.process_cic(block)
+		R = self.factor
+		if self.carry is not None and self.carry.shape[0] > 0:
+			block = np.concatenate((self.carry, block))
+		n = (block.shape[0] // R) * R
+		self.carry = block[n:].copy()
+		groups = block[:n].reshape(n // R, R, block.shape[1])
+		if self.mode == 'boxcar':
+			return groups.mean(axis=1)
+		out = np.empty((n // R, 2*block.shape[1]-1), dtype=np.float64)
+		out[:,0] = groups[:,:,0].mean(axis=1)
+		out[:,1:block.shape[1]] = groups[:,:,1:].min(axis=1)
+		out[:,block.shape[1]:] = groups[:,:,1:].max(axis=1)
+		return out
+	#
+
+	# Cascaded integrator comb, each stage is a running sum over factor rows computed as the difference
+	# of a cumulative sum. The sums restart every block from the last order*(factor-1) rows of the
+	# previous one so they never grow large enough to lose precision
+	def process_cic(self, block):
+		R = self.factor
+		history = self.order*(R - 1)
+		if self.carry is None: # Start in steady state on the first row
+			self.carry = np.repeat(block[:1], history, axis=0)
+		x = np.concatenate((self.carry, block))
+		self.carry = x[x.shape[0]-history:].copy()
+		ref = x[0].copy()
+		x = x - ref
+		for i in range(self.order):
+			cs = np.zeros((x.shape[0]+1, x.shape[1]), dtype=np.float64)
+			np.cumsum(x, axis=0, out=cs[1:])
+			x = cs[R:] - cs[:-R]
+		# x[j] is the filter output for the window ending on input row self.count + j
+		first = (R - 1 - self.count) % R
+		self.count += block.shape[0]
+		out = x[first::R]
+		out /= float(R)**self.order
+		out += ref
+		return out
+	#
+# end decimator
+
+# Applies the first order low pass filter y[n] = a*y[n-1] + (1-a)*x[n] along the first axis of %x in place
+# %state is the last output of the previous block, returns the last output of this block
+# The recursion is solved in closed form with a cumulative sum over runs of rows short enough that
+# the growing weights a**-n stay well inside double precision
+def exp_lowpass(x, a, state):
+	L = max(int(20.0/-np.log(a)), 1)
+	shape = (-1,) + (1,)*(x.ndim-1)
+	for i in range(0, x.shape[0], L):
+		c = x[i:i+L]
+		p = (a**np.arange(1, c.shape[0]+1)).reshape(shape)
+		c[:] = p*(state + (1.0 - a)*np.cumsum(c/p, axis=0))
+		state = c[-1].copy()
+	return state
+# end exp_lowpass
+
+# A software lock-in amplifier, demodulates any number of channels at any number of harmonics of a
+# reference at once, the output is low pass filtered and reduced to a lower rate
+#
+# %channels is a list of the block columns to demodulate, the card channels start at column 1
+# %sample_freq is the sample frequency of the input stream
+# %time_constant is the time constant of each low pass filter stage in seconds
+# %decimation is the number of input rows for each output row
+# %ref_column is the block column holding a measured reference, such as the chopper output, its phase
+# is tracked from the rising crossings of %ref_level, by default the midpoint of the first block
+# %ref_freq is the frequency of a synthesized reference in Hz, used if ref_column is None
+# %harmonics is a list of the harmonics of the reference to demodulate at
+# %order is the number of low pass filter stages, 6 dB/octave each
+# %phase is a phase offset added to the reference in degrees
+#
+# Output rows are time, then X, Y, R, theta for each harmonic of each channel, in the order
+# channels[0] harmonics[0], channels[0] harmonics[1], ... R is the amplitude and theta in degrees
+class lockin():
+	def __init__(self, channels, sample_freq, time_constant, decimation, ref_column=None, ref_freq=None,
+				 harmonics=(1,), order=2, phase=0.0, ref_level=None):
+		if ref_column == None and ref_freq == None:
+			raise ValueError("lockin : give either a reference column or a reference frequency")
+		self.channels = list(channels)
+		self.harmonics = np.array(harmonics, dtype=np.float64)
+		self.a = np.exp(-1.0/(sample_freq*time_constant))
+		self.order = int(order)
+		self.decimation = int(decimation)
+		self.ref_column = ref_column
+		self.ref_freq = ref_freq
+		self.ref_level = ref_level
+		self.phase = np.radians(phase)
+		self.count = 0 # Number of input rows processed
+		self.state = np.zeros((self.order, len(self.harmonics), len(self.channels)), dtype=np.complex128)
+		self.last_ref = None # Time and value of the last reference sample of the previous block
+		self.crossings = np.zeros(0) # Times of the last reference crossings of the previous blocks
+		self.cycles = 0 # Number of reference cycles before the first of those crossings
+	#
+	
+	# Returns the phase of the reference in radians at each row of the block
+	def reference_phase(self, block):
+		t = block[:,0]
+		if self.ref_column == None:
+			return 2.0*np.pi*self.ref_freq*t + self.phase
+		ref = block[:,self.ref_column]
+		if self.ref_level == None:
+			self.ref_level = 0.5*(ref.min() + ref.max())
+		if self.last_ref != None:
+			t = np.concatenate(([self.last_ref[0]], t))
+			ref = np.concatenate(([self.last_ref[1]], ref))
+		self.last_ref = (t[-1], ref[-1])
+		# Rising crossings of the level, interpolated between samples
+		k = np.nonzero((ref[:-1] < self.ref_level) & (ref[1:] >= self.ref_level))[0]
+		tc = t[k] + (self.ref_level - ref[k])*(t[k+1] - t[k])/(ref[k+1] - ref[k])
+		c = np.concatenate((self.crossings, tc))
+		t = block[:,0]
+		if c.shape[0] < 2: # Not locked yet
+			ph = np.zeros(t.shape[0])
+		else:
+			cycle = np.interp(t, c, np.arange(c.shape[0], dtype=np.float64))
+			after = t > c[-1]
+			cycle[after] = c.shape[0] - 1 + (t[after] - c[-1])/(c[-1] - c[-2])
+			before = t < c[0]
+			cycle[before] = (t[before] - c[0])/(c[1] - c[0])
+			ph = 2.0*np.pi*(cycle + self.cycles) + self.phase
+		keep = min(c.shape[0], 2)
+		self.cycles += c.shape[0] - keep
+		self.crossings = c[c.shape[0]-keep:]
+		return ph
+	#
+	
+	# Demodulates a block, returns the output rows completed by it
+	def process(self, block):
+		ph = self.reference_phase(block)
+		ref = np.exp(-1j*np.outer(ph, self.harmonics))
+		z = 2.0*ref[:,:,np.newaxis]*block[:,np.newaxis,self.channels]
+		for i in range(self.order):
+			self.state[i] = exp_lowpass(z, self.a, self.state[i])
+		first = (self.decimation - 1 - self.count) % self.decimation
+		self.count += block.shape[0]
+		z = z[first::self.decimation]
+		out = np.empty((z.shape[0], 1 + 4*z.shape[1]*z.shape[2]), dtype=np.float64)
+		out[:,0] = block[first::self.decimation,0]
+		z = z.transpose(0, 2, 1).reshape(z.shape[0], -1)
+		out[:,1::4] = z.real
+		out[:,2::4] = z.imag
+		out[:,3::4] = np.abs(z)
+		out[:,4::4] = np.degrees(np.angle(z))
+		return out
+	#
+# end lockin
+
+# Time alignment
+# The card data is timed by its sample count and the data of the other instruments (temperature, magnet)
+# by the stop watch, the two time bases are zeroed together by sync_zero() (see nidaq.py). These functions
+# bring the streams onto one time base, see also runloader.align_run for recorded runs
+
+# Returns the columns of %values, sampled at the increasing times %tp, at the times %t
+# %method is 'linear' to interpolate, 'previous' to hold the last sample, or 'nearest'
+# Times before the first sample or, for 'linear', after the last are nan unless %hold is True, then the
+# first or last sample is used
+def interp_columns(t, tp, values, method='linear', hold=False):
+	values = np.asarray(values, dtype=np.float64).reshape(tp.shape[0], -1)
+	out = np.empty((t.shape[0], values.shape[1]), dtype=np.float64)
+	if tp.shape[0] == 0:
+		out.fill(np.nan)
+		return out
+	i = np.searchsorted(tp, t, side='right') # tp[i-1] <= t < tp[i]
+	if method == 'previous' or (method == 'linear' and tp.shape[0] == 1):
+		out[:] = values[np.maximum(i - 1, 0)]
+	elif method == 'nearest':
+		j = np.clip(i, 1, tp.shape[0] - 1)
+		later = (tp[j] - t) < (t - tp[j-1])
+		out[:] = values[np.where(later, j, j - 1)]
+		if tp.shape[0] == 1:
+			out[:] = values[0]
+	elif method == 'linear':
+		j = np.clip(i, 1, tp.shape[0] - 1)
+		dt = tp[j] - tp[j-1]
+		w = np.where(dt > 0, (t - tp[j-1])/np.where(dt > 0, dt, 1.0), 0.0)
+		if hold:
+			w = np.clip(w, 0.0, 1.0)
+		out[:] = values[j-1] + w[:,np.newaxis]*(values[j] - values[j-1])
+		if not hold:
+			out[t > tp[-1]] = np.nan
+	else:
+		raise ValueError("interp_columns : unknown method " + str(method))
+	if not hold:
+		out[t < tp[0]] = np.nan
+	return out
+# end interp_columns
+
+# Accumulates the sums of the rows of %values with times %t into the intervals ending at the increasing
+# times %edges, row k of %sums holds the sum over edges[k-1] < t <= edges[k], %counts the number of rows
+# Used to average a fast stream over the samples of a slow one, the mean is sums/counts
+def bin_sums(t, values, edges, sums, counts):
+	k = np.searchsorted(edges, t, side='left')
+	inside = k < edges.shape[0]
+	k = k[inside]
+	counts += np.bincount(k, minlength=edges.shape[0])
+	for c in range(values.shape[1]):
+		sums[:,c] += np.bincount(k, weights=values[inside,c], minlength=edges.shape[0])
+# end bin_sums
+
+# Adds the latest values of the other instruments to the card stream, each output row is the block row
+# followed by the values of each instrument at its time
+#
+# %widths is the number of values of each instrument, in the order of their index in update()
+# %method is 'linear' or 'previous', see interp_columns, card rows later than the last sample of an
+# instrument hold its last value since the next sample has not arrived yet
+# %time_offset is the card time at stop watch time zero, card time = stop watch time + time_offset
+# %history is the number of samples kept for each instrument
+class aligner():
+	def __init__(self, widths, method='linear', time_offset=0.0, history=1000):
+		self.widths = list(widths)
+		self.method = method
+		self.time_offset = time_offset
+		self.history = history
+		self.times = [np.zeros(0) for w in self.widths]
+		self.values = [np.zeros((0, w)) for w in self.widths]
+		self.lock = threading.Lock()
+	#
+
+	# Records a sample of instrument %index taken at stop watch time %t, may be called from any thread
+	def update(self, index, t, values):
+		with self.lock:
+			first = max(self.times[index].shape[0] - self.history + 1, 0) # [-history+1:] would keep all for history 1
+			self.times[index] = np.append(self.times[index][first:], t)
+			self.values[index] = np.vstack((self.values[index][first:], np.reshape(values, (1, -1))))
+	#
+
+	# Records a sample from a line of text as the instruments put on their data queues, time first and
+	# tab separated values
+	def update_line(self, index, line):
+		fields = [float(f) for f in str(line).split('\t')]
+		self.update(index, fields[0], fields[1:])
+	#
+
+	def process(self, block):
+		t = block[:,0] - self.time_offset
+		out = np.empty((block.shape[0], block.shape[1] + sum(self.widths)), dtype=np.float64)
+		out[:,:block.shape[1]] = block
+		c = block.shape[1]
+		for i in range(len(self.widths)):
+			with self.lock:
+				tp = self.times[i]
+				vp = self.values[i]
+			out[:,c:c+self.widths[i]] = interp_columns(t, tp, vp, self.method, hold=True)
+			c += self.widths[i]
+		return out
+	#
+# end aligner
@@ -0,0 +1,451 @@
+#
+# runloader.py
+#
+# GaborDAQ loader for recorded runs, opens every data file of a run lazily
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import os
+import re
+import time
+import numpy as np
+
+from parameters import *
+from datafiles import *
+from utilities import scale_raw
+from processing import interp_columns, bin_sums
+
+# Opening a run only lists its files and reads the headers of the binary ones, the data is read when a
+# column is used. Binary run files are memory mapped, text and compressed files are read in chunks keeping
+# only the columns asked for, so the memory used depends on the columns that are touched, not on the
+# length of the run. Columns that have been read are kept until forget() is called
+#
+# Example:
+#	run = open_run("2014_08_21_3")
+#	t = run['bnc']['time']
+#	v = run['bnc']['ai2']
+#	changes = run.log # Table of the parameter changes
+#	setpoint = run.events.value("Heater Setpoint", 1234.0) # Value of a parameter at a time
+
+# Names of the columns of the text data files other than bnc, see GaborDAQ_Documentation.txt
+text_column_names = {
+	'tmp' : ['time', 'A', 'B', 'C', 'D'],
+	'mag' : ['time', 'current', 'voltage', 'field']
+}
+text_read_bytes = 8*1024*1024 # Bytes of a text file parsed at a time
+align_chunk_rows = 1000000 # Rows of a binary run file read at a time
+
+# Parses the whole lines of text %data into a (lines, %columns) array, fields that are not numbers are nan
+def parse_text_lines(data, columns):
+	values = np.fromstring(data, sep=' ')
+	lines = data.count('\n')
+	if values.shape[0] == lines*columns:
+		return values.reshape(lines, columns)
+	# Some fields are not numbers, parse line by line
+	out = np.empty((lines, columns))
+	out.fill(np.nan)
+	for i, line in enumerate(data.splitlines()):
+		for j, field in enumerate(line.split('\t')[:columns]):
+			try:
+				out[i, j] = float(field)
+			except ValueError:
+				pass
+	return out
+# end parse_text_lines
+
+# A text data file of a run, see open_run
+# %filename is the data file, %names are the names of its columns, named time, ai0, ai1, ... if None
+class text_stream():
+	def __init__(self, filename, names=None):
+		self.filename = filename
+		self.names = names
+		self.cache = {}
+	#
+
+	# Returns the names of the columns, read from the first line if they were not given
+	def columns(self):
+		if self.names == None:
+			f = open(self.filename, 'r')
+			first = f.readline()
+			f.close()
+			n = len(first.split('\t')) if len(first.strip()) > 0 else 1
+			self.names = ['time'] + ['ai' + str(i) for i in range(n - 1)]
+		return self.names
+	#
+
+	# Yields the data as (lines, columns) arrays holding only the columns %use (all if None), from the
+	# byte range %start to %stop of the file
+	def iter_chunks(self, use=None, start=0, stop=None):
+		names = self.columns()
+		cols = range(len(names)) if use == None else [names.index(c) for c in use]
+		f = open(self.filename, 'rb')
+		f.seek(start)
+		left = stop - start if stop != None else None
+		rest = ""
+		while True:
+			size = text_read_bytes if left == None else min(text_read_bytes, left)
+			data = f.read(size) if size > 0 else ""
+			if left != None:
+				left -= len(data)
+			if len(data) == 0:
+				data = rest if rest.endswith('\n') or len(rest) == 0 else rest + '\n'
+				rest = ""
+				if len(data) == 0:
+					break
+			else:
+				data = rest + data
+				cut = data.rfind('\n') + 1
+				data, rest = data[:cut], data[cut:]
+			if len(data) > 0:
+				yield parse_text_lines(data, len(names))[:,cols]
+		f.close()
+	#
+
+	# Yields the data as (rows, columns) arrays, all columns in the order of columns()
+	def iter_arrays(self, rows=None):
+		return self.iter_chunks()
+	#
+
+	# Reads the columns %use in one pass through the file, keeping them in the cache
+	def load(self, use):
+		need = [c for c in use if c not in self.cache]
+		if len(need) > 0:
+			parts = list(self.iter_chunks(need))
+			data = np.concatenate(parts) if len(parts) > 0 else np.zeros((0, len(need)))
+			for j, c in enumerate(need):
+				self.cache[c] = np.ascontiguousarray(data[:,j])
+		return [self.cache[c] for c in use]
+	#
+
+	def __getitem__(self, name):
+		if name not in self.columns():
+			raise KeyError("runloader.text_stream : no column " + str(name) + " in " + str(self.filename))
+		return self.load([name])[0]
+	#
+
+	# Returns the rows with times from %t0 up to but not including %t1, using the time index if there is one
+	def window(self, t0, t1):
+		if os.path.isfile(time_index_filename(self.filename)):
+			start, stop = time_window_offsets(self.filename, t0, t1)
+		else:
+			start, stop = 0, None
+		parts = [d[(d[:,0] >= t0) & (d[:,0] < t1)] for d in self.iter_chunks(None, start, stop)]
+		return np.concatenate(parts) if len(parts) > 0 else np.zeros((0, len(self.columns())))
+	#
+
+	# Drops the columns that have been read
+	def forget(self):
+		self.cache = {}
+	#
+# end text_stream
+
+# Returns the records %rec of a binary or compressed run file with the given %header as a (rows, columns)
+# array, channels holding raw codes are scaled to volts
+def records_array(rec, header):
+	names = rec.dtype.names
+	out = np.empty((rec.shape[0], len(names)), dtype=np.float64)
+	for j, name in enumerate(names):
+		out[:,j] = rec[name]
+	if header['scaling'] != None:
+		out[:,1:] = scale_raw(out[:,1:], np.array(header['scaling']))
+	return out
+# end records_array
+
+# A binary run file of a run, the columns are memory mapped, see open_run
+class binary_stream():
+	def __init__(self, filename):
+		self.filename = filename
+		self.header, self.records = read_binary_run(filename)
+	#
+
+	def columns(self):
+		return list(self.records.dtype.names)
+	#
+
+	# Returns the column %name, channels holding raw codes are scaled to volts, which reads the column
+	def __getitem__(self, name):
+		if name not in self.records.dtype.names:
+			raise KeyError("runloader.binary_stream : no column " + str(name) + " in " + str(self.filename))
+		c = self.records[name]
+		if name != 'time' and self.header['scaling'] != None:
+			i = self.records.dtype.names.index(name) - 1
+			return scale_raw(np.asarray(c).reshape(-1, 1), np.array(self.header['scaling'])[i:i+1])[:,0]
+		return c
+	#
+
+	# Returns the records with times from %t0 up to but not including %t1
+	def window(self, t0, t1):
+		return read_data_window(self.filename, t0, t1)
+	#
+
+	# Yields the data as (%rows, columns) arrays, all columns in the order of columns(), in volts
+	def iter_arrays(self, rows=align_chunk_rows):
+		for i in range(0, self.records.shape[0], rows):
+			yield records_array(self.records[i:i+rows], self.header)
+	#
+
+	def forget(self):
+		pass
+	#
+# end binary_stream
+
+# A compressed run file of a run, see open_run
+# %names are the names of the columns of text data, named time, ai0, ai1, ... if None
+class compressed_stream():
+	def __init__(self, filename, names=None):
+		self.filename = filename
+		self.reader = compressed_run_reader(filename)
+		self.header = self.reader.header
+		self.names = names
+		self.cache = {}
+	#
+
+	def columns(self):
+		if self.reader.kind == 'records':
+			return list(self.reader.dtype.names)
+		if self.names == None:
+			first = self.reader.chunk(0).split('\n', 1)[0] if self.reader.index.shape[0] > 0 else ""
+			self.names = ['time'] + ['ai' + str(i) for i in range(len(first.split('\t')) - 1)]
+		return self.names
+	#
+
+	# Yields the data one chunk at a time, as records or as (lines, columns) arrays of text data
+	def iter_chunks(self):
+		for i in range(self.reader.index.shape[0]):
+			c = self.reader.chunk(i)
+			if self.reader.kind == 'text':
+				c = parse_text_lines(c if c.endswith('\n') else c + '\n', len(self.columns()))
+			yield c
+	#
+
+	# Yields the data as (rows, columns) arrays, one per chunk, all columns in the order of columns(), in volts
+	def iter_arrays(self, rows=None):
+		for c in self.iter_chunks():
+			yield records_array(c, self.header) if self.reader.kind == 'records' else c
+	#
+
+	# Returns the column %name, reading it from every chunk, channels holding raw codes are scaled to volts
+	def __getitem__(self, name):
+		names = self.columns()
+		if name not in names:
+			raise KeyError("runloader.compressed_stream : no column " + str(name) + " in " + str(self.filename))
+		if name not in self.cache:
+			j = names.index(name)
+			parts = [c[name] if self.reader.kind == 'records' else c[:,j] for c in self.iter_chunks()]
+			c = np.concatenate(parts) if len(parts) > 0 else np.zeros(0)
+			if self.reader.kind == 'records' and name != 'time' and self.header['scaling'] != None:
+				c = scale_raw(c.reshape(-1, 1), np.array(self.header['scaling'])[j-1:j])[:,0]
+			self.cache[name] = c
+		return self.cache[name]
+	#
+
+	# Returns the rows with times from %t0 up to but not including %t1, reading only the chunks that hold them
+	def window(self, t0, t1):
+		w = self.reader.read_time(t0, t1)
+		if self.reader.kind == 'text':
+			return parse_text_lines(w, len(self.columns()))
+		return w
+	#
+
+	def forget(self):
+		self.cache = {}
+	#
+# end compressed_stream
+
+# Parses the lines of a log file, returns (parameters, changes) where parameters is a dictionary of the
+# values in the copy of parameters.py at the top of the file, as text, and changes is a record array with
+# the fields time, name and value, one row per line. Lines that are not parameter changes have the name ''
+# and the text of the line as the value
+def parse_log(filename):
+	params = {}
+	rows = []
+	f = open(filename, 'r')
+	header = True
+	for line in f:
+		line = line.rstrip('\r\n')
+		if header:
+			if line.startswith('##### Parameter Changes'):
+				header = False
+				continue
+			m = re.match(r'^([A-Za-z_]\w*)\s*=\s*(.*?)\s*(#.*)?$', line)
+			if m:
+				params[m.group(1)] = m.group(2)
+			continue
+		m = re.match(r'^\[([^\]]*)\]: (.*)$', line)
+		if not m:
+			continue
+		try:
+			t = float(m.group(1))
+		except ValueError:
+			t = np.nan
+		p = re.match(r'^PARAMETER (.*) SET TO (.*)$', m.group(2))
+		if p:
+			rows.append((t, p.group(1), p.group(2)))
+		else:
+			rows.append((t, '', m.group(2)))
+	f.close()
+	width = max([1] + [max(len(r[1]), len(r[2])) for r in rows])
+	table = np.array(rows, dtype=[('time', '<f8'), ('name', 'S' + str(width)), ('value', 'S' + str(width))])
+	return params, table.view(np.recarray)
+# end parse_log
+
+# The data files of a recorded run, the streams are opened when first used
+# Streams are indexed by type, e.g. run['bnc'], and their columns by name, e.g. run['bnc']['ai0']
+#
+# %prefix is the path and name of the run, %data_dir%year_%month_%day_%run
+class run_files():
+	def __init__(self, prefix):
+		self.prefix = prefix
+		self.files = {}
+		self.streams = {}
+		self.parsed_log = None
+		self.event_log = None
+		for type in data_file_types:
+			for ext in (data_file_ext, binary_file_ext, compressed_file_ext, 'log'):
+				name = prefix + '_' + str(type) + '.' + str(ext)
+				if os.path.isfile(name):
+					self.files[type] = name
+					break
+		if len(self.files) == 0:
+			raise IOError("runloader.run_files : No data files found for run " + str(prefix))
+	#
+
+	# Returns the types of data recorded in the run
+	def types(self):
+		return [t for t in data_file_types if t in self.files]
+	#
+
+	def __getitem__(self, type):
+		if type not in self.streams:
+			if type not in self.files:
+				raise KeyError("runloader.run_files : no " + str(type) + " data in run " + str(self.prefix))
+			name = self.files[type]
+			if name.endswith('.' + binary_file_ext):
+				self.streams[type] = binary_stream(name)
+			elif name.endswith('.' + compressed_file_ext):
+				self.streams[type] = compressed_stream(name, text_column_names.get(type))
+			else:
+				self.streams[type] = text_stream(name, text_column_names.get(type))
+		return self.streams[type]
+	#
+
+	# The parameter changes recorded in the log, see parse_log
+	@property
+	def log(self):
+		return self.parse()[1]
+	#
+
+	# The parameters at the start of the run, as text, see parse_log
+	@property
+	def parameters(self):
+		return self.parse()[0]
+	#
+
+	# The event log of the run, see datafiles.event_log_reader, run.events.value(name, t) gives the value
+	# of a parameter at any time without parsing the log
+	@property
+	def events(self):
+		if self.event_log == None:
+			name = self.prefix + '_log.' + event_file_ext
+			if not os.path.isfile(name):
+				raise KeyError("runloader.run_files : no event log in run " + str(self.prefix))
+			self.event_log = event_log_reader(name)
+		return self.event_log
+	#
+
+	def parse(self):
+		if self.parsed_log == None:
+			if 'log' not in self.files:
+				raise KeyError("runloader.run_files : no log in run " + str(self.prefix))
+			self.parsed_log = parse_log(self.files['log'])
+		return self.parsed_log
+	#
+
+	# Drops the columns that have been read from every stream
+	def forget(self):
+		for s in self.streams.values():
+			s.forget()
+	#
+# end run_files
+
+# Joins the streams of a recorded run into one table on the time base of one of them, a chunk of the
+# stream %onto at a time so that runs of any length are joined in bounded memory
+#
+# %run is an open run, see open_run
+# %streams are the types of the streams to join onto it, all the other data streams if None
+# %onto is the type of the stream giving the time base, usually 'bnc'
+# %method is how the other streams are brought onto the time base
+# 'linear', 'previous' or 'nearest' - their values at each row of onto, see processing.interp_columns
+# 'mean' - the mean of their rows since the previous row of onto, for putting the card data onto the
+#          time base of a slow instrument
+# %time_offset is the card time at stop watch time zero, used if exactly one of onto and a stream is 'bnc'
+# %filename is a binary run file to write the table to, if None the table is returned
+#
+# Returns (names, table), the names of the columns, time first then the columns of onto then those of each
+# stream named %type_%column, and the table, or the names and the number of rows written if %filename is given
+def align_run(run, streams=None, onto='bnc', method='linear', time_offset=0.0, filename=None):
+	if streams == None:
+		streams = [t for t in run.types() if t != onto and t != 'log']
+	names = list(run[onto].columns())
+	shift = {} # Added to the time of each stream to bring it onto the time base of onto
+	for s in streams:
+		names += [str(s) + '_' + c for c in run[s].columns()[1:]]
+		shift[s] = 0.0
+		if onto == 'bnc' and s != 'bnc':
+			shift[s] = time_offset
+		elif onto != 'bnc' and s == 'bnc':
+			shift[s] = -time_offset
+	if method == 'mean':
+		t = run[onto]['time']
+		parts = [np.column_stack([run[onto][c] for c in run[onto].columns()])]
+		for s in streams:
+			width = len(run[s].columns()) - 1
+			sums = np.zeros((t.shape[0], width))
+			counts = np.zeros(t.shape[0])
+			for d in run[s].iter_arrays():
+				bin_sums(d[:,0] + shift[s], d[:,1:], t, sums, counts)
+			with np.errstate(invalid='ignore', divide='ignore'):
+				parts.append(sums/counts[:,np.newaxis])
+		table = np.column_stack(parts)
+		if filename == None:
+			return names, table
+		out = binary_run_writer(filename, names[1:])
+		out.write(table)
+		out.close()
+		return names, table.shape[0]
+	# The other streams are slow, they are read whole
+	others = [(s, run[s]['time'] + shift[s], np.column_stack([run[s][c] for c in run[s].columns()[1:]])) for s in streams]
+	out = None
+	if filename != None:
+		freq = run[onto].header['sample_freq'] if hasattr(run[onto], 'header') else masterSampleFreq
+		out = binary_run_writer(filename, names[1:], freq)
+	parts = []
+	rows = 0
+	for d in run[onto].iter_arrays():
+		block = [d] + [interp_columns(d[:,0], tp, vp, method) for s, tp, vp in others]
+		block = np.column_stack(block)
+		rows += block.shape[0]
+		if out != None:
+			out.write(block)
+		else:
+			parts.append(block)
+	if out != None:
+		out.close()
+		return names, rows
+	return names, np.concatenate(parts) if len(parts) > 0 else np.zeros((0, len(names)))
+# end align_run
+
+# Opens a recorded run
+# %run is the run number as shown by the data writer, %year_%month_%day_%run, or just the number of a run
+# recorded on %date, given as %year_%month_%day, today if None
+# %data_dir is the directory holding the data files
+def open_run(run, date=None, data_dir=data_dir_path):
+	run = str(run)
+	if re.match(r'^\d+$', run):
+		if date == None:
+			date = time.strftime("%Y_%m_%d")
+		run = str(date) + '_' + run
+	return run_files(os.path.join(data_dir, run))
+# end open_run
@@ -15,29 +15,53 @@ import serial
 import Queue
 
 from parameters import *
+from utilities import get_scheduler
+from serialloop import get_serial_loop
 
 # A base class for communicating with serial devices
 # 
 # %com_port string that sets the COM port used by the serial device e.g. "COM2"
 #
+# Several queries can be made in one transaction with query(), joined into one message with the separator
+# query_separator if the device takes them that way (None if it doesn't), or otherwise pipelined, all of them
+# sent at once and then the responses read in order. Either way there is one turnaround for all of them.
+# The serial port is locked for each transaction so commands can be sent from any thread
+#
+# If the global parameter serial_event_loop is True the transactions run on the serial loop shared by
+# every instrument (see serialloop.py) instead of blocking the calling thread on the port, self.loop_port
+# is then the port on the loop
+#
+# %port is a serial port to use instead of opening %com_port, for example a serialloop.loopback_lakeshore_625
+#
 class serial_device(threading.Thread):
-	def __init__(self, com_port):
+	query_separator = None
+	
+	def __init__(self, com_port, port=None):
 		self.running = True
-		try:
-			self.ser = serial.Serial(
-				port=str(com_port),
-				baudrate=9600,
-				parity=serial.PARITY_ODD,
-				stopbits=serial.STOPBITS_ONE,
-				bytesize=serial.SEVENBITS,
-				timeout=0.05
-			)
+		self.lock = threading.Lock()
+		self.query_errors = 0 # Transactions with a missing or extra response
+		self.loop_port = None
+		if port != None:
+			self.ser = port
 			self.serial_open = True
-		except Exception as e:
-			print "Error opening Serial Port" + str(com_port)
-			print str(e)
-			self.serial_open = False
+		else:
+			try:
+				self.ser = serial.Serial(
+					port=str(com_port),
+					baudrate=9600,
+					parity=serial.PARITY_ODD,
+					stopbits=serial.STOPBITS_ONE,
+					bytesize=serial.SEVENBITS,
+					timeout=0.05
+				)
+				self.serial_open = True
+			except Exception as e:
+				print "Error opening Serial Port" + str(com_port)
+				print str(e)
+				self.serial_open = False
 		#
+		if self.serial_open and serial_event_loop:
+			self.loop_port = get_serial_loop().add_port(self.ser, self.query_separator)
 		
 		# initialize data queue
 		self.data_queue = Queue.Queue(maxsize=200000)
@@ -53,24 +77,72 @@ class serial_device(threading.Thread):
 	# Sends a request for data to the serial device and listens for a response
 	# Returns none and prints to terminal if no response was received
 	def get_data(self, command):
+		if self.loop_port != None:
+			return self.loop_port.request([command]).wait()[0]
 		if self.ser.isOpen():
-			self.ser.write(str(command) + '\r\n')
-			out = self.ser.readline().strip()
+			with self.lock:
+				self.ser.write(str(command) + '\r\n')
+				out = self.ser.readline().strip()
 			if out == "":
 				return None
 			else:
 				return out
 	# end get_data
 	
+	# Sends the queries in the list %commands in one transaction and returns the list of their responses,
+	# in the same order, with None for any that were not received
+	def query(self, commands):
+		out = [None]*len(commands)
+		if self.loop_port != None:
+			return self.loop_port.request(commands).wait()
+		if not self.ser.isOpen():
+			return out
+		with self.lock:
+			if self.query_separator != None:
+				self.ser.write(self.query_separator.join([str(c) for c in commands]) + '\r\n')
+				line = self.ser.readline().strip()
+				parts = line.split(self.query_separator) if line != "" else []
+				if len(parts) != len(commands):
+					self.resync()
+					return out
+				lines = parts
+			else:
+				self.ser.write("".join([str(c) + '\r\n' for c in commands]))
+				lines = []
+				for c in commands:
+					line = self.ser.readline()
+					if not line.endswith('\n'): # Timed out, the rest will not come
+						self.resync()
+						break
+					lines.append(line.strip())
+		for i in range(len(lines)):
+			if lines[i] != "":
+				out[i] = lines[i]
+		return out
+	# end query
+	
+	# Drops any responses left over from a failed transaction, so they are not taken for the next one
+	# Must hold the lock
+	def resync(self):
+		self.query_errors += 1
+		time.sleep(self.ser.timeout)
+		self.ser.flushInput()
+	# end resync
+	
 	# Sends a command and does not wait for a response
 	def send_command(self, command):
-		if self.ser.isOpen():
-			self.ser.write(str(command) + '\r\n')
+		if self.loop_port != None:
+			self.loop_port.send(command)
+		elif self.ser.isOpen():
+			with self.lock:
+				self.ser.write(str(command) + '\r\n')
 	# end send_command
 	
 	# Closes the serial connection and stops the thread
 	def stop(self):
 		self.running = False
+		if self.loop_port != None:
+			get_serial_loop().remove_port(self.loop_port)
 		self.ser.close()
 	# end stop
 # end serial_device
@@ -84,43 +156,63 @@ class serial_device(threading.Thread):
 # .current # The output current, Units in Amps
 # .field   # The central field, computed from the current based on calibration, Units in Tesla
 #
+# The current and voltage are read in one transaction every magnet_poll_interval seconds, on the serial loop
+# the reading is only started by the poll and is taken when the loop has the responses
+#
+# %port is a serial port to use instead of opening %com_port, see serial_device
+#
 class lakeshore_625(serial_device):
-	def __init__(self, com_port, sys_time):
-		serial_device.__init__(self,com_port)
+	query_separator = ';' # Queries joined as RDGI?;RDGV?, answered as current;voltage
+	
+	def __init__(self, com_port, sys_time, port=None):
+		serial_device.__init__(self, com_port, port)
 		self.name = "LakeShore 625"
 		self.current = 0.0
 		self.voltage = 0.0
 		self.field = 0.0
 		self.timer = sys_time
+		self.task = None
+		self.reading = None # The reading in progress on the serial loop
 	#
 	
-	# Runs the magnet
+	# Runs the magnet, reading it every magnet_poll_interval on the scheduler
 	def run(self):
-		self.read_data()
+		if self.serial_open:
+			self.task = get_scheduler().add(self.read_data, magnet_poll_interval, self.name)
 	#	
 	
 	# Reads the current and voltage and computes the field
 	def read_data(self):
-		if self.serial_open:
-			c = self.get_data("RDGI?") 
-			v = self.get_data("RDGV?")
-			if c != None and v != None:
+		if self.loop_port != None:
+			if self.reading == None or self.reading.done.is_set():
+				self.reading = self.loop_port.request(["RDGI?", "RDGV?"], self.take_reading)
+		elif self.serial_open:
+			self.take_reading(self.query(["RDGI?", "RDGV?"]))
+	# end read_data
+	
+	# Takes the responses %responses to RDGI?;RDGV? as the current and voltage
+	def take_reading(self, responses):
+		c, v = responses
+		if c != None and v != None:
+			try:
 				self.current = float(c)
 				self.voltage = float(v)
 				self.field = self.current * current_to_field * 1.0e-4
 				s = str(self.timer.time()) + "\t" + str(self.current) + "\t" + str(self.voltage) + "\t" + str(self.field)
 				self.data_queue.put(s)
-			#
-			self.task = threading.Timer(0.25, self.read_data)
-			self.task.start()
-	# end read_data
+			except ValueError:
+				print "lakeshore_625.read_data : Could not read the response " + str(c) + ";" + str(v)
+	# end take_reading
 	
 	#Closes the serial connection and stops the thread
 	def stop(self):
 		self.running = False
-		self.task.cancel()
-		time.sleep(0.1)
-		self.ser.close()
+		if self.task != None:
+			self.task.cancel() # Waits for a reading in progress
+		if self.loop_port != None:
+			get_serial_loop().remove_port(self.loop_port)
+		if self.serial_open:
+			self.ser.close()
 	#end stop
 # end lakeshore_625
 	
\ No newline at end of file
@@ -0,0 +1,413 @@
+#
+# serialloop.py
+#
+# GaborDAQ serial event loop, runs the transactions of every serial instrument on one thread
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import time
+import atexit
+import threading
+import collections
+
+from parameters import *
+from utilities import monotonic_time
+
+# One thread services every serial port instead of a thread per instrument blocking in readline(). The
+# ports are read without blocking, each holds a queue of transactions, a transaction being one or more
+# commands sent together and the responses expected for them. The loop writes the next transaction of a
+# port once the last is done, collects the bytes that have arrived, splits them into responses at the
+# terminator and completes the transaction when every response is in, or when its timeout passes with None
+# for the missing ones. A caller either waits on the transaction or gives a callback that the loop calls
+# with the responses, so polling an instrument never holds a thread while it answers.
+#
+# Python 2 has no asyncio, and select() does not work on serial ports on Windows, so the loop polls the
+# ports, sleeping serial_loop_tick seconds whenever none of them had anything to do
+#
+# Example:
+#	port = get_serial_loop().add_port(ser, separator=';')
+#	current, voltage = port.request(["RDGI?", "RDGV?"]).wait()
+
+# A transaction on a port, see loop_port.request
+class serial_request():
+	def __init__(self, commands, expected, timeout, callback):
+		self.commands = commands
+		self.expected = expected # Number of responses expected
+		self.timeout = timeout
+		self.callback = callback
+		self.responses = []
+		self.lines = 0 # Response lines received
+		self.deadline = None
+		self.result = None
+		self.done = threading.Event()
+	#
+
+	# Waits for the transaction to complete, returns the list of responses, None for any not received
+	def wait(self):
+		self.done.wait()
+		return self.result
+	#
+# end serial_request
+
+# A serial port run by the serial loop, made by serial_loop.add_port
+#
+# %ser is the port, a serial.Serial or anything with its isOpen, write, inWaiting, read and flushInput
+# methods, for example loopback_lakeshore_625. It is set to read without blocking
+# %separator joins several queries into one message if the instrument takes them that way, otherwise
+# several queries are pipelined, written together and their responses read in order
+# %terminator ends each command and response
+class loop_port():
+	def __init__(self, loop, ser, separator=None, terminator='\r\n'):
+		self.loop = loop
+		self.ser = ser
+		self.ser.timeout = 0
+		self.separator = separator
+		self.terminator = terminator
+		self.pending = collections.deque()
+		self.current = None
+		self.buffer = ''
+		self.transactions = 0
+		self.timeouts = 0
+		self.removed = False
+		self.stale = 0 # Response lines still due for transactions that timed out
+		self.stale_until = 0.0 # When to stop waiting for them
+	#
+
+	# Returns the number of response lines the transaction %r is answered with
+	def response_lines(self, r):
+		if self.separator != None and r.expected > 1:
+			return 1
+		return r.expected
+	#
+
+	# Queues the queries in the list %commands as one transaction, returns the serial_request
+	# %callback is called on the loop thread with the list of responses when it completes
+	# %timeout is the seconds allowed for all the responses, from when the commands are written
+	def request(self, commands, callback=None, timeout=serial_command_timeout):
+		commands = [str(c) for c in commands]
+		r = serial_request(commands, len(commands), timeout, callback)
+		self.loop.submit(self, r)
+		return r
+	#
+
+	# Queues the command %command, which has no response
+	def send(self, command):
+		r = serial_request([str(command)], 0, 0.0, None)
+		self.loop.submit(self, r)
+		return r
+	#
+
+	# Writes the next transaction if there is none in progress, must be called on the loop thread
+	# Returns True if it wrote one
+	# Waits for the late responses of timed out transactions first, so they are not taken for the next one
+	def start_next(self, now):
+		if self.current != None or len(self.pending) == 0:
+			return False
+		if self.stale > 0:
+			if now < self.stale_until:
+				return False
+			# They are not coming, drop any part that arrived
+			self.stale = 0
+			self.buffer = ''
+			self.ser.flushInput()
+		r = self.pending.popleft()
+		if self.separator != None and r.expected > 1:
+			self.ser.write(self.separator.join(r.commands) + self.terminator)
+		else:
+			self.ser.write("".join([c + self.terminator for c in r.commands]))
+		self.transactions += 1
+		if r.expected == 0:
+			self.complete(r, [])
+			return True
+		r.deadline = now + r.timeout
+		self.current = r
+		return True
+	#
+
+	# Reads what has arrived and completes the transaction in progress if it can, must be called on the loop thread
+	# Returns True if anything arrived
+	def service(self, now):
+		n = self.ser.inWaiting()
+		if n > 0:
+			self.buffer += self.ser.read(n)
+		while self.stale > 0 and self.terminator in self.buffer:
+			self.buffer = self.buffer.split(self.terminator, 1)[1] # A late response, drop it
+			self.stale -= 1
+		r = self.current
+		while r != None and self.terminator in self.buffer:
+			line, self.buffer = self.buffer.split(self.terminator, 1)
+			line = line.strip()
+			r.lines += 1
+			if self.separator != None and r.expected > 1:
+				r.responses += line.split(self.separator) if line != "" else []
+			else:
+				r.responses.append(line)
+			if len(r.responses) >= r.expected:
+				self.current = None
+				self.complete(r, r.responses[:r.expected])
+				r = None
+		if r != None and now > r.deadline:
+			# Timed out, the responses may still come, they are dropped as they arrive (the partial
+			# line in the buffer is the first of them) and the next transaction waits for them
+			self.timeouts += 1
+			self.current = None
+			self.stale += self.response_lines(r) - r.lines
+			self.stale_until = now + self.stale*max(r.timeout, serial_command_timeout) # Allowing for each of them
+			self.complete(r, r.responses + [None]*(r.expected - len(r.responses)))
+		elif r == None and self.current == None and self.stale == 0:
+			self.buffer = '' # Nothing is expected, discard it
+		return n > 0
+	#
+
+	# Completes every transaction queued or in progress with no responses, must hold the loop lock
+	def fail_all(self):
+		pending = ([self.current] if self.current != None else []) + list(self.pending)
+		self.current = None
+		self.pending.clear()
+		for r in pending:
+			self.complete(r, [None]*r.expected)
+	#
+
+	def complete(self, r, responses):
+		r.result = [x if x != "" else None for x in responses]
+		r.done.set()
+		if r.callback != None:
+			try:
+				r.callback(r.result)
+			except Exception as e:
+				print "serial_loop : callback for " + ";".join(r.commands) + " failed"
+				print str(e)
+	#
+
+	# Returns a one line summary of the transactions of the port
+	def summary(self):
+		return "%d transactions, %d timed out, %d queued"%(self.transactions, self.timeouts, len(self.pending))
+	#
+# end loop_port
+
+# The serial loop, see above, use get_serial_loop() for the shared instance
+class serial_loop():
+	def __init__(self, tick=serial_loop_tick):
+		self.tick = tick
+		self.ports = []
+		self.lock = threading.RLock() # Callbacks may queue the next transaction
+		self.wake = threading.Event()
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name="serial loop")
+		self.thread.daemon = True
+		self.thread.start()
+	#
+
+	# Adds the port %ser, returns its loop_port, see loop_port for the arguments
+	def add_port(self, ser, separator=None, terminator='\r\n'):
+		p = loop_port(self, ser, separator, terminator)
+		with self.lock:
+			self.ports = self.ports + [p]
+		return p
+	#
+
+	# Removes the loop_port %p, its queued transactions are completed with no responses
+	def remove_port(self, p):
+		with self.lock:
+			self.ports = [x for x in self.ports if x != p]
+			p.removed = True
+			p.fail_all()
+	#
+
+	# Queues the serial_request %r on the loop_port %p, or completes it with no responses if the port
+	# is closed or removed or the loop has stopped, as reading a closed port gives nothing
+	def submit(self, p, r):
+		with self.lock:
+			if p.removed or not self.running or not p.ser.isOpen():
+				p.complete(r, [None]*r.expected)
+				return
+			p.pending.append(r)
+		self.wake.set()
+	#
+
+	def run(self):
+		while self.running:
+			busy = False
+			now = monotonic_time()
+			for p in self.ports:
+				with self.lock:
+					try:
+						if not p.ser.isOpen():
+							p.fail_all()
+							continue
+						busy = p.service(now) or busy
+						busy = p.start_next(now) or busy
+					except Exception as e:
+						print "serial_loop : error on a serial port"
+						print str(e)
+			if not busy:
+				self.wake.wait(self.tick)
+				self.wake.clear()
+		with self.lock:
+			for p in self.ports:
+				p.fail_all()
+	#
+
+	# Returns the summaries of the ports, one line each
+	def stats(self):
+		return [p.summary() for p in self.ports]
+	#
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+		self.wake.set()
+		if self.thread != threading.current_thread():
+			self.thread.join(1.0)
+	#
+# end serial_loop
+
+# Returns the serial loop shared by all the serial instruments, started on first use and stopped at exit
+serial_loop_instance = None
+serial_loop_lock = threading.Lock()
+def get_serial_loop():
+	global serial_loop_instance
+	with serial_loop_lock:
+		if serial_loop_instance == None:
+			serial_loop_instance = serial_loop()
+			atexit.register(serial_loop_instance.stop)
+	return serial_loop_instance
+# end get_serial_loop
+
+# An in-process stand in for a serial port with a LakeShore 625 on it, for testing and benchmarking
+# without the instrument. It answers RDGI?, RDGV?, RDGF?, SETI?, RATE? and takes SETI and RATE, several
+# queries may be joined with ';'. The output current ramps to the setpoint at the ramp rate.
+# The timing is that of the real link: the bytes take 10 bits each at %baudrate both ways and the
+# instrument takes %latency seconds to answer a message, the responses arrive a byte at a time
+#
+# Can be passed as the port of lakeshore_625, with the serial loop or without it
+class loopback_lakeshore_625():
+	def __init__(self, baudrate=9600, latency=0.01, timeout=0.05):
+		self.byte_time = 10.0/baudrate
+		self.latency = latency
+		self.timeout = timeout
+		self.open = True
+		self.lock = threading.Lock()
+		self.output = collections.deque() # (time the first byte arrives, response)
+		self.busy_until = 0.0 # The link is busy sending until then
+		self.setpoint = 0.0
+		self.rate = 0.1 # Amps per second
+		self.current0 = 0.0
+		self.t0 = monotonic_time()
+	#
+
+	def isOpen(self):
+		return self.open
+	#
+
+	def close(self):
+		self.open = False
+	#
+
+	# The output current at %t, ramping from current0 at t0 toward the setpoint
+	def current(self, t):
+		step = self.rate*(t - self.t0)
+		if abs(self.setpoint - self.current0) <= step:
+			return self.setpoint
+		return self.current0 + step*(1.0 if self.setpoint > self.current0 else -1.0)
+	#
+
+	# Returns the response to one command, None if it has none
+	def answer(self, command, t):
+		parts = command.strip().split(None, 1)
+		if len(parts) == 0:
+			return None
+		name = parts[0].upper()
+		if name == "RDGI?":
+			return "%+.4f"%self.current(t)
+		if name == "RDGV?":
+			return "%+.4f"%(0.0116*self.current(t))
+		if name == "RDGF?":
+			return "%+.4f"%(self.current(t)*current_to_field*1.0e-4)
+		if name == "SETI?":
+			return "%+.4f"%self.setpoint
+		if name == "RATE?":
+			return "%.4f"%self.rate
+		if name in ("SETI", "RATE") and len(parts) > 1:
+			self.current0 = self.current(t)
+			self.t0 = t
+			if name == "SETI":
+				self.setpoint = float(parts[1])
+			else:
+				self.rate = float(parts[1])
+		return None
+	#
+
+	def write(self, data):
+		now = monotonic_time()
+		with self.lock:
+			start = max(now, self.busy_until)
+			for message in data.split('\r\n')[:-1]:
+				start += (len(message) + 2)*self.byte_time
+				answers = [self.answer(c, start) for c in message.split(';')]
+				answers = [a for a in answers if a != None]
+				if len(answers) > 0:
+					response = ";".join(answers) + "\r\n"
+					start += self.latency
+					self.output.append((start, response))
+					start += len(response)*self.byte_time
+			self.busy_until = start
+		return len(data)
+	#
+
+	# Returns the number of bytes that have arrived
+	def inWaiting(self):
+		now = monotonic_time()
+		n = 0
+		with self.lock:
+			for t, response in self.output:
+				if now < t:
+					break
+				n += min(len(response), int((now - t)/self.byte_time) + 1)
+		return n
+	#
+
+	# Reads up to %size bytes, waiting up to the timeout for them
+	def read(self, size=1):
+		out = ''
+		deadline = monotonic_time() + (self.timeout if self.timeout != None else 1.0e9)
+		while True:
+			n = min(size - len(out), self.inWaiting())
+			with self.lock:
+				while n > 0:
+					t, response = self.output[0]
+					part = response[:n]
+					out += part
+					n -= len(part)
+					if len(part) == len(response):
+						self.output.popleft()
+					else:
+						self.output[0] = (t + len(part)*self.byte_time, response[len(part):])
+			if len(out) >= size or monotonic_time() >= deadline:
+				return out
+			time.sleep(self.byte_time)
+	#
+
+	# Reads a line, waiting up to the timeout, as serial.Serial.readline
+	def readline(self):
+		out = ''
+		deadline = monotonic_time() + (self.timeout if self.timeout != None else 1.0e9)
+		while not out.endswith('\n'):
+			out += self.read(1) if self.inWaiting() > 0 else ''
+			if monotonic_time() >= deadline:
+				break
+			if not out.endswith('\n') and self.inWaiting() == 0:
+				time.sleep(self.byte_time)
+		return out
+	#
+
+	# Drops the bytes that have arrived
+	def flushInput(self):
+		now = monotonic_time()
+		with self.lock:
+			while len(self.output) > 0 and self.output[0][0] <= now:
+				self.output.popleft()
+	#
+# end loopback_lakeshore_625
@@ -10,8 +10,17 @@
 # All Rights Reserved
 
 from parameters import *
+from datafiles import *
 
 import threading
+import Queue
+import collections
+import heapq
+import atexit
+import json
+import parameters
+import ctypes
+import ctypes.util
 import numpy as np
 import sys
 import os
@@ -29,17 +38,121 @@ def type_index(type):
 
 # Removes all elements from the given data queue
 # %q is the input queue, containing data in numpy format
+# Blocks of raw data from the card (see raw_block) are not merged, they are returned as a list
 def dequeue_all(q):
 	try:
-		d = q.get()
+		d = [q.get()]
 		while(not q.empty()):
-			d = np.append(d,q.get(),axis=0)
-		return d
+			d.append(q.get())
+		return merge_blocks(d)
 	except Exception as e:
 		print "Utilities.dequeue_all : Could not read Queue"
 		print str(e)
 # end dequeue_all
 
+# Merges a list of blocks of numpy data into one array with a single copy
+# Blocks of raw data from the card (see raw_block) are not merged, if there are any the list is returned as is
+def merge_blocks(blocks):
+	if len(blocks) == 0 or any(isinstance(b, raw_block) for b in blocks):
+		return blocks
+	if len(blocks) == 1:
+		return blocks[0]
+	return np.concatenate(blocks, axis=0)
+# end merge_blocks
+
+# Returns the size in bytes and in rows of an item from a data queue
+def item_size(d):
+	if isinstance(d, raw_block):
+		return d.codes.nbytes, d.codes.shape[0]
+	if isinstance(d, np.ndarray):
+		return d.nbytes, d.shape[0] if d.ndim > 0 else 1
+	return len(str(d)), 1
+# end item_size
+
+# Takes the items of a data queue in batches bounded in size, so that a consumer that has fallen
+# behind catches up in steps of bounded time and memory instead of taking the whole backlog at once
+# Keeps statistics of the queue depth, the bytes taken but not yet written and the drain latency
+#
+# %q is the queue to drain
+# %max_bytes is the largest size of a batch in bytes, a batch always holds at least one item
+# %max_rows is the largest number of rows in a batch
+#
+# Usage: batch = drain.get_batch(), write the batch, then drain.done()
+class queue_drain():
+	def __init__(self, q, max_bytes=drain_max_bytes, max_rows=drain_max_rows):
+		self.q = q
+		self.max_bytes = max_bytes
+		self.max_rows = max_rows
+		self.depth = 0 # Items left in the queue after the last batch
+		self.max_depth = 0
+		self.bytes_in_flight = 0 # Bytes taken from the queue and not yet written
+		self.batches = 0
+		self.items = 0
+		self.bytes = 0
+		self.latency = 0.0 # Time from the start of the last batch to done()
+		self.max_latency = 0.0
+		self.total_latency = 0.0
+		self.started = None
+	#
+	
+	# Takes items from the queue without waiting until it is empty or the batch is full, returns them as a list
+	def get_batch(self):
+		self.started = time.time()
+		batch = []
+		nbytes = 0
+		rows = 0
+		while nbytes < self.max_bytes and rows < self.max_rows:
+			try:
+				d = self.q.get_nowait()
+			except Queue.Empty:
+				break
+			b, r = item_size(d)
+			nbytes += b
+			rows += r
+			batch.append(d)
+		self.depth = self.q.qsize()
+		self.max_depth = max(self.max_depth, self.depth)
+		self.bytes_in_flight = nbytes
+		self.items += len(batch)
+		self.bytes += nbytes
+		if len(batch) == 0:
+			self.started = None
+		return batch
+	#
+	
+	# Takes a batch of numpy data and merges it, see merge_blocks, returns None if the queue is empty
+	def get_merged(self):
+		batch = self.get_batch()
+		if len(batch) == 0:
+			return None
+		return merge_blocks(batch)
+	#
+	
+	# Marks the last batch as written, empty batches are not counted
+	def done(self):
+		if self.started == None:
+			return
+		self.latency = time.time() - self.started
+		self.max_latency = max(self.max_latency, self.latency)
+		self.total_latency += self.latency
+		self.batches += 1
+		self.bytes_in_flight = 0
+		self.started = None
+	#
+	
+	# Returns True if the last batch left items in the queue
+	def backlogged(self):
+		return self.depth > 0
+	#
+	
+	# Returns a one line summary of the statistics
+	def summary(self):
+		mean = self.total_latency/self.batches if self.batches > 0 else 0.0
+		return "%d batches, %d items, %.1f MB, depth %d (max %d), %d bytes in flight, latency mean %.3f s, max %.3f s"%(
+			self.batches, self.items, self.bytes/1048576.0, self.depth, self.max_depth, self.bytes_in_flight, mean, self.max_latency)
+	#
+# end queue_drain
+
 # Removes all elements from the given data queue
 # %q is the input queue, containing data as strings
 def dequeue_str(q):
@@ -54,39 +167,674 @@ def dequeue_str(q):
 		print str(e)
 # end dequeue_str
 
+# A preallocated ring buffer of numpy rows, written by a single producer and read by any number of
+# ring_reader objects, each with its own cursor. The producer never waits for the readers, a reader
+# that falls more than one buffer behind is told how many rows it lost.
+#
+# %rows is the capacity of the buffer in rows
+# %columns is the number of columns in each row
+# %max_write is the largest number of rows the producer writes at once, rows that close to the write
+# position are treated as already lost because the next write may be overwriting them
+class ring_buffer():
+	def __init__(self, rows, columns, max_write, dtype=np.float64):
+		if max_write >= rows:
+			raise ValueError("ring_buffer : max_write must be smaller than the number of rows")
+		self.rows = int(rows)
+		self.columns = columns
+		self.max_write = int(max_write)
+		self.data = np.zeros((self.rows, columns), dtype=dtype)
+		self.written = 0 # Total number of rows ever committed, the write cursor
+	#
+	
+	# Returns a writeable view of up to %n rows at the write position, stops short at the end of
+	# the storage so it may be shorter than %n. Call commit() once the rows are filled in
+	def write_view(self, n):
+		start = self.written % self.rows
+		return self.data[start:min(start + n, self.rows)]
+	#
+	
+	# Publishes %n rows filled in through write_view() to the readers
+	def commit(self, n):
+		self.written += n
+	#
+	
+	# Copies the rows of %block into the buffer and publishes them
+	def write(self, block):
+		n = 0
+		while n < block.shape[0]:
+			v = self.write_view(block.shape[0] - n)
+			v[:] = block[n:n+v.shape[0]]
+			n += v.shape[0]
+			self.commit(v.shape[0])
+	#
+	
+	# Returns a new reader starting at the current write position
+	def reader(self):
+		return ring_reader(self)
+	#
+# end ring_buffer
+
+# A reader of a ring_buffer with its own cursor
+# Views returned by read() point into the buffer and are not copied, they stay valid until the producer
+# comes around again, use valid() to check a view after processing it
+class ring_reader():
+	def __init__(self, ring):
+		self.ring = ring
+		self.cursor = ring.written
+		self.lost = 0 # Total number of rows lost to overruns
+	#
+	
+	# Returns the number of rows waiting to be read
+	def available(self):
+		return self.ring.written - self.cursor
+	#
+	
+	# Returns (view, lost) where view holds up to %max_rows of the next contiguous unread rows and lost
+	# is the number of rows that were skipped because this reader fell behind, zero unless it overran
+	def read(self, max_rows=None):
+		ring = self.ring
+		written = ring.written
+		lost = 0
+		if written - self.cursor > ring.rows - ring.max_write:
+			lost = written - self.cursor - (ring.rows - ring.max_write)
+			self.cursor += lost
+			self.lost += lost
+		start = self.cursor % ring.rows
+		n = min(written - self.cursor, ring.rows - start)
+		if max_rows != None:
+			n = min(n, max_rows)
+		self.cursor += n
+		return ring.data[start:start+n], lost
+	#
+	
+	# Returns (views, lost) with all unread rows as a list of at most two contiguous views
+	def read_all(self):
+		views = []
+		lost = 0
+		while self.available() > 0:
+			v, l = self.read()
+			lost += l
+			views.append(v)
+		return views, lost
+	#
+	
+	# Returns (blocks, lost) as read_all but with the rows copied out of the ring, so they stay valid however
+	# long they are kept. Rows that the producer may have overwritten while they were copied are dropped,
+	# the oldest first, and counted as lost
+	def read_all_copy(self):
+		views, lost = self.read_all()
+		rows = sum([v.shape[0] for v in views])
+		blocks = [v.copy() for v in views]
+		ring = self.ring
+		over = min(ring.written + ring.max_write - (self.cursor - rows) - ring.rows, rows)
+		if over > 0:
+			lost += over
+			self.lost += over
+			while over > 0:
+				n = min(over, blocks[0].shape[0])
+				blocks[0] = blocks[0][n:]
+				over -= n
+				if blocks[0].shape[0] == 0:
+					blocks.pop(0)
+		return blocks, lost
+	#
+	
+	# Returns False if the rows behind the cursor returned by the last read may have been overwritten
+	# by the producer since, %rows is the number of rows read
+	def valid(self, rows):
+		return self.ring.written + self.ring.max_write - (self.cursor - rows) <= self.ring.rows
+	#
+# end ring_reader
+
+# Converts raw 16 bit codes from the card to volts in one vectorized step
+# %codes is a (scans, channels) array of raw codes
+# %coeffs is a (channels, order) array of polynomial scaling coefficients for each channel,
+# volts = coeffs[:,0] + coeffs[:,1]*code + coeffs[:,2]*code**2 + ...
+# Returns a float array the same shape as codes, written into %out if given
+def scale_raw(codes, coeffs, out=None):
+	if out is None:
+		out = np.empty(codes.shape, dtype=np.float64)
+	out[:] = coeffs[:,-1]
+	for k in range(coeffs.shape[1]-2, -1, -1):
+		out *= codes
+		out += coeffs[:,k]
+	return out
+# end scale_raw
+
+# A block of unscaled data from the card, a quarter of the size of the equivalent voltage block
+# %count is the number of samples acquired before the block, %codes the (scans, channels) raw codes,
+# %coeffs the scaling coefficients of the run (see scale_raw) and %freq the sample frequency
+class raw_block():
+	def __init__(self, count, codes, coeffs, freq):
+		self.count = count
+		self.codes = codes
+		self.coeffs = coeffs
+		self.freq = freq
+	#
+	
+	# Returns the block in volts in the same (scans, channels+1) layout as the voltage data, time first
+	def volts(self):
+		pts = self.codes.shape[0]
+		d = np.empty((pts, self.codes.shape[1]+1), dtype=np.float64)
+		d[:,0] = np.arange(self.count+1, self.count+pts+1, dtype=np.float64)
+		d[:,0] /= self.freq
+		scale_raw(self.codes, self.coeffs, out=d[:,1:])
+		return d
+	#
+# end raw_block
+
+# Keeps running statistics of the intervals between successive calls to tick(), used to measure
+# the jitter of periodic tasks such as polling the card
+# %expected is the nominal interval in seconds, if given late() counts intervals more than twice as long
+class interval_stats():
+	def __init__(self, expected=None):
+		self.expected = expected
+		self.reset()
+	#
+	
+	# Clears the statistics
+	def reset(self):
+		self.last = None
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.max = 0.0
+		self.late = 0
+	#
+	
+	# Records the time now, or the given time %t in seconds
+	def tick(self, t=None):
+		if t == None:
+			t = time.time()
+		if self.last != None:
+			dt = t - self.last
+			self.count += 1
+			delta = dt - self.mean
+			self.mean += delta/self.count
+			self.m2 += delta*(dt - self.mean)
+			self.max = max(self.max, dt)
+			if self.expected != None and dt > 2.0*self.expected:
+				self.late += 1
+		self.last = t
+	#
+	
+	# Returns the standard deviation of the intervals, the jitter
+	def jitter(self):
+		if self.count < 2:
+			return 0.0
+		return np.sqrt(self.m2/(self.count - 1))
+	#
+	
+	# Returns a one line summary of the statistics
+	def summary(self):
+		return "%d intervals, mean %.6f s, jitter %.6f s, max %.6f s, %d late"%(self.count, self.mean, self.jitter(), self.max, self.late)
+	#
+# end interval_stats
+
+# Returns the time in seconds from a monotonic high resolution clock of the host, one that is never set
+# back or slewed like the time of day. On Windows time.clock() is the performance counter, elsewhere
+# it is the processor time, so clock_gettime(CLOCK_MONOTONIC) is used instead where it is available
+if sys.platform == "win32":
+	monotonic_time = time.clock
+else:
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+	def find_clock_gettime():
+		for lib in (ctypes.util.find_library('rt'), ctypes.util.find_library('c')):
+			try:
+				return ctypes.CDLL(lib).clock_gettime
+			except (OSError, AttributeError, TypeError):
+				pass
+		return None
+	clock_gettime = find_clock_gettime()
+	CLOCK_MONOTONIC = 6 if sys.platform == "darwin" else 1
+	def monotonic_time():
+		t = timespec()
+		if clock_gettime == None or clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+			return time.time()
+		return t.tv_sec + t.tv_nsec*1e-9
+# end monotonic_time
+
+# Estimates the relation between the host clock and the sample clock of a DAQ card, which drift apart
+# by up to tens of parts per million, from the sample count at the arrival of each block of data.
+# The time of arrival is later than the last sample was clocked by a varying delay, so from each
+# clock_fit_interval only the arrival with the least delay is kept, and a line is fitted through the last
+# clock_fit_points of them. card_time() then gives the card time of any host time
+#
+# %sample_freq is the sample frequency of the card
+class card_clock():
+	def __init__(self, sample_freq):
+		self.sample_freq = float(sample_freq)
+		self.lock = threading.RLock()
+		self.reset()
+	#
+
+	# Starts again from card time zero at the host time now
+	def reset(self):
+		with self.lock:
+			self.host_zero = monotonic_time()
+			self.hosts = [] # Host times since host_zero of the arrivals kept
+			self.cards = [] # Card times of the arrivals kept
+			self.bucket = None # Start of the current clock_fit_interval
+			self.offset = 0.0 # Card time at host_zero
+			self.rate = 1.0 # Card seconds per host second
+			self.residual_rms = 0.0
+			self.residual_max = 0.0
+	#
+
+	# Records that %count samples had been clocked when a block arrived at host time %host, now if None
+	def observe(self, count, host=None):
+		if host == None:
+			host = monotonic_time()
+		with self.lock:
+			h = host - self.host_zero
+			c = count/self.sample_freq
+			if self.bucket != None and h - self.bucket < clock_fit_interval:
+				if c - h > self.cards[-1] - self.hosts[-1]: # Less delay than the arrival kept
+					self.hosts[-1] = h
+					self.cards[-1] = c
+			else:
+				self.bucket = h
+				self.hosts.append(h)
+				self.cards.append(c)
+				if len(self.hosts) > clock_fit_points:
+					del self.hosts[0]
+					del self.cards[0]
+			if len(self.hosts) >= 2:
+				self.fit()
+	#
+
+	# Fits the line through the arrivals kept, called holding the lock
+	def fit(self):
+		h = np.array(self.hosts)
+		c = np.array(self.cards)
+		hm = h.mean()
+		cm = c.mean()
+		var = ((h - hm)**2).sum()
+		if var <= 0:
+			return
+		self.rate = ((h - hm)*(c - cm)).sum()/var
+		self.offset = cm - self.rate*hm
+		r = c - (cm + self.rate*(h - hm))
+		self.residual_rms = np.sqrt((r**2).mean())
+		self.residual_max = np.abs(r).max()
+	#
+
+	# Returns the card time at host time %host (see monotonic_time), now if None
+	def card_time(self, host=None):
+		if host == None:
+			host = monotonic_time()
+		with self.lock:
+			return self.offset + self.rate*(host - self.host_zero)
+	#
+
+	# Returns the drift of the card clock from the host clock in parts per million
+	def drift_ppm(self):
+		return (self.rate - 1.0)*1e6
+	#
+
+	# Returns a one line summary of the fit
+	def summary(self):
+		return "%d points, drift %.2f ppm, offset %.6f s, residual rms %.1f us, max %.1f us"%(len(self.hosts),
+			self.drift_ppm(), self.offset, 1e6*self.residual_rms, 1e6*self.residual_max)
+	#
+# end card_clock
+
 # A stopwatch for timing peripheral functions (i.e. those not from the DAQ card)
-# Based off of system time but can be synchronized by calling the zero() method
+# Based off of the monotonic host clock but can be synchronized by calling the zero() method
+# Once a card_clock is given with set_clock(), the stopwatch gives the card time, so that peripheral data
+# is timed on the time base of the card data and follows the drift of the card clock
 class Stopwatch():
 	def __init__(self):
-		self.start_time = time.clock()
+		self.start_time = monotonic_time()
+		self.clock = None
 	#
 	def time(self):
-		return time.clock() - self.start_time
+		if self.clock != None:
+			return self.clock.card_time()
+		return monotonic_time() - self.start_time
 	#
 	def zero(self):
-		self.start_time = time.clock()
+		self.start_time = monotonic_time()
+	#
+	# Times from the card clock %clock, or from the host clock again if None
+	def set_clock(self, clock):
+		self.clock = clock
 	#
 # end Stopwatch
 
+# Periodic jobs
+# Every periodic poller (the card, the serial instruments, the data writer) registers a job with one
+# scheduler instead of each starting a new threading.Timer every cycle. The scheduler keeps the jobs in a
+# heap by deadline on the monotonic clock and hands each job to a small fixed pool of worker threads when
+# its deadline comes. The deadlines are fixed multiples of the interval from the start, so time spent
+# running a job does not add up as drift. A job is never run twice at once, a deadline that comes while it
+# is still running is an overrun and is skipped, and deadlines missed altogether are coalesced into one run.
+# A job that returns True has more work waiting (e.g. a backlogged queue) and is run again right away.
+#
+# Example:
+#	job = get_scheduler().add(self.read_data, 0.25, "LakeShore 625")
+#	...
+#	job.cancel() # Waits for a run in progress to finish
+
+# A job of the scheduler, see scheduler.add
+class scheduled_job():
+	def __init__(self, func, interval, name):
+		self.func = func
+		self.interval = float(interval)
+		self.name = name
+		self.cond = threading.Condition()
+		self.busy = False # Queued or running on a worker
+		self.cancelled = False
+		self.thread = None # The worker running the job
+		self.runs = 0
+		self.overruns = 0 # Deadlines that came while the job was still running
+		self.missed = 0 # Deadlines passed before the scheduler got to them, coalesced
+		self.late_sum = 0.0 # Seconds from the deadlines to the starts of the runs
+		self.late_max = 0.0
+		self.timing = interval_stats(self.interval)
+	#
+
+	# Runs the job on a worker, %deadline is the time it was due
+	def execute(self, deadline):
+		start = monotonic_time()
+		self.thread = threading.current_thread()
+		self.runs += 1
+		self.late_sum += start - deadline
+		self.late_max = max(self.late_max, start - deadline)
+		self.timing.tick(start)
+		try:
+			while not self.cancelled and self.func() == True:
+				pass
+		except Exception as e:
+			print "scheduler : job " + str(self.name) + " failed"
+			print str(e)
+		finally:
+			with self.cond:
+				self.busy = False
+				self.thread = None
+				self.cond.notify_all()
+	#
+
+	# Stops the job, if %wait then waits for a run in progress to finish unless called from the job itself
+	def cancel(self, wait=True):
+		with self.cond:
+			self.cancelled = True
+			if wait:
+				while self.busy and self.thread != threading.current_thread():
+					self.cond.wait()
+	#
+
+	# Returns a one line summary of the timing of the job
+	def summary(self):
+		late = self.late_sum/self.runs if self.runs > 0 else 0.0
+		return "%s : every %.3f s, %d runs, late mean %.6f s max %.6f s, jitter %.6f s, %d overruns, %d missed"%(
+			self.name, self.interval, self.runs, late, self.late_max, self.timing.jitter(), self.overruns, self.missed)
+	#
+# end scheduled_job
+
+# Runs periodic jobs on a pool of %workers threads, see above
+class scheduler():
+	def __init__(self, workers=scheduler_workers):
+		self.cond = threading.Condition()
+		self.heap = []
+		self.count = 0 # Breaks ties in the heap
+		self.jobs = []
+		self.running = True
+		self.work = Queue.Queue()
+		self.threads = []
+		for i in range(workers):
+			t = threading.Thread(target=self.work_loop, name="scheduler worker " + str(i))
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+		self.thread = threading.Thread(target=self.run, name="scheduler")
+		self.thread.daemon = True
+		self.thread.start()
+	#
+
+	# Adds a job calling %func every %interval seconds, starting after %delay seconds, returns the job
+	def add(self, func, interval, name=None, delay=0.0):
+		if interval <= 0:
+			raise ValueError("scheduler.add : interval must be positive")
+		job = scheduled_job(func, interval, name if name != None else getattr(func, '__name__', 'job'))
+		with self.cond:
+			self.jobs.append(job)
+			self.push(monotonic_time() + delay, job)
+			self.cond.notify()
+		return job
+	#
+
+	# Adds %job to the heap at %deadline, must hold the lock
+	def push(self, deadline, job):
+		self.count += 1
+		heapq.heappush(self.heap, (deadline, self.count, job))
+	#
+
+	# Hands the jobs to the workers as they come due
+	def run(self):
+		with self.cond:
+			while self.running:
+				if len(self.heap) == 0:
+					self.cond.wait()
+					continue
+				now = monotonic_time()
+				deadline, count, job = self.heap[0]
+				if deadline > now:
+					self.cond.wait(deadline - now)
+					continue
+				heapq.heappop(self.heap)
+				if job.cancelled:
+					self.jobs.remove(job)
+					continue
+				with job.cond:
+					if job.busy:
+						job.overruns += 1
+					else:
+						job.busy = True
+						self.work.put((job, deadline))
+				missed = int((now - deadline)//job.interval)
+				job.missed += missed
+				self.push(deadline + (missed + 1)*job.interval, job)
+	#
+
+	def work_loop(self):
+		while True:
+			item = self.work.get()
+			if item == None:
+				return
+			item[0].execute(item[1])
+	#
+
+	# Returns the summaries of the jobs, one line each
+	def stats(self):
+		with self.cond:
+			return [job.summary() for job in self.jobs]
+	#
+
+	# Cancels every job and stops the threads
+	def stop(self):
+		with self.cond:
+			jobs = list(self.jobs)
+			self.running = False
+			self.cond.notify()
+		for job in jobs:
+			job.cancel()
+		for t in self.threads:
+			self.work.put(None)
+		for t in self.threads + [self.thread]:
+			if t != threading.current_thread():
+				t.join(1.0)
+	#
+# end scheduler
+
+# Returns the scheduler shared by all the pollers, started on first use and stopped at exit
+scheduler_instance = None
+scheduler_lock = threading.Lock()
+def get_scheduler():
+	global scheduler_instance
+	with scheduler_lock:
+		if scheduler_instance == None:
+			scheduler_instance = scheduler()
+			atexit.register(scheduler_instance.stop)
+	return scheduler_instance
+# end get_scheduler
+
+# Returns the values of the global parameters that can be written as JSON, as a dictionary
+def parameter_snapshot():
+	snapshot = {}
+	for name, value in vars(parameters).items():
+		if name.startswith('_'):
+			continue
+		try:
+			json.dumps(value)
+		except (TypeError, ValueError):
+			continue
+		snapshot[name] = value
+	return snapshot
+# end parameter_snapshot
+
 # Sets up the terminal output to be saved to file in the data directory as well as echoed in the local terminal
 # One log file per day, with the date in the file name
+#
+# Printing never waits on the terminal or the disk, the lines are queued and written out in batches by a
+# background thread every logger_flush_interval seconds. If more than logger_max_lines writes are waiting
+# the new ones are dropped and their lines counted, and the count is written to the log once there is room. When the file
+# grows past logger_max_bytes it is renamed with the suffix .1 (older files move up to .2 and so on, keeping
+# logger_backups of them) and a new file is started. close() writes out what is waiting, it is also called
+# at exit
 class Logger(object):
 	def __init__(self):
 		self.terminal = sys.stdout
 		self.filename = data_dir_path + time.strftime("%Y_%m_%d.log")
-		self.log = open(self.filename, "a")
-		self.log.write("######################" + time.strftime("[%Y/%m/%d %H:%M:%S]") +"######################\n")
+		self.log = open(self.filename, "a") # None after an error, opened again for the next lines
+		self.log_closed = False
+		self.log_failing = False # The last write to the file failed, the error has been reported
+		self.size = self.log.tell()
+		self.lines = collections.deque()
+		self.lock = threading.Lock()
+		self.out_lock = threading.Lock()
+		self.wake = threading.Event()
+		self.dropped = 0 # Lines dropped since the last were reported
+		self.total_dropped = 0
+		self.running = True
+		self.write("######################" + time.strftime("[%Y/%m/%d %H:%M:%S]") +"######################\n")
+		self.thread = threading.Thread(target=self.run, name="Logger")
+		self.thread.daemon = True
+		self.thread.start()
+		atexit.register(self.close)
 
 	def write(self, message):
-		self.terminal.write(message)
-		self.log.write(message)
+		if not self.running: # Closing or closed, write it out directly, to the file until it is closed
+			with self.lock:
+				self.lines.append(message)
+			self.write_out()
+			return
+		with self.lock:
+			if len(self.lines) >= logger_max_lines:
+				n = message.count("\n")
+				self.dropped += n
+				self.total_dropped += n
+				return
+			self.lines.append(message)
+			if len(self.lines) == logger_max_lines//2: # Write out early when filling up
+				self.wake.set()
+
+	# Asks the background thread to write out what is waiting, without waiting for it
+	def flush(self):
+		self.wake.set()
+
+	def run(self):
+		while self.running:
+			self.wake.wait(logger_flush_interval)
+			self.wake.clear()
+			self.write_out()
+		self.write_out()
+
+	# Writes out the lines waiting, to the terminal and the file, one call at a time so they stay in order
+	def write_out(self):
+		with self.out_lock:
+			with self.lock:
+				lines = self.lines
+				self.lines = collections.deque()
+				dropped = self.dropped
+				self.dropped = 0
+			if dropped > 0:
+				if len(lines) > 0 and not lines[-1].endswith("\n"):
+					lines.append("\n")
+				lines.append("Logger : " + str(dropped) + " lines dropped, printing faster than they could be written\n")
+			if len(lines) == 0:
+				return
+			text = "".join(lines)
+			try:
+				self.terminal.write(text)
+				self.terminal.flush()
+			except (IOError, AttributeError): # No terminal, e.g. run with pythonw
+				pass
+			if self.log_closed:
+				return
+			try:
+				if self.log == None:
+					self.log = open(self.filename, "a")
+					self.size = self.log.tell()
+				self.log.write(text)
+				self.log.flush()
+				self.size += len(text)
+				if self.size > logger_max_bytes:
+					self.rotate()
+				self.log_failing = False
+			except Exception as e:
+				self.log_error(e)
+
+	# Drops the file after an error writing it, it is opened again for the next lines, reports the first
+	# error of a run of them on the terminal
+	def log_error(self, e):
+		try:
+			self.log.close()
+		except Exception:
+			pass
+		self.log = None
+		if not self.log_failing:
+			self.log_failing = True
+			try:
+				self.terminal.write("Logger : Could not write " + self.filename + ", printing to the terminal only until it can be written\n" + str(e) + "\n")
+			except (IOError, AttributeError):
+				pass
+
+	# Moves the file to the suffix .1, older files up by one, and starts a new one
+	def rotate(self):
+		self.log.close()
+		for i in range(logger_backups, 0, -1):
+			old = self.filename + "." + str(i)
+			if os.path.isfile(old):
+				if i == logger_backups:
+					os.remove(old)
+				else:
+					os.rename(old, self.filename + "." + str(i+1))
+		os.rename(self.filename, self.filename + ".1")
+		self.log = open(self.filename, "a")
+		self.size = 0
+
+	# Writes out everything waiting and stops the background thread
+	def close(self):
+		if self.running:
+			self.running = False
+			self.wake.set()
+			self.thread.join()
+			with self.out_lock:
+				self.log_closed = True
+				if self.log != None:
+					try:
+						self.log.close()
+					except Exception as e:
+						self.log_error(e)
 # end Logger
 
 # Handles data writing, logging changes to parameters
 # Buffers changes if not recording
 #
-# %card is the data_queue from the main DAQ card, sends arrays of double precision data
-# if you are not using the card pass in None
+# %card is the data_queue from the main DAQ card, sends arrays of double precision data,
+# or a ring_reader on the card's ring buffer. If you are not using the card pass in None
 #
 # %other_data is a list of the data queues from other data sources, must be in order
 # specified in global parameter data_file_types
@@ -95,23 +843,38 @@ class Logger(object):
 #
 # % buffer is a boolean, if True then the data_writer will write down the buffer of changes that happened while not recording 
 #
+# The card data is written as text, or to a binary or compressed run file (see datafiles.py) if the global
+# parameter bnc_file_format is "binary" or "compressed", use set_card_info() to give the channel names and
+# sample frequency recorded in its header. The other data is written as text, or to compressed run files
+# if the global parameter other_file_format is "compressed"
+#
+# The files are written through a write-behind buffer (see datafiles.write_behind) if the global parameter
+# write_behind_enabled is True, flush_stats() gives its statistics
+#
+# %process is a boolean, if True the files are formatted and written by a separate writer process
+# (see writerproc.py) that is sent the data through shared memory, so that the disk and the formatting
+# do not hold up the acquisition. The default is the global parameter data_writer_process
+#
+# Each run is recorded in the run catalog of the data directory (see catalog.py) if the global parameter
+# run_catalog_enabled is True, which also gives the next run number
+#
 class data_writer(threading.Thread):
-	def __init__(self, card, other_data, stop_watch, buffer):
-		self.running = True
-		self.recording = False
-		self.data_files = None
-		self.change_log = None
-		self.run_number = "             "
-		self.change_buffer = []
-		self.timer = stop_watch
-		self.buffer = buffer
-		
-		# set up timing
+	def __init__(self, card, other_data, stop_watch, buffer, process=data_writer_process):
+		self.init_state(stop_watch, buffer)
 		
 		# set the data queues
 		self.card_data = card
 		self.other_data = other_data
 		self.num_other_data = len(other_data)
+		self.card_drain = None
+		if card != None and not isinstance(card, ring_reader):
+			self.card_drain = queue_drain(card)
+		self.other_drains = [queue_drain(q) for q in other_data]
+		if process:
+			from writerproc import writer_process
+			self.proc = writer_process(buffer)
+		if self.proc == None and write_behind_enabled:
+			self.flusher = write_behind()
 		if self.num_other_data != len(data_file_types) - 2:
 			print "data_writer.__init__ : Length of parameter other_data is inconsistent with length of global parameter data_file_types"
 		if self.num_other_data > len(data_file_types) - 2:
@@ -121,54 +884,149 @@ class data_writer(threading.Thread):
 		threading.Thread.__init__(self)
 	#
 	
+	# Sets up the state of the writer apart from the data queues, shared with writerproc.writer_files
+	# which writes the files in the writer process, %stop_watch and %buffer are as for data_writer
+	def init_state(self, stop_watch, buffer):
+		self.running = True
+		self.recording = False
+		self.data_files = None
+		self.change_log = None
+		self.run_number = "             "
+		self.change_buffer = []
+		self.timer = stop_watch
+		self.buffer = buffer
+		self.card_channels = None
+		self.card_freq = masterSampleFreq
+		self.proc = None
+		self.flusher = None
+		self.task = None
+		self.catalog = None
+		self.catalog_id = None
+		self.event_log = None
+		self.event_buffer = []
+		self.param_state = {}
+	#
+	
+	# Writes out the data every 0.5 s on the scheduler, see get_scheduler
 	def run(self):
 		if self.card_data == None:
-			self.write_out_other_data()
+			self.task = get_scheduler().add(self.write_out_other_data, 0.5, "data writer")
 		else:
-			self.write_out_data()
+			self.task = get_scheduler().add(self.write_out_data, 0.5, "data writer")
 	#
 	
 	# Writes the data out to file
+	# Returns True if any of the queues still holds data
 	def write_out_other_data(self):
-		if self.other_data != []:
-			for i in range(len(self.other_data)):
-				if not self.other_data[i].empty():
-					qd = dequeue_str(self.other_data[i])
-					if self.recording:
-						out = self.data_files[i+1]
-						for a in qd:
-							out.write(str(a) + "\n")
-		if self.running:
-			self.task = threading.Timer(0.5, self.write_out_other_data)
-			self.task.start()
+		return self.write_other_batches() and self.running
 	#
 	
 	# Writes the data out to file
+	# Takes at most one bounded batch from each queue per call, if a queue still holds data after
+	# its batch it returns True so that the scheduler calls it again right away
 	def write_out_data(self):
-		if not self.card_data.empty():
-			cd = dequeue_all(self.card_data)
-			if self.recording:
-				out = self.data_files[0]
-				for a in cd:
-					out.write("\t".join(str(x) for x in a) + "\n")
+		backlog = False
+		if isinstance(self.card_data, ring_reader):
+			views, lost = self.card_data.read_all_copy() # Copied, the writes are slower than the card
+			if lost > 0:
+				print "data_writer.write_out_data : Card data overran the ring buffer, " + str(lost) + " samples lost"
+			for cd in views:
+				self.write_card_data(cd)
+		else:
+			cd = self.card_drain.get_merged()
+			if isinstance(cd, list):
+				for b in cd:
+					self.write_card_data(b)
+			elif cd is not None:
+				self.write_card_data(cd)
+			self.card_drain.done()
+			backlog = self.card_drain.backlogged()
 		#
-		if self.other_data != []:
-			for i in range(len(self.other_data)):
-				if not self.other_data[i].empty():
-					qd = dequeue_str(self.other_data[i])
-					if self.recording:
-						out = self.data_files[i+1]
-						for a in qd:
-							out.write(str(a) + "\n")
-		if self.running:
-			self.task = threading.Timer(0.5, self.write_out_data)
-			self.task.start()
+		backlog = self.write_other_batches() or backlog
+		return backlog and self.running
+	#
+	
+	# Writes one batch from each of the other data queues, one write per file
+	# Returns True if any of the queues still holds data
+	def write_other_batches(self):
+		backlog = False
+		for i in range(len(self.other_drains)):
+			drain = self.other_drains[i]
+			qd = drain.get_batch()
+			if self.recording and len(qd) > 0:
+				text = "".join([str(a) + "\n" for a in qd])
+				if self.proc != None:
+					self.proc.write_text(i, text)
+				else:
+					self.data_files[i+1].write(text)
+			drain.done()
+			backlog = backlog or drain.backlogged()
+		return backlog
+	#
+	
+	# Returns a summary of the statistics of the queue drains, one line per queue
+	def drain_stats(self):
+		lines = []
+		if self.card_drain != None:
+			lines.append(str(data_file_types[0]) + " : " + self.card_drain.summary())
+		for i in range(len(self.other_drains)):
+			lines.append(str(data_file_types[i+1]) + " : " + self.other_drains[i].summary())
+		return lines
+	#
+	
+	# Writes a block of card data out to file if recording, %cd is an array of voltage data or a raw_block
+	def write_card_data(self, cd):
+		if self.recording:
+			if self.proc != None:
+				self.proc.write_block(cd)
+				return
+			out = self.data_files[0]
+			if isinstance(out, (binary_run_writer, compressed_run_writer)):
+				if isinstance(cd, raw_block):
+					out.write_raw(cd)
+				else:
+					out.write(cd)
+				return
+			if isinstance(cd, raw_block):
+				cd = cd.volts()
+			out.write(format_text_block(cd))
+	#
+	
+	# Sets the channel names and sample frequency of the card, which are written in the header of binary run files
+	def set_card_info(self, channel_names, sample_freq):
+		self.card_channels = channel_names
+		self.card_freq = sample_freq
+		if self.proc != None:
+			self.proc.post(('card_info', channel_names, sample_freq))
 	#
 	
+	# Stops writing, waits for a write in progress to finish and closes the files
 	def stop(self):
 		self.running = False
-		self.task.cancel()
-		self.close_files(self.data_files)
+		if self.task != None:
+			self.task.cancel()
+		if self.proc != None:
+			self.proc.close()
+		else:
+			self.close_run_files()
+		if self.flusher != None:
+			self.flusher.stop()
+	#
+	
+	# Returns a summary of the statistics of the write-behind buffer, see datafiles.write_behind
+	def flush_stats(self):
+		if self.proc != None:
+			return "write-behind buffer in the writer process"
+		if self.flusher == None:
+			return "write-behind buffer not used"
+		return self.flusher.summary()
+	#
+	
+	# Returns the function used to open the data files, through the write-behind buffer if it is used
+	def file_opener(self):
+		if self.flusher != None:
+			return self.flusher.open
+		return open
 	#
 	
 	# Initializes the log file by writing out the parameters file
@@ -190,31 +1048,125 @@ class data_writer(threading.Thread):
 				f.close()
 	#
 
+	# Closes the files of the run being recorded, if any, and records its end in the run catalog
+	def close_run_files(self):
+		self.close_files(self.data_files)
+		if self.event_log != None:
+			self.event_log.close()
+		self.finish_catalog_run()
+		self.data_files = None
+		self.event_log = None
+	#
+
 	# Initialize output files for writing
 	# Returns a list of files, with types given by the parameter data_file_types,
+	# text files keep a time index file as they are written, see datafiles.indexed_text_file
+	# The log also gets an event log, see init_event_log
 	def init_output_files(self):
-		run = 0
 		out_files = []
-		out_file_dir = data_dir_path + time.strftime("%Y_%m_%d_")
+		date = time.strftime("%Y_%m_%d")
+		out_file_dir = data_dir_path + date + '_'
 		self.file_path_date = out_file_dir
-		while os.path.isfile(out_file_dir  + str(run) + '_' + str(data_file_types[0]) + '.' + str(data_file_ext)):
-			run += 1
+		catalog = self.get_catalog()
+		run = catalog.allocate_run(date) if catalog != None else 0
+		while self.run_exists(out_file_dir + str(run)):
+			run = catalog.allocate_run(date) if catalog != None else run + 1
 		self.file_run = run
 		self.run_number = time.strftime("%Y_%m_%d_") + str(run)
+		opener = self.file_opener()
 		for type in data_file_types:
 			if str(type) == "log":
-				out_files.append(open(out_file_dir + str(run) + '_' + str(type) + '.log','a+'))
+				out_files.append(indexed_text_file(out_file_dir + str(run) + '_' + str(type) + '.log','a+', opener=opener))
 				out_files[len(out_files)-1] = self.init_log_file(out_files[len(out_files)-1])
+				self.init_event_log(event_log_filename(out_file_dir + str(run) + '_' + str(type) + '.log'), opener)
+			elif str(type) == "bnc" and bnc_file_format == "binary":
+				out_files.append(binary_run_writer(out_file_dir + str(run) +  '_' + str(type) + '.' + str(binary_file_ext),
+					self.card_channels, self.card_freq, opener))
+			elif str(type) == "bnc" and bnc_file_format == "compressed":
+				out_files.append(compressed_run_writer(out_file_dir + str(run) +  '_' + str(type) + '.' + str(compressed_file_ext),
+					'records', self.card_channels, self.card_freq, opener=opener))
+			elif str(type) != "bnc" and other_file_format == "compressed":
+				out_files.append(compressed_run_writer(out_file_dir + str(run) +  '_' + str(type) + '.' + str(compressed_file_ext), 'text', opener=opener))
 			else:
-				out_files.append(open(out_file_dir + str(run) +  '_' + str(type) + '.' + str(data_file_ext),'a+'))
+				out_files.append(indexed_text_file(out_file_dir + str(run) +  '_' + str(type) + '.' + str(data_file_ext),'a+', opener=opener))
+		if catalog != None:
+			try:
+				self.catalog_id = catalog.start_run(date, run, dict(zip(data_file_types, [f.filename for f in out_files])),
+					self.card_freq, self.card_channels)
+			except Exception as e:
+				print "data_writer.init_output_files : Could not record the run in the run catalog"
+				print str(e)
 		return out_files
 	#
+
+	# Opens the event log %filename with %opener, starting with a snapshot of the parameters, and a line
+	# giving every parameter changed before recording started
+	def init_event_log(self, filename, opener):
+		if self.buffer and len(self.event_buffer) > 0: # Starts at the first buffered change, written after it
+			t = self.event_buffer[0]['t']
+		else:
+			t = self.record_time()
+			self.update_state(self.event_buffer)
+		self.event_log = event_log_writer(filename, t, parameter_snapshot(), opener, self.param_state)
+	#
+
+	# Adds the parameter changes among %events to param_state, the value of every parameter changed so far
+	def update_state(self, events):
+		for e in events:
+			if e != None and 'name' in e:
+				self.param_state[e['name']] = e['value']
+	#
+
+	# Returns the stop watch time that recording started
+	def record_time(self):
+		return self.timer.time()
+	#
+
+	# Returns True if there is a card data file for the run %prefix, %data_dir%year_%month_%day_%run
+	def run_exists(self, prefix):
+		for ext in (data_file_ext, binary_file_ext, compressed_file_ext):
+			if os.path.isfile(prefix + '_' + str(data_file_types[0]) + '.' + str(ext)):
+				return True
+		return False
+	#
+
+	# Returns the run catalog of the data directory, opened on first use, None if it is not used
+	def get_catalog(self):
+		if self.catalog == None and run_catalog_enabled:
+			try:
+				from catalog import run_catalog
+				self.catalog = run_catalog()
+			except Exception as e:
+				print "data_writer.get_catalog : Could not open the run catalog, probing the data directory instead"
+				print str(e)
+		return self.catalog
+	#
+
+	# Records the end of the current run in the run catalog, in the background since the tmp and mag
+	# data are read to find their ranges
+	def finish_catalog_run(self):
+		if self.catalog == None or self.catalog_id == None:
+			return
+		t = threading.Thread(target=self.catalog.finish_run, args=(self.catalog_id, time.time()))
+		t.start()
+		self.catalog_id = None
+	#
 	
 	# Turns recording on and off
 	def toggle_record(self):
-		if self.recording:
-			self.close_files(self.data_files)
-			self.data_files = None
+		if self.proc != None:
+			try:
+				reply = self.proc.request(('record', self.timer.time()))
+			except (IOError, EOFError) as e:
+				print "data_writer.toggle_record : The writer process did not answer"
+				print str(e)
+				return
+			if isinstance(reply, tuple) and len(reply) == 2:
+				self.recording, self.run_number = reply
+			else:
+				print "data_writer.toggle_record : The writer process gave no recording state"
+		elif self.recording:
+			self.close_run_files()
 			self.change_log = None
 			self.run_number = "             "
 			self.recording = False
@@ -223,7 +1175,11 @@ class data_writer(threading.Thread):
 			self.change_log = self.data_files[type_index('log')]
 			if self.buffer:
 				self.change_log.writelines(self.change_buffer)
+				for e in self.event_buffer:
+					self.event_log.write(e)
+				self.update_state(self.event_buffer)
 			self.change_buffer = []
+			self.event_buffer = []
 			self.recording = True
 	#
 
@@ -231,19 +1187,33 @@ class data_writer(threading.Thread):
 	# Records a message to the log file, buffers the change message if not recording
 	# %txt is the text to be written to the log file
 	def log_str(self, txt):
-		message = "[" + str(self.timer.time()) + "]: " + str(txt) + "\n"
-		if self.recording:
-			self.change_log.write(message)
-		else:
-			self.change_buffer.append(message)
+		t = self.timer.time()
+		message = "[" + str(t) + "]: " + str(txt) + "\n"
+		self.write_message(message, {'t' : t, 'message' : str(txt)})
+	#
 	
 	# Records a parameter change to the log file, buffers the change message if not recording
 	# %name is the name of the parameter being changed
 	# %value is the value that the parameter is being set to
 	def log(self, name, value):
-		message = "[" + str(self.timer.time()) + "]: " + "PARAMETER " + str(name) + " SET TO " + str(value) + "\n"
+		t = self.timer.time()
+		message = "[" + str(t) + "]: " + "PARAMETER " + str(name) + " SET TO " + str(value) + "\n"
+		self.write_message(message, {'t' : t, 'name' : str(name), 'value' : value})
+	#
+	
+	# Writes a message to the log file and its event %event to the event log, buffers them if not recording
+	def write_message(self, message, event=None):
+		if self.proc != None:
+			self.proc.post(('log', message, event))
+			return
 		if self.recording:
 			self.change_log.write(message)
+			if event != None:
+				self.update_state([event])
+				self.event_log.write(event)
 		else:
 			self.change_buffer.append(message)
+			if event != None:
+				self.event_buffer.append(event)
+	#
 # end data_write
@@ -0,0 +1,258 @@
+#
+# writerproc.py
+#
+# GaborDAQ data writer process, formats and writes the data files in a separate process so that
+# the disk and the formatting never hold up the acquisition
+#
+# Gabor Lab
+# University of California, Riverside
+# All Rights Reserved
+
+import os
+import sys
+import mmap
+import time
+import threading
+import tempfile
+import subprocess
+import cPickle as pickle
+import numpy as np
+
+from parameters import *
+from utilities import *
+
+# Blocks of data pass between the processes through a ring of shared memory, the acquisition process
+# copies each block into the ring and sends a short message giving its place, the writer process writes
+# it out and then releases the space. The start of the shared memory holds the count of bytes released.
+# Control messages (recording on and off, log lines, card information) are pickled over the pipes of
+# the writer process.
+#
+# The writer process is started by running this module, see writer_process
+shared_header_size = 64
+
+# Opens the shared memory named %name holding %size bytes, creating it if %create
+# On Windows it is named shared memory, elsewhere a file, in memory if /dev/shm exists
+def open_shared(name, size, create=False):
+	if sys.platform == "win32":
+		return name, mmap.mmap(-1, size, tagname=name)
+	if create:
+		fd, name = tempfile.mkstemp(prefix="gabordaq_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+		os.ftruncate(fd, size)
+	else:
+		fd = os.open(name, os.O_RDWR)
+	mem = mmap.mmap(fd, size)
+	os.close(fd)
+	return name, mem
+# end open_shared
+
+# The shared memory ring as seen by either process
+# %mem is the shared memory, %size is its size in bytes
+class shared_ring():
+	def __init__(self, mem, size):
+		self.mem = mem
+		self.capacity = size - shared_header_size
+		self.released = np.frombuffer(mem, dtype=np.uint64, count=1) # Bytes released by the writer process
+		self.data = np.frombuffer(mem, dtype=np.uint8, count=self.capacity, offset=shared_header_size)
+		self.written = 0 # Bytes used by the acquisition process
+		self.pos = 0
+	#
+
+	# Copies the contiguous array %a into the ring, waiting for the writer process to release space if needed
+	# Returns (offset, bytes used), the bytes used include any skipped at the end of the ring
+	# %alive is a function returning False if the writer process has stopped
+	def put(self, a, alive):
+		n = a.nbytes
+		skip = 0
+		if self.pos + n > self.capacity:
+			skip = self.capacity - self.pos
+		padded = skip + (n + 7)//8*8 # Keep every block aligned for its dtype
+		if padded > self.capacity:
+			raise ValueError("writerproc.shared_ring.put : block of " + str(n) + " bytes does not fit in the shared memory")
+		while self.capacity - (self.written - int(self.released[0])) < padded:
+			if not alive():
+				raise IOError("writerproc.shared_ring.put : The writer process has stopped")
+			time.sleep(0.001)
+		off = 0 if skip > 0 else self.pos
+		self.data[off:off+n] = a.reshape(-1).view(np.uint8)
+		self.written += padded
+		self.pos = (off + (n + 7)//8*8) % self.capacity
+		return off, padded
+	#
+
+	# Returns the array of %dtype and %shape at %off, without copying
+	def get(self, off, dtype, shape):
+		dtype = np.dtype(dtype)
+		n = dtype.itemsize*int(np.prod(shape))
+		return self.data[off:off+n].view(dtype).reshape(shape)
+	#
+
+	# Releases %used bytes, called by the writer process once a block is written
+	def release(self, used):
+		self.released[0] += used
+	#
+# end shared_ring
+
+# Starts and talks to the writer process, used by data_writer when it runs out of process
+# The methods may be called from any thread
+#
+# %buffer is the data_writer buffer flag, see data_writer
+# %size is the size of the shared memory in bytes
+class writer_process():
+	def __init__(self, buffer, size=writer_shared_bytes):
+		self.name, self.mem = open_shared("gabordaq_writer_" + str(os.getpid()), size, create=True)
+		self.ring = shared_ring(self.mem, size)
+		self.max_block = self.ring.capacity//4
+		self.lock = threading.Lock()
+		self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__.replace(".pyc", ".py")),
+			self.name, str(size), str(int(bool(buffer)))], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.request(('ready',))
+	#
+
+	def alive(self):
+		return self.proc.poll() == None
+	#
+
+	# Sends a message, must hold the lock
+	def send(self, msg):
+		if not self.alive():
+			raise IOError("writerproc.writer_process : The writer process has stopped")
+		pickle.dump(msg, self.proc.stdin, 2)
+		self.proc.stdin.flush()
+	#
+
+	# Sends a message and returns the reply of the writer process
+	def request(self, msg):
+		with self.lock:
+			self.send(msg)
+			return pickle.load(self.proc.stdout)
+	#
+
+	# Sends a message without waiting for a reply
+	def post(self, msg):
+		with self.lock:
+			self.send(msg)
+	#
+
+	# Passes a block of card data to the writer process, %cd is an array of voltage data or a raw_block
+	# Blocks too large for the shared memory are passed in pieces
+	def write_block(self, cd):
+		a = cd.codes if isinstance(cd, raw_block) else cd
+		rows = max(self.max_block//max(a[:1].nbytes, 1), 1)
+		for i in range(0, a.shape[0], rows):
+			piece = np.ascontiguousarray(a[i:i+rows])
+			meta = None
+			if isinstance(cd, raw_block):
+				meta = (cd.count + i, np.asarray(cd.coeffs).tolist(), cd.freq)
+			with self.lock:
+				off, used = self.ring.put(piece, self.alive)
+				self.send(('card', off, used, piece.dtype.str, piece.shape, meta))
+	#
+
+	# Passes the text %s for the other data file %i to the writer process
+	def write_text(self, i, s):
+		a = np.frombuffer(s, dtype=np.uint8)
+		with self.lock:
+			off, used = self.ring.put(a, self.alive)
+			self.send(('text', i, off, used, a.shape[0]))
+	#
+
+	# Stops the writer process once it has written everything it was sent, and frees the shared memory
+	def close(self):
+		if self.alive():
+			self.request(('stop',))
+			self.proc.wait()
+		self.ring = None
+		self.mem.close()
+		if sys.platform != "win32":
+			os.remove(self.name)
+	#
+# end writer_process
+
+# The data writer running in the writer process, writes the files of a data_writer
+# from the messages it is sent instead of reading the queues itself
+class writer_files(data_writer):
+	def __init__(self, ring, buffer):
+		self.init_state(None, buffer)
+		self.ring = ring
+		self.start_time = 0.0
+		if write_behind_enabled:
+			self.flusher = write_behind()
+	#
+
+	# Handles messages from %fin until told to stop, replies to requests on %fout
+	def serve(self, fin, fout):
+		while self.running:
+			try:
+				msg = pickle.load(fin)
+			except EOFError: # The acquisition process is gone, keep what was written
+				self.running = False
+				self.close_run_files()
+				return
+			reply = None
+			try:
+				reply = self.handle(msg)
+			except Exception as e:
+				print "writerproc.writer_files : Could not handle message " + str(msg[0])
+				print str(e)
+				if msg[0] == 'record': # The state as it is, the caller keeps it in step
+					reply = (self.recording, self.run_number)
+			if msg[0] in ('ready', 'record', 'stop'):
+				pickle.dump(reply, fout, 2)
+				fout.flush()
+	#
+
+	# Handles one message, returns the reply for requests
+	def handle(self, msg):
+		kind = msg[0]
+		if kind == 'card':
+			off, used, dtype, shape, meta = msg[1:]
+			try:
+				cd = self.ring.get(off, dtype, shape)
+				if meta != None:
+					cd = raw_block(meta[0], cd, np.array(meta[1]), meta[2])
+				self.write_card_data(cd)
+			finally:
+				self.ring.release(used)
+		elif kind == 'text':
+			i, off, used, n = msg[1:]
+			try:
+				if self.recording:
+					self.data_files[i+1].write(self.ring.data[off:off+n].tostring())
+			finally:
+				self.ring.release(used)
+		elif kind == 'log':
+			self.write_message(msg[1], msg[2])
+		elif kind == 'card_info':
+			self.set_card_info(msg[1], msg[2])
+		elif kind == 'record':
+			self.start_time = msg[1]
+			self.toggle_record()
+			return (self.recording, self.run_number)
+		elif kind == 'stop':
+			self.running = False
+			self.close_run_files()
+			if self.flusher != None:
+				self.flusher.stop()
+		return None
+	#
+
+	# The stop watch time sent with the request to start recording
+	def record_time(self):
+		return self.start_time
+	#
+# end writer_files
+
+# Writer process, run as: python writerproc.py shared_name shared_size buffer
+if __name__ == "__main__":
+	if sys.platform == "win32":
+		import msvcrt
+		msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+		msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+	# Replies go to the original stdout, anything printed goes to stderr
+	fout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+	sys.stdout = sys.stderr
+	size = int(sys.argv[2])
+	name, mem = open_shared(sys.argv[1], size)
+	files = writer_files(shared_ring(mem, size), sys.argv[3] == "1")
+	files.serve(sys.stdin, fout)
+	mem.close()